@@ -1,2 +1,19 @@
-from .cli import cli
-from .app import app
+import importlib
+
+# imported on first access, so the service processes and the cli load neither the web app nor each other
+_LAZY_ATTRIBUTES = {
+    'cli': '.cli',
+    'app': '.app',
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    # replaces the submodule set by the import system
+    globals()[name] = value
+    return value
+
+
+__all__ = list(_LAZY_ATTRIBUTES)
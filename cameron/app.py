@@ -1,21 +1,40 @@
 import asyncio
 import contextlib
-import os.path
+import json
 import time
 from pathlib import Path
-from typing import Optional, Set, List
-import json
+from typing import Optional
 
-import anyio
 from starlette.applications import Starlette
 from starlette.endpoints import WebSocketEndpoint
+from starlette.responses import JSONResponse, Response
 from starlette.routing import Route, WebSocketRoute, Mount
 from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 from starlette.types import Scope, Receive, Send
 from starlette.websockets import WebSocket
 
-from cameron.services import ServiceWebSocketClient, ServiceWebSocketClientDelegate, invoke_service
+from cameron.broadcast import (
+    CONNECTIONS,
+    BroadcastQueue,
+    KIND_VOICE_INPUT,
+    KIND_VOICE_TRANSCRIBE_RESULT,
+    KIND_VOICE_SYNTHESIZE_FORMAT,
+    broadcast_frame,
+    broadcast_stats,
+)
+from cameron.history import HistoryManager
+from cameron.memory import ConversationMemory
+from cameron.metrics import METRICS_CONTENT_TYPE, render_metrics
+from cameron.orchestrator import ConversationOrchestrator
+from cameron.services import (
+    ServiceWebSocketClient,
+    ServiceWebSocketClientDelegate,
+    open_service_pool,
+    close_service_pool,
+    service_pool_stats,
+)
+from cameron.tracing import TRACE_STAGE_ASR_FINAL, UtteranceTrace
 
 DIR_ASSETS = Path(__file__).parent / 'assets'
 DIR_WEB_STATIC = DIR_ASSETS / 'web' / 'static' / 'dist'
@@ -24,60 +43,19 @@ DIR_WEB_TEMPLATES = DIR_ASSETS / 'web' / 'templates'
 TEMPLATES = Jinja2Templates(directory=DIR_WEB_TEMPLATES)
 
 
-class HistoryManager:
-    def __init__(self):
-        self._lock = asyncio.Lock()
-        self._path = os.path.join('data', 'history.json')
-        self._data = []
-        if os.path.exists(self._path):
-            with open(self._path, 'r') as f:
-                self._data = json.load(f)
-
-    def get(self) -> List[List[str]]:
-        return self._data
-
-    async def set(self, data=List[List[str]]):
-        async with self._lock:
-            self._data = data
-            await self._save()
-
-    async def append_user(self, s: str):
-        async with self._lock:
-            # no history, or last item already has a bot response
-            if not self._data or self._data[-1][1]:
-                item = ['', '']
-                self._data.append(item)
-            else:
-                item = self._data[-1]
-
-            item[0] = item[0]+s
-
-            await self._save()
-
-    async def append_bot(self, s: str):
-        async with self._lock:
-            if not self._data:
-                return
-
-            # just append last item's bot response
-            self._data[-1][1] = self.data[-1][1]+s
-
-            await self._save()
-
-    async def _save(self):
-        data = json.dumps(self._data, ensure_ascii=False)
-        async with await anyio.open_file(self._path, 'w') as f:
-            await f.write(data)
-
-    async def save(self):
-        async with self._lock:
-            await self._save()
-
-
 @contextlib.asynccontextmanager
 async def lifespan(app: Starlette):
+    open_service_pool()
     history = HistoryManager()
-    yield {'history': history}
+    memory = ConversationMemory()
+    backfill_task = asyncio.create_task(memory.backfill(history))
+    orchestrator = ConversationOrchestrator(history, memory)
+    orchestrator.start()
+    yield {'history': history, 'orchestrator': orchestrator}
+    await orchestrator.close()
+    backfill_task.cancel()
+    history.close()
+    await close_service_pool()
 
 
 async def route_index(request):
@@ -86,22 +64,16 @@ async def route_index(request):
     })
 
 
-KIND_VOICE_INPUT = 0x01
-KIND_VOICE_TRANSCRIBE_RESULT = 0x02
-KIND_VOICE_SYNTHESIZE_RESULT = 0x03
-KIND_MODEL_GENERATE_RESULT = 0x04
+async def route_stats_services(request):
+    return JSONResponse(service_pool_stats())
+
 
-CONNECTIONS: Set['CameronEndpoint'] = set()
+async def route_stats_broadcast(request):
+    return JSONResponse(broadcast_stats())
 
 
-async def broadcast_frame(kind: int, data: bytes | str):
-    if isinstance(data, str):
-        data = data.encode('utf-8')
-    for endpoint in CONNECTIONS:
-        try:
-            await endpoint.websocket.send_bytes(bytes([kind]) + data)
-        except Exception as e:
-            print(f'broadcast_frame failed: {e}')
+async def route_metrics(request):
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 
 class CameronEndpoint(WebSocketEndpoint, ServiceWebSocketClientDelegate):
@@ -110,94 +82,84 @@ class CameronEndpoint(WebSocketEndpoint, ServiceWebSocketClientDelegate):
     def __init__(self, scope: Scope, receive: Receive, send: Send):
         super().__init__(scope, receive, send)
         self.websocket: Optional[WebSocket] = None
+        self.outbound: Optional[BroadcastQueue] = None
         self.transcribe: Optional[ServiceWebSocketClient] = None
-        self.synthesize: Optional[ServiceWebSocketClient] = None
         self.history: Optional[HistoryManager] = None
-        self.psyche_loop_task = None
-
-    async def psyche_loop(self):
-        while self.websocket:
-            await asyncio.sleep(5)
-
-            if not self.websocket:
-                return
-
-            history = self.history.get()
-
-            # if last history has a bot reponse
-            if history and history[-1][1]:
-                continue
-
-            try:
-                response = await invoke_service(
-                    'generation',
-                    '/generation/generate',
-                    input_text=history[-1][0],
-                    history=history[:-1],
-                    max_new_tokens=64,
-                )
-                print(f'generation response: {response}')
-                output_text = response['output_text']
-                history = response['history']
-                await self.synthesize.send(output_text)
-                await self.history.set(history)
-                await broadcast_frame(KIND_MODEL_GENERATE_RESULT, output_text)
-            except Exception as e:
-                print(f'psyche_loop failed: {e}')
+        self.orchestrator: Optional[ConversationOrchestrator] = None
+        # utterance being transcribed, started by its first voice frame
+        self.trace: Optional[UtteranceTrace] = None
 
     async def on_connect(self, websocket: WebSocket) -> None:
         await super().on_connect(websocket)
 
         self.history = websocket.state.history
+        self.orchestrator = websocket.state.orchestrator
         self.websocket = websocket
 
         self.transcribe = ServiceWebSocketClient(
             'transcribe',
-            '/transcribe/ws',
-            self,
-        )
-        self.synthesize = ServiceWebSocketClient(
-            'synthesize',
-            '/synthesize/ws',
+            '/transcribe/ws?events=1',
             self,
         )
 
-        CONNECTIONS.add(self)
+        self.outbound = BroadcastQueue(websocket.send_bytes)
+        self.outbound.start()
+
+        if self.orchestrator.synthesize_format:
+            self.outbound.put(
+                KIND_VOICE_SYNTHESIZE_FORMAT,
+                bytes([KIND_VOICE_SYNTHESIZE_FORMAT]) + self.orchestrator.synthesize_format.encode('utf-8'),
+            )
 
-        self.psyche_loop_task = asyncio.create_task(self.psyche_loop())
+        CONNECTIONS.add(self)
 
     async def on_receive(self, websocket: WebSocket, data: bytes) -> None:
         await super().on_receive(websocket, data)
 
         if data[0] == KIND_VOICE_INPUT:
+            if not self.trace:
+                self.trace = UtteranceTrace()
+                await self.transcribe.send(json.dumps(dict(trace_id=self.trace.trace_id)))
             await self.transcribe.send(data[1:])
 
     async def on_service_receive(self, service_name: str, service_path: str, data: str | bytes):
         if service_name == 'transcribe':
             if isinstance(data, str):
-                await self.history.append_user(data)
-                await broadcast_frame(KIND_VOICE_TRANSCRIBE_RESULT, data)
-
-        if service_name == 'synthesize':
-            if isinstance(data, bytes):
-                await broadcast_frame(KIND_VOICE_SYNTHESIZE_RESULT, data)
+                event = json.loads(data)
+                if event['type'] == 'sentence':
+                    trace, self.trace = self.trace or UtteranceTrace(event.get('trace_id')), None
+                    trace.mark(TRACE_STAGE_ASR_FINAL)
+                    if 'asr_seconds' in event:
+                        trace.record('transcribe', 'final', event['asr_seconds'])
+                    await self.history.append_user(event['text'])
+                    self.orchestrator.notify_user_input(trace)
+                    broadcast_frame(KIND_VOICE_TRANSCRIBE_RESULT, event['text'])
+                elif event['type'] == 'speech_start':
+                    if self.trace:
+                        # frames before the speech were silence
+                        self.trace.restart()
+                    self.orchestrator.notify_speech(self, True)
+                elif event['type'] == 'speech_end':
+                    self.orchestrator.notify_speech(self, False)
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
         CONNECTIONS.remove(self)
+        self.orchestrator.notify_speech(self, False)
 
         await self.transcribe.close()
-        await self.synthesize.close()
+        await self.outbound.close()
 
         self.websocket = None
 
-        await self.psyche_loop_task
-
         await super().on_disconnect(websocket, close_code)
 
 
 app = Starlette(
     routes=[
         Route('/', endpoint=route_index, methods=['GET']),
+        Route('/stats/services', endpoint=route_stats_services, methods=['GET']),
+        Route('/stats/broadcast', endpoint=route_stats_broadcast, methods=['GET']),
+        Route('/metrics', endpoint=route_metrics, methods=['GET']),
         Mount('/static/dist', app=StaticFiles(directory=DIR_WEB_STATIC)),
         WebSocketRoute('/ws', endpoint=CameronEndpoint)
     ],
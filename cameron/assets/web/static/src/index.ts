@@ -3,6 +3,13 @@ enum WebSocketFrameKind {
     AudioTranscribeResult = 0x02,
     AudioSynthesizeResult = 0x03,
     ModelGenerationResult = 0x04,
+    AudioSynthesizeFormat = 0x05,
+}
+
+interface AudioSynthesizeFormat {
+    format: string
+    sample_rate: number
+    channels: number
 }
 
 async function wait(ms: number) {
@@ -39,8 +46,22 @@ const state: {
     ws?: WebSocket;
     audioStream?: MediaStream;
     audioContext?: AudioContext;
+    synthesizeFormat?: AudioSynthesizeFormat;
 } = {};
 
+function decodePcmS16LE(ctx: AudioContext, format: AudioSynthesizeFormat, data: Uint8Array): AudioBuffer {
+    const samples = new Int16Array(data.buffer.slice(data.byteOffset, data.byteOffset + data.byteLength))
+    const frames = samples.length / format.channels
+    const buf = ctx.createBuffer(format.channels, frames, format.sample_rate)
+    for (let c = 0; c < format.channels; c++) {
+        const channel = buf.getChannelData(c)
+        for (let i = 0; i < frames; i++) {
+            channel[i] = samples[i * format.channels + c] / 32768
+        }
+    }
+    return buf
+}
+
 class AudioSynthesizeQueue {
     queue: Uint8Array[] = []
 
@@ -68,7 +89,10 @@ class AudioSynthesizeQueue {
                     this.queue = [];
                     return
                 }
-                const buf = await ctx.decodeAudioData(data.buffer.slice(data.byteOffset, data.byteLength))
+                const format = state.synthesizeFormat
+                const buf = format && format.format === 'pcm_s16le'
+                    ? decodePcmS16LE(ctx, format, data)
+                    : await ctx.decodeAudioData(data.buffer.slice(data.byteOffset, data.byteOffset + data.byteLength))
 
                 const src = ctx.createBufferSource()
                 src.buffer = buf
@@ -128,6 +152,10 @@ async function setupWebSocket() {
             case WebSocketFrameKind.AudioSynthesizeResult:
                 await audioQueue.add(data.subarray(1))
                 break
+            case WebSocketFrameKind.AudioSynthesizeFormat:
+                state.synthesizeFormat = JSON.parse(new TextDecoder().decode(data.subarray(1)))
+                info(`synthesize format: ${state.synthesizeFormat?.format}`)
+                break
             case WebSocketFrameKind.ModelGenerationResult:
                 const result = new TextDecoder().decode(data.subarray(1))
                 info(`model generation result: ${result}`)
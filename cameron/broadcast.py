@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import os
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+KIND_VOICE_INPUT = 0x01
+KIND_VOICE_TRANSCRIBE_RESULT = 0x02
+KIND_VOICE_SYNTHESIZE_RESULT = 0x03
+KIND_MODEL_GENERATE_RESULT = 0x04
+# json header describing the encoding of following KIND_VOICE_SYNTHESIZE_RESULT frames
+KIND_VOICE_SYNTHESIZE_FORMAT = 0x05
+
+# frames a slow consumer may lose, every other kind is always delivered
+KINDS_DROPPABLE = {KIND_VOICE_SYNTHESIZE_RESULT}
+
+BROADCAST_QUEUE_SIZE = int(os.getenv('CAMERON_BROADCAST_QUEUE_SIZE', '64'))
+BROADCAST_QUEUE_BYTES = int(os.getenv('CAMERON_BROADCAST_QUEUE_BYTES', str(4 * 1024 * 1024)))
+# 'drop_oldest', 'drop_newest' or 'coalesce'
+BROADCAST_POLICY = os.getenv('CAMERON_BROADCAST_POLICY', 'drop_oldest')
+
+# connected browser endpoints, each with an ``outbound`` queue
+CONNECTIONS: Set = set()
+
+
+class BroadcastQueue:
+    """
+    bounded outbound queue of a single connection, drained by its own sender task so a slow consumer never delays
+    the others
+
+    once ``max_size`` frames or ``max_bytes`` are queued, droppable frames are handled by ``policy``:
+    'drop_oldest' discards the oldest queued droppable frame, 'drop_newest' discards the incoming one, 'coalesce'
+    appends the incoming frame to the last queued frame of the same kind while within ``max_bytes``, and drops the
+    oldest otherwise
+    """
+
+    def __init__(
+            self,
+            send: Callable[[bytes], Awaitable[None]],
+            max_size: int = BROADCAST_QUEUE_SIZE,
+            max_bytes: int = BROADCAST_QUEUE_BYTES,
+            policy: str = BROADCAST_POLICY,
+    ):
+        if policy not in ('drop_oldest', 'drop_newest', 'coalesce'):
+            raise ValueError(f'unknown broadcast policy: {policy}')
+        self.send = send
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.frames: Deque[Tuple[int, bytes]] = collections.deque()
+        self.nbytes = 0
+        self.event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.frames.clear()
+        self.nbytes = 0
+
+    @property
+    def full(self) -> bool:
+        return len(self.frames) >= self.max_size or self.nbytes >= self.max_bytes
+
+    def put(self, kind: int, frame: bytes):
+        """
+        :param frame: the kind byte followed by the payload, shared between all queues
+        """
+        if kind in KINDS_DROPPABLE and self.full:
+            if self.policy == 'drop_newest':
+                self.dropped += 1
+                return
+            if self.policy == 'coalesce' and self.frames and self.frames[-1][0] == kind and \
+                    self.nbytes + len(frame) - 1 <= self.max_bytes:
+                _, last = self.frames.pop()
+                self.frames.append((kind, last + frame[1:]))
+                self.nbytes += len(frame) - 1
+                self.coalesced += 1
+                return
+            self._drop_oldest(kind)
+
+        self.frames.append((kind, frame))
+        self.nbytes += len(frame)
+        self.max_depth = max(self.max_depth, len(self.frames))
+        self.event.set()
+
+    def _drop_oldest(self, kind: int):
+        for i, (queued_kind, queued) in enumerate(self.frames):
+            if queued_kind == kind:
+                del self.frames[i]
+                self.nbytes -= len(queued)
+                self.dropped += 1
+                return
+
+    async def _run(self):
+        while True:
+            while not self.frames:
+                self.event.clear()
+                await self.event.wait()
+            _, frame = self.frames.popleft()
+            self.nbytes -= len(frame)
+            try:
+                await self.send(frame)
+            except Exception as e:
+                print(f'broadcast: send failed: {e}')
+                return
+            self.sent += 1
+
+    def stats(self) -> Dict:
+        return dict(
+            depth=len(self.frames),
+            bytes=self.nbytes,
+            max_depth=self.max_depth,
+            sent=self.sent,
+            dropped=self.dropped,
+            coalesced=self.coalesced,
+        )
+
+
+def broadcast_frame(kind: int, data: bytes | str):
+    """
+    queue a frame for every connection, the frame is built once and shared
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    frame = bytes([kind]) + data
+    for endpoint in CONNECTIONS:
+        endpoint.outbound.put(kind, frame)
+
+
+def broadcast_stats() -> Dict:
+    connections = [endpoint.outbound.stats() for endpoint in CONNECTIONS]
+    return dict(
+        policy=BROADCAST_POLICY,
+        connections=connections,
+        dropped=sum(c['dropped'] for c in connections),
+        coalesced=sum(c['coalesced'] for c in connections),
+    )
@@ -0,0 +1,215 @@
+import asyncio
+import json
+import os
+from typing import Iterator, List, Optional, Tuple
+
+import anyio
+
+HISTORY_STORE = os.getenv('CAMERON_HISTORY_STORE', 'jsonl')
+HISTORY_WINDOW_TURNS = int(os.getenv('CAMERON_HISTORY_WINDOW_TURNS', '64'))
+# a short history is not rewritten before this many appends
+HISTORY_COMPACT_MIN_APPENDS = int(os.getenv('CAMERON_HISTORY_COMPACT_MIN_APPENDS', '256'))
+
+
+class HistoryStore:
+    """
+    storage backend of the conversation history, a list of [user, bot] turns
+
+    turns are only ever appended or updated at the end, so backends can store deltas
+    """
+
+    def load_tail(self, limit: int) -> Tuple[int, List[List[str]]]:
+        """
+        :return: index of the first returned turn and the last ``limit`` turns
+        """
+        raise NotImplementedError()
+
+    def load_all(self) -> List[List[str]]:
+        raise NotImplementedError()
+
+    def put(self, index: int, turn: List[str]):
+        """
+        insert or update a single turn
+        """
+        raise NotImplementedError()
+
+    def replace(self, turns: List[List[str]]):
+        """
+        replace the whole history
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def _read_lines_reversed(path: str, block_size: int = 64 * 1024) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b'\n')
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line
+        if remainder:
+            yield remainder
+
+
+class JsonLinesHistoryStore(HistoryStore):
+    """
+    append-only log with one ``{"i": index, "u": user, "b": bot}`` record per write, the last record of an index wins
+
+    the log is rewritten with one record per turn after as many appends as there are turns, and at least
+    ``HISTORY_COMPACT_MIN_APPENDS``, which keeps the amortized cost of a write independent of the history length
+    """
+
+    def __init__(self, path: str, legacy_path: Optional[str] = None):
+        self.path = path
+        # records appended since the last compaction
+        self.records = 0
+        self.count = 0
+
+        if not os.path.exists(path) and legacy_path and os.path.exists(legacy_path):
+            with open(legacy_path, 'r') as f:
+                self.replace(json.load(f))
+            print(f'history: migrated {legacy_path} to {path}')
+
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                # terminate a torn write so the next record starts on its own line
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+
+        # reads only the last record
+        self.load_tail(1)
+
+    def load_tail(self, limit: int) -> Tuple[int, List[List[str]]]:
+        if not os.path.exists(self.path):
+            return 0, []
+
+        turns = {}
+        for line in _read_lines_reversed(self.path):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # torn write at the end of the log
+                continue
+            if not turns:
+                self.count = record['i'] + 1
+            if record['i'] < self.count - limit:
+                break
+            turns.setdefault(record['i'], [record['u'], record['b']])
+
+        offset = self.count - len(turns)
+        return offset, [turns[i] for i in range(offset, self.count)]
+
+    def load_all(self) -> List[List[str]]:
+        return self.load_tail(self.count)[1]
+
+    def put(self, index: int, turn: List[str]):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(dict(i=index, u=turn[0], b=turn[1]), ensure_ascii=False) + '\n')
+        self.records += 1
+        self.count = max(self.count, index + 1)
+
+        if self.records >= max(self.count, HISTORY_COMPACT_MIN_APPENDS):
+            self.compact()
+
+    def replace(self, turns: List[List[str]]):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for i, turn in enumerate(turns):
+                f.write(json.dumps(dict(i=i, u=turn[0], b=turn[1]), ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.records = 0
+        self.count = len(turns)
+
+    def compact(self):
+        self.replace(self.load_all())
+
+
+def create_history_store() -> HistoryStore:
+    if HISTORY_STORE == 'jsonl':
+        return JsonLinesHistoryStore(
+            os.path.join('data', 'history.jsonl'),
+            legacy_path=os.path.join('data', 'history.json'),
+        )
+    raise ValueError(f'unknown history store: {HISTORY_STORE}')
+
+
+class HistoryManager:
+    """
+    keeps the last turns in memory and writes every change through to the store as a single turn
+    """
+
+    def __init__(self, store: Optional[HistoryStore] = None):
+        self._lock = asyncio.Lock()
+        self._store = store or create_history_store()
+        self._offset, self._data = self._store.load_tail(HISTORY_WINDOW_TURNS)
+
+    @property
+    def offset(self) -> int:
+        """
+        index of the first turn returned by ``get``
+        """
+        return self._offset
+
+    def get(self) -> List[List[str]]:
+        """
+        :return: the most recent turns
+        """
+        return self._data
+
+    async def load_all(self) -> List[List[str]]:
+        async with self._lock:
+            return await anyio.to_thread.run_sync(self._store.load_all)
+
+    async def set(self, data: List[List[str]]):
+        async with self._lock:
+            await anyio.to_thread.run_sync(self._store.replace, data)
+            self._offset, self._data = max(0, len(data) - HISTORY_WINDOW_TURNS), data[-HISTORY_WINDOW_TURNS:]
+
+    async def append_user(self, s: str):
+        async with self._lock:
+            # no history, or last item already has a bot response
+            if not self._data or self._data[-1][1]:
+                item = ['', '']
+                self._data.append(item)
+            else:
+                item = self._data[-1]
+
+            item[0] = item[0]+s
+
+            await self._put_last()
+
+    async def append_bot(self, s: str):
+        async with self._lock:
+            if not self._data:
+                return
+
+            # just append last item's bot response
+            self._data[-1][1] = self._data[-1][1]+s
+
+            await self._put_last()
+
+    async def _put_last(self):
+        index = self._offset + len(self._data) - 1
+        await anyio.to_thread.run_sync(self._store.put, index, list(self._data[-1]))
+
+        # keep the in-memory window bounded
+        if len(self._data) > HISTORY_WINDOW_TURNS * 2:
+            trimmed = len(self._data) - HISTORY_WINDOW_TURNS
+            self._data = self._data[trimmed:]
+            self._offset += trimmed
+
+    def close(self):
+        self._store.close()
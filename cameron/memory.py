@@ -0,0 +1,101 @@
+import asyncio
+import os
+from typing import Dict, List, Tuple
+
+from cameron.history import HistoryManager
+from cameron.services import invoke_service
+
+MEMORY_INDEX_NAME = 'history'
+MEMORY_RECENT_TURNS = int(os.getenv('CAMERON_MEMORY_RECENT_TURNS', '4'))
+MEMORY_RECALL_TOP_K = int(os.getenv('CAMERON_MEMORY_RECALL_TOP_K', '4'))
+MEMORY_BACKFILL_BATCH_SIZE = 64
+
+
+def recent_window_start(count: int) -> int:
+    """
+    history index of the first recent turn, the window advances ``MEMORY_RECENT_TURNS`` turns at a time, so
+    consecutive prompts share it as a prefix, it holds ``MEMORY_RECENT_TURNS`` turns up to fewer than twice as many
+
+    :param count: turns before the current input
+    """
+    return max(0, (count - MEMORY_RECENT_TURNS) // MEMORY_RECENT_TURNS * MEMORY_RECENT_TURNS)
+
+
+class ConversationMemory:
+    """
+    index completed history turns in the embeddings service and recall the relevant ones for a new input,
+    so the prompt sent to generation stays bounded however long the history grows
+    """
+
+    async def index_turns(self, turns: List[Tuple[int, List[str]]]):
+        """
+        :param turns: (history index, [user, bot]) pairs, turns without a bot response are skipped
+        """
+        items = [
+            dict(id=i, text=turn[0] + '\n' + turn[1], payload=dict(index=i, turn=turn))
+            for i, turn in turns if turn[0] and turn[1]
+        ]
+        if not items:
+            return
+        await invoke_service(
+            'embeddings',
+            '/embeddings/index/add',
+            index=MEMORY_INDEX_NAME,
+            items=items,
+        )
+
+    async def remember(self, index: int, turn: List[str]):
+        try:
+            await self.index_turns([(index, turn)])
+        except Exception as e:
+            print(f'memory: index failed: {e}')
+
+    async def backfill(self, history: HistoryManager, attempts: int = 5):
+        """
+        index turns recorded before this process started, already indexed turns are skipped by the service
+        """
+        turns = list(enumerate(await history.load_all()))
+        for attempt in range(attempts):
+            try:
+                for i in range(0, len(turns), MEMORY_BACKFILL_BATCH_SIZE):
+                    await self.index_turns(turns[i:i + MEMORY_BACKFILL_BATCH_SIZE])
+                return
+            except Exception as e:
+                print(f'memory: backfill failed: {e}')
+                await asyncio.sleep(5 * (attempt + 1))
+
+    async def search(self, input_text: str, k: int) -> List[Dict]:
+        """
+        :return: payloads of the ``k`` indexed turns closest to ``input_text``
+        """
+        response = await invoke_service(
+            'embeddings',
+            '/embeddings/index/search',
+            idempotent=True,
+            index=MEMORY_INDEX_NAME,
+            text=input_text,
+            k=k,
+        )
+        return [result['payload'] for result in response['results']]
+
+    async def recall(self, input_text: str, history: List[List[str]], offset: int = 0) -> List[List[str]]:
+        """
+        :param input_text: current user input
+        :param history: the latest turns before the current input
+        :param offset: history index of the first turn in ``history``
+        :return: the recent turns followed by the recalled ones in chronological order, recalled turns change with
+            every input, so they come last to keep the prompt prefix reusable by the generation prefix cache
+        """
+        recent_start = max(0, recent_window_start(offset + len(history)) - offset)
+        if offset + recent_start == 0:
+            return history
+
+        recalled = {}
+        try:
+            for payload in await self.search(input_text, MEMORY_RECALL_TOP_K):
+                if payload['index'] < offset + recent_start and payload.get('turn'):
+                    recalled[payload['index']] = payload['turn']
+        except Exception as e:
+            print(f'memory: recall failed: {e}')
+
+        return history[recent_start:] + [recalled[i] for i in sorted(recalled)]
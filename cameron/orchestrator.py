@@ -0,0 +1,243 @@
+import asyncio
+import collections
+import json
+import os
+import uuid
+from typing import Any, Optional, OrderedDict, Set
+
+from cameron.broadcast import (
+    broadcast_frame,
+    KIND_MODEL_GENERATE_RESULT,
+    KIND_VOICE_SYNTHESIZE_FORMAT,
+    KIND_VOICE_SYNTHESIZE_RESULT,
+)
+from cameron.history import HistoryManager
+from cameron.memory import ConversationMemory
+from cameron.segmenter import ClauseSegmenter
+from cameron.services import ServiceWebSocketClient, ServiceWebSocketClientDelegate, stream_service
+from cameron.tracing import (
+    TRACE_STAGE_FIRST_AUDIO,
+    TRACE_STAGE_FIRST_TOKEN,
+    TRACE_STAGE_GENERATION_START,
+    UtteranceTrace,
+)
+
+ORCHESTRATOR_END_OF_UTTERANCE_DELAY = float(os.getenv('CAMERON_END_OF_UTTERANCE_DELAY', '0.8'))
+# shorter delay once voice activity detection reports when speech ends
+ORCHESTRATOR_SPEECH_END_DELAY = float(os.getenv('CAMERON_SPEECH_END_DELAY', '0.2'))
+ORCHESTRATOR_MAX_NEW_TOKENS = int(os.getenv('CAMERON_GENERATION_MAX_NEW_TOKENS', '64'))
+# replies still being synthesized, the oldest ones are given up once exceeded
+ORCHESTRATOR_MAX_REPLIES_TRACED = 8
+
+
+class ConversationOrchestrator(ServiceWebSocketClientDelegate):
+    """
+    app-wide owner of the reply pipeline, a reply is generated once the user stayed silent for the
+    end-of-utterance delay, and superseded as soon as the user continues talking
+
+    with speech start / end notifications from voice activity detection, a pending reply waits for the speech to
+    end, and the shorter speech-end delay applies
+    """
+
+    def __init__(self, history: HistoryManager, memory: ConversationMemory):
+        self.history = history
+        self.memory = memory
+        # keeps the generation and synthesize calls of this conversation on one replica each, warming its caches
+        self.conversation_id = uuid.uuid4().hex
+        self.synthesize: Optional[ServiceWebSocketClient] = None
+        # stream header of the synthesize websocket, forwarded to every browser
+        self.synthesize_format: Optional[str] = None
+        self.debounce_task: Optional[asyncio.Task] = None
+        self.generation_task: Optional[asyncio.Task] = None
+        # a transcribed sentence is waiting for a reply
+        self.pending_input = False
+        # sources currently reporting speech
+        self.speaking: Set[Any] = set()
+        self.speech_events = False
+        # trace of the input waiting for a reply, and of the replies being generated or synthesized
+        self.trace: Optional[UtteranceTrace] = None
+        self.replies: OrderedDict[str, UtteranceTrace] = collections.OrderedDict()
+        # reply of the audio currently streamed by synthesize
+        self.synthesize_trace: Optional[UtteranceTrace] = None
+
+    def start(self):
+        self.synthesize = ServiceWebSocketClient(
+            'synthesize',
+            '/synthesize/ws?format=pcm&events=1',
+            self,
+            affinity=self.conversation_id,
+        )
+        # reply to an input left unanswered by the previous run
+        history = self.history.get()
+        if history and not history[-1][1]:
+            self.notify_user_input()
+
+    async def close(self):
+        self._cancel()
+        if self.trace:
+            self.trace.finish('incomplete')
+            self.trace = None
+        for trace in self.replies.values():
+            trace.finish('incomplete')
+        self.replies.clear()
+        if self.synthesize:
+            await self.synthesize.close()
+            self.synthesize = None
+
+    def _cancel(self):
+        for task in (self.debounce_task, self.generation_task):
+            if task and not task.done():
+                task.cancel()
+        self.debounce_task = None
+        self.generation_task = None
+
+    def notify_user_input(self, trace: Optional[UtteranceTrace] = None):
+        """
+        called after a transcribed sentence was appended to the history
+
+        :param trace: timings of the sentence, continued by the reply
+        """
+        if self.generation_task and not self.generation_task.done():
+            print('orchestrator: user continued talking, superseding generation')
+            # drop clauses of the superseded reply still queued for synthesis
+            asyncio.create_task(self.synthesize.send(json.dumps(dict(cancel=True))))
+        self._cancel()
+        if self.trace:
+            # answered together with the new sentence
+            self.trace.finish('superseded')
+        self.trace = trace
+        self.pending_input = True
+        if not self.speaking:
+            self.debounce_task = asyncio.create_task(self._debounce())
+
+    def notify_speech(self, source: Any, speaking: bool):
+        """
+        called when voice activity detection of ``source`` reports the start or the end of speech
+        """
+        if speaking:
+            self.speech_events = True
+            self.speaking.add(source)
+            # hold the reply while the user is talking
+            if self.debounce_task and not self.debounce_task.done():
+                self.debounce_task.cancel()
+                self.debounce_task = None
+            return
+
+        if source not in self.speaking:
+            return
+        self.speaking.discard(source)
+        if not self.speaking and self.pending_input and not self.debounce_task:
+            self.debounce_task = asyncio.create_task(self._debounce())
+
+    async def _debounce(self):
+        if self.speech_events:
+            await asyncio.sleep(ORCHESTRATOR_SPEECH_END_DELAY)
+        else:
+            await asyncio.sleep(ORCHESTRATOR_END_OF_UTTERANCE_DELAY)
+        self.debounce_task = None
+        self.pending_input = False
+        trace, self.trace = self.trace or UtteranceTrace(), None
+        self.generation_task = asyncio.create_task(self._generate(trace))
+
+    def _finish_trace(self, trace: UtteranceTrace, outcome: str):
+        trace.finish(outcome)
+        self.replies.pop(trace.trace_id, None)
+        if self.synthesize_trace is trace:
+            self.synthesize_trace = None
+
+    async def _synthesize(self, trace: UtteranceTrace, clause: str):
+        trace.clauses_sent += 1
+        await self.synthesize.send(json.dumps(dict(text=clause, trace_id=trace.trace_id), ensure_ascii=False))
+
+    async def _generate(self, trace: UtteranceTrace):
+        history = self.history.get()
+        offset = self.history.offset
+
+        # last history already has a bot response
+        if not history or history[-1][1]:
+            trace.finish('incomplete')
+            return
+
+        trace.mark(TRACE_STAGE_GENERATION_START)
+        self.replies[trace.trace_id] = trace
+        while len(self.replies) > ORCHESTRATOR_MAX_REPLIES_TRACED:
+            _, expired = self.replies.popitem(last=False)
+            self._finish_trace(expired, 'incomplete')
+
+        try:
+            input_text = history[-1][0]
+            context = await self.memory.recall(input_text, history[:-1], offset)
+
+            segmenter = ClauseSegmenter()
+            output_text = ''
+            async for event in stream_service(
+                    'generation',
+                    '/generation/stream',
+                    input_text=input_text,
+                    history=context,
+                    max_new_tokens=ORCHESTRATOR_MAX_NEW_TOKENS,
+                    trace_id=trace.trace_id,
+                    affinity=self.conversation_id,
+            ):
+                if 'delta' in event:
+                    trace.mark(TRACE_STAGE_FIRST_TOKEN)
+                    # hand every completed clause to synthesize while generation continues
+                    for clause in segmenter.push(event['delta']):
+                        await self._synthesize(trace, clause)
+                    continue
+                print(f'generation response: {event}')
+                output_text = event['output_text']
+                for stage in ('queue', 'prefill', 'decode'):
+                    if stage in event.get('timings', {}):
+                        trace.record('generation', stage, event['timings'][stage])
+            clause = segmenter.flush()
+            if clause:
+                await self._synthesize(trace, clause)
+
+            # a sentence appended to the turn before the reply is committed supersedes it, the turn is answered again
+            await self.history.append_bot(output_text)
+
+            # the reply is committed, a new user sentence starts the next turn instead of superseding it
+            self.generation_task = None
+            trace.generation_done = True
+            if trace.reply_done:
+                self._finish_trace(trace, 'replied')
+
+            broadcast_frame(KIND_MODEL_GENERATE_RESULT, output_text)
+
+            asyncio.create_task(self.memory.remember(offset + len(history) - 1, [input_text, output_text]))
+        except asyncio.CancelledError:
+            if not trace.generation_done:
+                self._finish_trace(trace, 'superseded')
+            raise
+        except Exception as e:
+            print(f'orchestrator: generation failed: {e}')
+            self._finish_trace(trace, 'failed')
+
+    def _on_synthesize_event(self, event: dict):
+        trace = self.replies.get(event.get('trace_id'))
+        if event['type'] == 'start':
+            self.synthesize_trace = trace
+        elif event['type'] == 'end':
+            self.synthesize_trace = None
+            if not trace:
+                return
+            trace.clauses_done += 1
+            trace.record('synthesize', 'first_chunk', event['first_chunk'])
+            if trace.reply_done:
+                self._finish_trace(trace, 'replied')
+
+    async def on_service_receive(self, service_name: str, service_path: str, data: str | bytes):
+        if service_name == 'synthesize':
+            if isinstance(data, bytes):
+                broadcast_frame(KIND_VOICE_SYNTHESIZE_RESULT, data)
+                if self.synthesize_trace:
+                    self.synthesize_trace.mark(TRACE_STAGE_FIRST_AUDIO)
+                return
+            event = json.loads(data)
+            if 'type' in event:
+                self._on_synthesize_event(event)
+            else:
+                # stream header, sent once per connection
+                self.synthesize_format = data
+                broadcast_frame(KIND_VOICE_SYNTHESIZE_FORMAT, data)
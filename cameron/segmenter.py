@@ -0,0 +1,58 @@
+from typing import List, Optional
+
+SENTENCE_TERMINATORS = set('。！？；!?;…\n')
+CLAUSE_SEPARATORS = set('，、：,:')
+# a trailing '.' only ends a sentence when followed by whitespace, to keep decimals and abbreviations intact
+AMBIGUOUS_TERMINATORS = set('.')
+
+CLAUSE_MIN_LENGTH = 6
+
+
+class ClauseSegmenter:
+    """
+    split streamed text into clauses that can be synthesized independently
+    """
+
+    def __init__(self, min_length: int = CLAUSE_MIN_LENGTH):
+        self.min_length = min_length
+        self.buffer = ''
+
+    def push(self, delta: str) -> List[str]:
+        """
+        feed a text delta
+
+        :return: clauses completed by this delta
+        """
+        self.buffer += delta
+
+        clauses = []
+        start = 0
+        for i, c in enumerate(self.buffer):
+            if c in SENTENCE_TERMINATORS:
+                end = i + 1
+            elif c in CLAUSE_SEPARATORS and len(self.buffer[start:i + 1].strip()) >= self.min_length:
+                end = i + 1
+            elif c in AMBIGUOUS_TERMINATORS and i + 1 < len(self.buffer) and self.buffer[i + 1].isspace():
+                end = i + 1
+            else:
+                continue
+            clause = self.buffer[start:end].strip()
+            if any(ch.isalnum() for ch in clause):
+                clauses.append(clause)
+            elif clause and clauses:
+                # trailing punctuation only, keep it with the previous clause
+                clauses[-1] += clause
+            start = end
+
+        self.buffer = self.buffer[start:]
+        return clauses
+
+    def flush(self) -> Optional[str]:
+        """
+        :return: remaining text after the stream finished
+        """
+        clause = self.buffer.strip()
+        self.buffer = ''
+        if not any(ch.isalnum() for ch in clause):
+            return None
+        return clause
@@ -1,7 +1,26 @@
-from .bootstrap import services_running
-from .client import (
-    invoke_service,
-    connect_service_websocket,
-    ServiceWebSocketClientDelegate,
-    ServiceWebSocketClient
-)
+import importlib
+
+# imported on first access, so a service process does not load the clients of the other services
+_LAZY_ATTRIBUTES = {
+    'services_running': '.bootstrap',
+    'invoke_service': '.client',
+    'invoke_service_vectors': '.client',
+    'stream_service': '.client',
+    'open_service_pool': '.client',
+    'close_service_pool': '.client',
+    'service_pool_stats': '.client',
+    'connect_service_websocket': '.client',
+    'ServiceWebSocketClientDelegate': '.client',
+    'ServiceWebSocketClient': '.client',
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+__all__ = list(_LAZY_ATTRIBUTES)
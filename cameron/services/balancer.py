@@ -0,0 +1,78 @@
+import collections
+import time
+from typing import Dict, List, Optional, OrderedDict, Tuple
+
+from .bootstrap import get_service_replicas
+
+# a replica failing to connect is skipped for this many seconds, e.g. while the supervisor restarts it
+SERVICE_REPLICA_DOWN_TIME = 5.0
+SERVICE_AFFINITY_MAX_KEYS = 4096
+
+
+class ServiceBalancer:
+    """
+    picks a replica of a service by least outstanding requests, calls sharing an affinity key stick to the replica
+    picked first, so caches of a conversation stay warm on one replica
+
+    an open websocket counts as an outstanding request until it is closed
+    """
+
+    def __init__(self):
+        self.outstanding: Dict[str, List[int]] = {}
+        self.down_until: Dict[str, List[float]] = {}
+        self.affinity: OrderedDict[Tuple[str, str], int] = collections.OrderedDict()
+
+    def _replicas(self, name: str) -> List[int]:
+        if name not in self.outstanding:
+            replicas = get_service_replicas(name)
+            self.outstanding[name] = [0] * replicas
+            self.down_until[name] = [0.0] * replicas
+        return self.outstanding[name]
+
+    def pick(self, name: str, affinity: Optional[str] = None) -> int:
+        outstanding = self._replicas(name)
+        if len(outstanding) == 1:
+            return 0
+
+        now = time.monotonic()
+        down_until = self.down_until[name]
+        if affinity is not None:
+            replica = self.affinity.get((name, affinity))
+            if replica is not None and down_until[replica] <= now:
+                self.affinity.move_to_end((name, affinity))
+                return replica
+
+        # every replica down, try them all anyway
+        candidates = [i for i in range(len(outstanding)) if down_until[i] <= now] or range(len(outstanding))
+        replica = min(candidates, key=lambda i: outstanding[i])
+
+        if affinity is not None:
+            self.affinity[(name, affinity)] = replica
+            self.affinity.move_to_end((name, affinity))
+            while len(self.affinity) > SERVICE_AFFINITY_MAX_KEYS:
+                self.affinity.popitem(last=False)
+        return replica
+
+    def acquire(self, name: str, affinity: Optional[str] = None) -> int:
+        replica = self.pick(name, affinity)
+        self.outstanding[name][replica] += 1
+        return replica
+
+    def release(self, name: str, replica: int, failed: bool = False):
+        """
+        :param failed: the replica could not be reached, calls are moved to the other replicas for a while
+        """
+        self.outstanding[name][replica] -= 1
+        if failed:
+            self.down_until[name][replica] = time.monotonic() + SERVICE_REPLICA_DOWN_TIME
+
+    def stats(self, name: str) -> List[Dict]:
+        now = time.monotonic()
+        return [
+            dict(outstanding=outstanding, down=down_until > now)
+            for outstanding, down_until in zip(self._replicas(name), self.down_until[name])
+        ]
+
+
+# shared by the http pool and the websocket clients of the process
+SERVICE_BALANCER = ServiceBalancer()
@@ -1,6 +1,10 @@
 import multiprocessing
 import os
+import threading
+import time
+from typing import Dict, Optional
 
+import httpx
 import uvicorn
 
 SERVICE_NAMES = [
@@ -10,33 +14,217 @@ SERVICE_NAMES = [
     'transcribe',
 ]
 
+# replicas per service, e.g. 'generation=2,synthesize=2', one by default
+SERVICE_REPLICAS = os.getenv('CAMERON_SERVICE_REPLICAS', '')
+# cuda devices assigned to the replicas of a service in turn, e.g. 'generation=0:1,synthesize=1'
+SERVICE_DEVICES = os.getenv('CAMERON_SERVICE_DEVICES', '')
+# the vector index and cache of embeddings are append-only files with a single writer
+SERVICE_NAMES_SINGLE_REPLICA = {'embeddings'}
 
-def get_service_socket_path(name: str) -> str:
+SERVICE_READY_TIMEOUT = float(os.getenv('CAMERON_SERVICE_READY_TIMEOUT', '600'))
+SERVICE_RESTART_BACKOFF = 1.0
+SERVICE_RESTART_BACKOFF_MAX = 30.0
+# a worker running longer than this before crashing restarts without backoff
+SERVICE_RESTART_STABLE_TIME = 60.0
+
+
+def _parse_service_options(value: str) -> Dict[str, str]:
+    """
+    :param value: comma separated 'name=option' pairs
+    """
+    options = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, _, option = item.partition('=')
+        options[name.strip()] = option.strip()
+    return options
+
+
+def get_service_replicas(name: str) -> int:
+    if name in SERVICE_NAMES_SINGLE_REPLICA:
+        return 1
+    return max(1, int(_parse_service_options(SERVICE_REPLICAS).get(name, '1')))
+
+
+def get_service_device(name: str, replica: int = 0) -> Optional[str]:
+    """
+    :return: CUDA_VISIBLE_DEVICES of the replica, None to inherit
+    """
+    devices = _parse_service_options(SERVICE_DEVICES).get(name)
+    if not devices:
+        return None
+    devices = devices.split(':')
+    return devices[replica % len(devices)]
+
+
+def get_service_socket_path(name: str, replica: int = 0) -> str:
+    # the first replica keeps the socket path of a single worker
+    if replica:
+        name = f'{name}-{replica}'
     return os.path.join('data', 'service-' + name + ".socket")
 
 
-def run_service(name: str):
-    socket_path = get_service_socket_path(name)
+def run_service(name: str, replica: int = 0):
+    # ctrl-c in the terminal stops the app only, services are stopped by the supervisor
+    os.setpgrp()
+
+    device = get_service_device(name, replica)
+    if device is not None:
+        # before the service module imports torch
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+
+    socket_path = get_service_socket_path(name, replica)
     if os.path.exists(socket_path):
         os.remove(socket_path)
 
     uvicorn.run(f'cameron.services.{name}:app', uds=socket_path, log_level="info")
 
 
+def probe_service(name: str, replica: int = 0, timeout: float = 1) -> Optional[Dict]:
+    """
+    :return: the health response of a service replica, None if it is not serving yet
+    """
+    transport = httpx.HTTPTransport(uds=get_service_socket_path(name, replica))
+    try:
+        with httpx.Client(transport=transport, timeout=timeout) as client:
+            res = client.get(f'http://dummyhost/{name}/health')
+            res.raise_for_status()
+            return res.json()
+    except httpx.HTTPError:
+        return None
+
+
+class ServiceWorker:
+    def __init__(self, name: str, replica: int = 0):
+        self.name = name
+        self.replica = replica
+        self.label = f'{name}-{replica}' if replica else name
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.backoff = SERVICE_RESTART_BACKOFF
+        self.restart_at: Optional[float] = None
+        self.ready = False
+
+    def start(self):
+        # a stale socket of a previous run must not pass the readiness probe
+        socket_path = get_service_socket_path(self.name, self.replica)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.process = multiprocessing.Process(
+            target=run_service,
+            args=(self.name, self.replica),
+            name=f'service-{self.label}',
+            # terminated with the supervisor, even when it exits abnormally
+            daemon=True,
+        )
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        self.ready = False
+
+
+class ServiceSupervisor:
+    """
+    starts every replica of every service in parallel, waits for their readiness probes, and restarts crashed
+    workers with exponential backoff until stopped
+    """
+
+    def __init__(self, names=None):
+        self.workers = [
+            ServiceWorker(name, replica)
+            for name in (names or SERVICE_NAMES)
+            for replica in range(get_service_replicas(name))
+        ]
+        self.stopping = threading.Event()
+        self.monitor_thread: Optional[threading.Thread] = None
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.monitor_thread = threading.Thread(target=self._monitor, name='service-supervisor', daemon=True)
+        self.monitor_thread.start()
+
+    def wait_ready(self, timeout: float = SERVICE_READY_TIMEOUT) -> bool:
+        """
+        block until every service answers its readiness probe
+        """
+        deadline = time.monotonic() + timeout
+        while not self.stopping.is_set():
+            for worker in self.workers:
+                if worker.ready:
+                    continue
+                health = probe_service(worker.name, worker.replica)
+                if health is not None:
+                    worker.ready = True
+                    print(
+                        f'supervisor: {worker.label} ready after {time.monotonic() - worker.started_at:.1f}s, '
+                        f'load time {health["load_time"]:.1f}s'
+                    )
+            if all(worker.ready for worker in self.workers):
+                return True
+            if time.monotonic() > deadline:
+                pending = ', '.join(worker.label for worker in self.workers if not worker.ready)
+                print(f'supervisor: services not ready after {timeout:.0f}s: {pending}')
+                return False
+            time.sleep(0.2)
+        return False
+
+    def _monitor(self):
+        while not self.stopping.wait(0.5):
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    continue
+                if worker.restart_at is None:
+                    if now - worker.started_at > SERVICE_RESTART_STABLE_TIME:
+                        worker.backoff = SERVICE_RESTART_BACKOFF
+                    worker.restart_at = now + worker.backoff
+                    print(
+                        f'supervisor: {worker.label} exited with code {worker.process.exitcode}, '
+                        f'restarting in {worker.backoff:.1f}s'
+                    )
+                    worker.backoff = min(worker.backoff * 2, SERVICE_RESTART_BACKOFF_MAX)
+                elif now >= worker.restart_at:
+                    worker.restarts += 1
+                    worker.start()
+                    threading.Thread(target=self._wait_restarted, args=(worker,), daemon=True).start()
+
+    def _wait_restarted(self, worker: ServiceWorker):
+        process = worker.process
+        while not self.stopping.is_set() and process.is_alive():
+            health = probe_service(worker.name, worker.replica)
+            if health is not None:
+                worker.ready = True
+                print(f'supervisor: {worker.label} restarted, load time {health["load_time"]:.1f}s')
+                return
+            time.sleep(0.5)
+
+    def stop(self, timeout: float = 10):
+        self.stopping.set()
+        if self.monitor_thread:
+            self.monitor_thread.join()
+            self.monitor_thread = None
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+
+
 class services_running:
     def __init__(self):
-        self.processes = [
-            multiprocessing.Process(
-                target=run_service,
-                args=(name,)
-            )
-            for name in SERVICE_NAMES
-        ]
+        self.supervisor = ServiceSupervisor()
 
     def __enter__(self):
-        for process in self.processes:
-            process.start()
+        self.supervisor.start()
+        if not self.supervisor.wait_ready():
+            print('supervisor: starting without all services ready')
+        return self.supervisor
 
     def __exit__(self, *args, **kwargs):
-        for process in self.processes:
-            process.join()
+        self.supervisor.stop()
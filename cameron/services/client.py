@@ -1,36 +1,273 @@
 import asyncio
-from typing import Optional, Dict
+import contextlib
+import json
+import os
+from typing import AsyncIterator, Optional, Dict, Tuple
 
 import httpx
+import numpy as np
 import websockets
 from websockets import WebSocketClientProtocol
 
+from .balancer import SERVICE_BALANCER
 from .bootstrap import get_service_socket_path
+from .vectors import VECTORS_MEDIA_TYPE, decode_vectors
 
 
-async def invoke_service(name: str, path: str, **kwargs) -> Dict:
-    async with httpx.AsyncClient(
-            transport=httpx.AsyncHTTPTransport(
-                uds=get_service_socket_path(name),
-            ),
-            timeout=None,
-    ) as client:
-        res = await client.post(
-            'http://dummyhost' + path,
-            json=kwargs,
+SERVICE_POOL_MAX_CONNECTIONS = int(os.getenv('CAMERON_SERVICE_POOL_MAX_CONNECTIONS', '32'))
+SERVICE_POOL_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('CAMERON_SERVICE_POOL_MAX_KEEPALIVE_CONNECTIONS', '8'))
+SERVICE_POOL_KEEPALIVE_EXPIRY = float(os.getenv('CAMERON_SERVICE_POOL_KEEPALIVE_EXPIRY', '30'))
+SERVICE_DEFAULT_TIMEOUT = float(os.getenv('CAMERON_SERVICE_TIMEOUT', '60'))
+SERVICE_RETRIES = int(os.getenv('CAMERON_SERVICE_RETRIES', '3'))
+SERVICE_RETRY_BACKOFF = 0.1
+
+# errors raised before the request reached the service, always safe to retry on another replica
+SERVICE_RETRY_ERRORS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+)
+# raised by a kept-alive connection closed by the service, possibly after the request was received, only retried
+# for idempotent requests
+SERVICE_RETRY_IDEMPOTENT_ERRORS = (
+    httpx.RemoteProtocolError,
+)
+
+
+class ServicePoolStats:
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.retries = 0
+        self.failures = 0
+
+
+class ServicePool:
+    """
+    one keep-alive http client per service replica, shared by all calls for the lifetime of the app
+    """
+
+    def __init__(self):
+        self.clients: Dict[Tuple[str, int], httpx.AsyncClient] = {}
+        self.stats: Dict[str, ServicePoolStats] = {}
+
+    def client(self, name: str, replica: int = 0) -> httpx.AsyncClient:
+        if (name, replica) not in self.clients:
+            self.clients[(name, replica)] = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(
+                    uds=get_service_socket_path(name, replica),
+                    limits=httpx.Limits(
+                        max_connections=SERVICE_POOL_MAX_CONNECTIONS,
+                        max_keepalive_connections=SERVICE_POOL_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=SERVICE_POOL_KEEPALIVE_EXPIRY,
+                    ),
+                ),
+                timeout=SERVICE_DEFAULT_TIMEOUT,
+            )
+        return self.clients[(name, replica)]
+
+    @contextlib.asynccontextmanager
+    async def stream(
+            self,
+            name: str,
+            method: str,
+            path: str,
+            affinity: Optional[str] = None,
+            idempotent: bool = False,
+            **kwargs
+    ) -> AsyncIterator[httpx.Response]:
+        """
+        open a streaming request on the least busy replica, retrying with backoff on connection errors until the
+        response starts, a retry moves to another replica if there is one
+
+        :param affinity: requests with the same key stick to one replica
+        :param idempotent: the request may run twice, it is also retried when the connection drops after sending it
+        """
+        stats = self.stats.setdefault(name, ServicePoolStats())
+        stats.requests += 1
+        stats.in_flight += 1
+        replica = None
+        try:
+            for attempt in range(SERVICE_RETRIES + 1):
+                replica = SERVICE_BALANCER.acquire(name, affinity)
+                try:
+                    client = self.client(name, replica)
+                    request = client.build_request(method, 'http://dummyhost' + path, **kwargs)
+                    res = await client.send(request, stream=True)
+                    break
+                except SERVICE_RETRY_ERRORS + SERVICE_RETRY_IDEMPOTENT_ERRORS as e:
+                    retryable = idempotent or isinstance(e, SERVICE_RETRY_ERRORS)
+                    # a dropped kept-alive connection says nothing about the replica
+                    SERVICE_BALANCER.release(name, replica, failed=isinstance(e, SERVICE_RETRY_ERRORS))
+                    replica = None
+                    if not retryable or attempt == SERVICE_RETRIES:
+                        raise
+                    stats.retries += 1
+                    print(f'service {name}{path} failed: {e}, retrying')
+                    await asyncio.sleep(SERVICE_RETRY_BACKOFF * 2 ** attempt)
+            try:
+                yield res
+            finally:
+                await res.aclose()
+        except Exception:
+            stats.failures += 1
+            raise
+        finally:
+            if replica is not None:
+                SERVICE_BALANCER.release(name, replica)
+            stats.in_flight -= 1
+
+    async def request(
+            self,
+            name: str,
+            method: str,
+            path: str,
+            affinity: Optional[str] = None,
+            idempotent: bool = False,
+            **kwargs
+    ) -> httpx.Response:
+        async with self.stream(name, method, path, affinity=affinity, idempotent=idempotent, **kwargs) as res:
+            await res.aread()
+            return res
+
+    def pool_stats(self) -> Dict[str, Dict]:
+        result = {}
+        for name, stats in self.stats.items():
+            result[name] = dict(
+                requests=stats.requests,
+                in_flight=stats.in_flight,
+                retries=stats.retries,
+                failures=stats.failures,
+                max_connections=SERVICE_POOL_MAX_CONNECTIONS,
+                replicas=SERVICE_BALANCER.stats(name),
+            )
+        return result
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+
+_SERVICE_POOL: Optional[ServicePool] = None
+
+
+def open_service_pool() -> ServicePool:
+    """
+    create the shared service pool, called from the app lifespan
+    """
+    global _SERVICE_POOL
+    _SERVICE_POOL = ServicePool()
+    return _SERVICE_POOL
+
+
+async def close_service_pool():
+    global _SERVICE_POOL
+    if _SERVICE_POOL:
+        await _SERVICE_POOL.close()
+        _SERVICE_POOL = None
+
+
+def service_pool_stats() -> Dict[str, Dict]:
+    return _SERVICE_POOL.pool_stats() if _SERVICE_POOL else {}
+
+
+@contextlib.asynccontextmanager
+async def _service_pool() -> AsyncIterator[ServicePool]:
+    if _SERVICE_POOL:
+        yield _SERVICE_POOL
+        return
+    # outside of the app lifespan, e.g. in scripts
+    pool = ServicePool()
+    try:
+        yield pool
+    finally:
+        await pool.close()
+
+
+async def invoke_service(
+        name: str,
+        path: str,
+        timeout: Optional[float] = SERVICE_DEFAULT_TIMEOUT,
+        affinity: Optional[str] = None,
+        idempotent: bool = False,
+        **kwargs
+) -> Dict:
+    """
+    :param timeout: seconds for each of connect, read and write, None to wait forever
+    :param affinity: calls with the same key, e.g. a conversation, stick to one replica of the service
+    :param idempotent: the call may run twice, e.g. a search, it is also retried when the connection drops after
+        sending it
+    :param kwargs: json body
+    """
+    async with _service_pool() as pool:
+        res = await pool.request(
+            name, 'POST', path, affinity=affinity, idempotent=idempotent, json=kwargs, timeout=timeout,
         )
         return res.json()
 
 
-async def connect_service_websocket(name: str, path: str) -> WebSocketClientProtocol:
+async def invoke_service_vectors(
+        name: str,
+        path: str,
+        dtype: str = 'float32',
+        timeout: Optional[float] = SERVICE_DEFAULT_TIMEOUT,
+        affinity: Optional[str] = None,
+        idempotent: bool = False,
+        **kwargs
+) -> np.ndarray:
+    """
+    invoke a service route returning vectors, using the binary encoding instead of json float lists
+
+    :param dtype: 'float32' or 'float16'
+    :return: read-only array of shape (rows, dim), backed by the response body without copying
+    """
+    async with _service_pool() as pool:
+        res = await pool.request(
+            name,
+            'POST',
+            path,
+            affinity=affinity,
+            idempotent=idempotent,
+            json=kwargs,
+            headers={'Accept': f'{VECTORS_MEDIA_TYPE}; dtype={dtype}'},
+            timeout=timeout,
+        )
+        res.raise_for_status()
+        return decode_vectors(res.content)
+
+
+async def stream_service(
+        name: str,
+        path: str,
+        timeout: Optional[float] = SERVICE_DEFAULT_TIMEOUT,
+        affinity: Optional[str] = None,
+        idempotent: bool = False,
+        **kwargs
+) -> AsyncIterator[Dict]:
+    """
+    invoke a service route responding with newline delimited json, yielding each event as it arrives
+
+    :param timeout: seconds to wait for each chunk, not for the whole response
+    """
+    async with _service_pool() as pool:
+        async with pool.stream(
+                name, 'POST', path, affinity=affinity, idempotent=idempotent, json=kwargs, timeout=timeout,
+        ) as res:
+            async for line in res.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+
+async def connect_service_websocket(name: str, path: str, replica: int = 0) -> WebSocketClientProtocol:
     """
     :param name: service name
     :param path: service url path
+    :param replica: service replica
     :return:
     """
     if not path.startswith('/'):
         path = '/' + path
-    socket_path = get_service_socket_path(name)
+    socket_path = get_service_socket_path(name, replica)
     return await websockets.unix_connect(socket_path, 'ws://dummyhost' + path)
 
 
@@ -41,10 +278,24 @@ class ServiceWebSocketClientDelegate:
 
 
 class ServiceWebSocketClient:
-    def __init__(self, service_name: str, service_path: str, delegate: ServiceWebSocketClientDelegate):
+    """
+    a websocket to the least busy replica of a service, reconnected until closed
+
+    :param affinity: clients with the same key, e.g. a conversation, stick to one replica of the service
+    """
+
+    def __init__(
+            self,
+            service_name: str,
+            service_path: str,
+            delegate: ServiceWebSocketClientDelegate,
+            affinity: Optional[str] = None,
+    ):
         self.delegate = delegate
         self.service_name = service_name
         self.service_path = service_path
+        self.affinity = affinity
+        self.replica: Optional[int] = None
         self.websocket: Optional[WebSocketClientProtocol] = None
         self.websocket_task: Optional[asyncio.Task] = None
         asyncio.create_task(self._connect())
@@ -69,6 +320,7 @@ class ServiceWebSocketClient:
                 break
             if self.delegate:
                 await self.delegate.on_service_receive(self.service_name, self.service_path, data)
+        self._release()
         if self.delegate:
             print(
                 f'websocket closed {self.service_name}@{self.service_path}, reconnecting')
@@ -76,9 +328,30 @@ class ServiceWebSocketClient:
             await self._connect()
 
     async def _connect(self):
-        self.websocket = await connect_service_websocket(self.service_name, self.service_path)
+        while self.delegate:
+            replica = SERVICE_BALANCER.acquire(self.service_name, self.affinity)
+            try:
+                self.websocket = await connect_service_websocket(self.service_name, self.service_path, replica)
+                self.replica = replica
+                break
+            except Exception as e:
+                SERVICE_BALANCER.release(self.service_name, replica, failed=True)
+                print(
+                    f'websocket connect {self.service_name}@{self.service_path} failed: {e}, retrying')
+                await asyncio.sleep(3)
+        if not self.delegate:
+            # closed while connecting
+            if self.websocket:
+                await self.websocket.close()
+            self._release()
+            return
         self.websocket_task = asyncio.create_task(self._handle())
 
+    def _release(self):
+        if self.replica is not None:
+            SERVICE_BALANCER.release(self.service_name, self.replica)
+            self.replica = None
+
     async def close(self):
         self.delegate = None
 
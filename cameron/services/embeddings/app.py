@@ -1,55 +1,195 @@
 import asyncio
 import contextlib
-from typing import List
+import hashlib
+import os
+import re
+import time
+from typing import Dict, List
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 from starlette.routing import Route
 
-EMBEDDINGS_MODEL_NAME = "intfloat/multilingual-e5-large"
+from cameron.services.health import route_health
+from cameron.services.stubs import STUB_MODELS
+from cameron.services.vectors import VECTORS_MEDIA_TYPE, encode_vectors, negotiate_vectors_dtype
+from .batcher import MicroBatcher
+from .cache import EmbeddingsCache, EmbeddingsDiskCache, embeddings_cache_key
+from .index import VectorIndex
+
+# the stub keeps its vectors apart from the cached ones of the real model
+EMBEDDINGS_MODEL_NAME = 'stub' if STUB_MODELS else "intfloat/multilingual-e5-large"
 EMBEDDINGS_ENCODING_PREFIX = "query: "
 
+EMBEDDINGS_MAX_BATCH_SIZE = int(os.getenv('CAMERON_EMBEDDINGS_MAX_BATCH_SIZE', '64'))
+EMBEDDINGS_MAX_BATCH_WAIT = float(os.getenv('CAMERON_EMBEDDINGS_MAX_BATCH_WAIT', '0.005'))
+EMBEDDINGS_CACHE_SIZE = int(os.getenv('CAMERON_EMBEDDINGS_CACHE_SIZE', '65536'))
+# empty value disables the on-disk tier
+EMBEDDINGS_CACHE_DIR = os.getenv('CAMERON_EMBEDDINGS_CACHE_DIR', os.path.join('data', 'embeddings-cache'))
+EMBEDDINGS_INDEX_DIR = os.path.join('data', 'embeddings-index')
+EMBEDDINGS_INDEX_APPROXIMATE = os.getenv('CAMERON_EMBEDDINGS_INDEX_APPROXIMATE', '') == '1'
+EMBEDDINGS_INDEX_NLIST = int(os.getenv('CAMERON_EMBEDDINGS_INDEX_NLIST', '64'))
+EMBEDDINGS_INDEX_NPROBE = int(os.getenv('CAMERON_EMBEDDINGS_INDEX_NPROBE', '8'))
+
+EMBEDDINGS_INDEX_NAME_PATTERN = re.compile(r'^[a-zA-Z0-9_-]+$')
+
 
 class EmbeddingsService:
     def __init__(self):
-        self.lock = asyncio.Lock()
-        print(f'embeddings: loading sentence transformer')
-        self.model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+        if STUB_MODELS:
+            from cameron.services.stubs import StubSentenceTransformer
+
+            print(f'embeddings: using stub model')
+            self.model = StubSentenceTransformer()
+        else:
+            # torch and sentence transformers are only imported by the service process, on startup
+            from sentence_transformers import SentenceTransformer
+
+            print(f'embeddings: loading sentence transformer')
+            self.model = SentenceTransformer(EMBEDDINGS_MODEL_NAME)
+        self.batcher = MicroBatcher(
+            self._encode_batch,
+            max_batch_size=EMBEDDINGS_MAX_BATCH_SIZE,
+            max_wait=EMBEDDINGS_MAX_BATCH_WAIT,
+        )
+        disk = None
+        if EMBEDDINGS_CACHE_DIR:
+            disk = EmbeddingsDiskCache(
+                EMBEDDINGS_CACHE_DIR,
+                EMBEDDINGS_MODEL_NAME.replace('/', '--'),
+                self.model.get_sentence_embedding_dimension(),
+            )
+        self.cache = EmbeddingsCache(EMBEDDINGS_CACHE_SIZE, disk)
+        self.indexes: Dict[str, VectorIndex] = {}
         print(f'embeddings: ready')
 
-    async def encode(self, input_texts: List[str]) -> List[List[float]]:
-        async with self.lock:
-            output = self.model.encode([
-                EMBEDDINGS_ENCODING_PREFIX + input_text for input_text in input_texts
-            ], normalize_embeddings=True)
-            return [
-                t.tolist() for t in output
-            ]
+    def _encode_batch(self, input_texts: List[str]) -> np.ndarray:
+        return self.model.encode(
+            [EMBEDDINGS_ENCODING_PREFIX + input_text for input_text in input_texts],
+            batch_size=EMBEDDINGS_MAX_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+
+    async def encode(self, input_texts: List[str]) -> np.ndarray:
+        if not input_texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        keys = [
+            embeddings_cache_key(EMBEDDINGS_MODEL_NAME, EMBEDDINGS_ENCODING_PREFIX, input_text)
+            for input_text in input_texts
+        ]
+        vectors = self.cache.get_memory_many(keys)
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            found = await asyncio.to_thread(self.cache.get_disk_many, [keys[i] for i in missing])
+            for i, vector in zip(missing, found):
+                vectors[i] = vector
+            missing = [i for i in missing if vectors[i] is None]
+        if missing:
+            output = await self.batcher.submit([input_texts[i] for i in missing])
+            await asyncio.to_thread(self.cache.put_many, [keys[i] for i in missing], output)
+            for i, vector in zip(missing, output):
+                vectors[i] = vector
+
+        return np.stack(vectors)
+
+    def get_index(self, name: str) -> VectorIndex:
+        if not EMBEDDINGS_INDEX_NAME_PATTERN.match(name):
+            raise ValueError(f'invalid index name: {name}')
+        if name not in self.indexes:
+            self.indexes[name] = VectorIndex(
+                EMBEDDINGS_INDEX_DIR,
+                name,
+                self.model.get_sentence_embedding_dimension(),
+                approximate=EMBEDDINGS_INDEX_APPROXIMATE,
+                nlist=EMBEDDINGS_INDEX_NLIST,
+                nprobe=EMBEDDINGS_INDEX_NPROBE,
+            )
+        return self.indexes[name]
+
+    async def index_add(self, name: str, items: List[Dict]):
+        """
+        :param items: dicts with 'id', 'text' and an optional json 'payload'
+        """
+        index = self.get_index(name)
+        digests = [hashlib.sha256(item['text'].encode('utf-8')).hexdigest() for item in items]
+        items = [(item, digest) for item, digest in zip(items, digests) if not index.contains(str(item['id']), digest)]
+        if not items:
+            return
+        vectors = await self.encode([item['text'] for item, _ in items])
+        await asyncio.to_thread(
+            index.add,
+            [str(item['id']) for item, _ in items],
+            [digest for _, digest in items],
+            vectors,
+            [item.get('payload') for item, _ in items],
+        )
+
+    async def index_search(self, name: str, text: str, k: int) -> List[Dict]:
+        index = self.get_index(name)
+        vectors = await self.encode([text])
+        return await asyncio.to_thread(index.search, vectors[0], k)
 
-    def destroy(self):
+    async def destroy(self):
+        await self.batcher.stop()
         self.model = None
 
 
 async def route_invoke(req: Request):
-    text = (await req.json())['text']
-    output = await req.state.service.encode([text])
+    data = await req.json()
+    texts = data['texts'] if 'texts' in data else [data['text']]
+    output = await req.state.service.encode(texts)
+
+    dtype = negotiate_vectors_dtype(req.headers.get('accept'))
+    if dtype:
+        return Response(encode_vectors(output, dtype), media_type=VECTORS_MEDIA_TYPE)
+
+    if 'texts' in data:
+        return JSONResponse({
+            'vectors': output.tolist()
+        })
+    return JSONResponse({
+        'vector': output[0].tolist()
+    })
+
+
+async def route_index_add(req: Request):
+    data = await req.json()
+    await req.state.service.index_add(data['index'], data['items'])
+    return JSONResponse({})
+
+
+async def route_index_search(req: Request):
+    data = await req.json()
+    results = await req.state.service.index_search(data['index'], data['text'], int(data.get('k', 4)))
     return JSONResponse({
-        'vector': output[0]
+        'results': results
     })
 
 
+async def route_stats(req: Request):
+    return JSONResponse(req.state.service.cache.stats())
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app):
+    started_at = time.monotonic()
     service = EmbeddingsService()
-    yield dict(service=service)
-    service.destroy()
+    service.batcher.start()
+    yield dict(service=service, load_time=time.monotonic() - started_at)
+    await service.destroy()
 
 
 app = Starlette(
     routes=[
-        Route('/embeddings/encode', endpoint=route_invoke, methods=['POST'])
+        Route('/embeddings/health', endpoint=route_health, methods=['GET']),
+        Route('/embeddings/encode', endpoint=route_invoke, methods=['POST']),
+        Route('/embeddings/index/add', endpoint=route_index_add, methods=['POST']),
+        Route('/embeddings/index/search', endpoint=route_index_search, methods=['POST']),
+        Route('/embeddings/stats', endpoint=route_stats, methods=['GET']),
     ],
     lifespan=lifespan
 )
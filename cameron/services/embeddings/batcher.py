@@ -0,0 +1,88 @@
+import asyncio
+import concurrent.futures
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    coalesce concurrent ``submit`` calls into batches, collected for at most ``max_wait`` seconds or until
+    ``max_batch_size`` items are queued, and run ``fn`` on a worker thread
+    """
+
+    def __init__(
+            self,
+            fn: Callable[[List[str]], np.ndarray],
+            max_batch_size: int = 64,
+            max_wait: float = 0.005,
+    ):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: asyncio.Queue[Tuple[List[str], asyncio.Future]] = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='embeddings')
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, items: List[str]) -> np.ndarray:
+        """
+        :return: one output row per item
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((items, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[List[str], asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+
+        jobs = [await self.queue.get()]
+        count = len(jobs[0][0])
+        deadline = loop.time() + self.max_wait
+        while count < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                job = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            jobs.append(job)
+            count += len(job[0])
+
+        return [(items, future) for items, future in jobs if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = await self._collect()
+            if not jobs:
+                continue
+
+            batch = [item for items, _ in jobs for item in items]
+            try:
+                output = await loop.run_in_executor(self.executor, self.fn, batch)
+            except Exception as e:
+                print(f'embeddings: batch of {len(batch)} failed: {e}')
+                for _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for items, future in jobs:
+                if not future.done():
+                    future.set_result(output[offset:offset + len(items)])
+                offset += len(items)
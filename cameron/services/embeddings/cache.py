@@ -0,0 +1,146 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .storage import MappedMatrix
+
+
+def embeddings_cache_key(model_name: str, prefix: str, text: str) -> str:
+    return hashlib.sha256('\0'.join((model_name, prefix, text)).encode('utf-8')).hexdigest()
+
+
+# sha256 hex digest plus newline
+_KEY_LINE_BYTES = 65
+
+
+class EmbeddingsDiskCache:
+    """
+    vectors in a memory-mapped append-only matrix, with a sidecar file holding the key of every row,
+    its methods block on file io and are called off the event loop
+    """
+
+    def __init__(self, directory: str, name: str, dim: int):
+        os.makedirs(directory, exist_ok=True)
+        self.matrix = MappedMatrix(os.path.join(directory, name + '.f32'), dim)
+        self.keys_path = os.path.join(directory, name + '.keys')
+
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'r') as f:
+                keys = [line.strip() for line in f]
+        # an interrupted append may leave one file longer than the other
+        rows = min(len(self.matrix), len(keys))
+        self.matrix.truncate(rows)
+        with open(self.keys_path, 'ab') as f:
+            f.truncate(rows * _KEY_LINE_BYTES)
+
+        self.rows: Dict[str, int] = {key: i for i, key in enumerate(keys[:rows])}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        with self.lock:
+            rows = [self.rows.get(key) for key in keys]
+            if all(row is None for row in rows):
+                return [None] * len(keys)
+            view = self.matrix.view()
+            return [np.array(view[row]) if row is not None else None for row in rows]
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        with self.lock:
+            # first occurrence of every key not stored yet, a batch may repeat a text
+            missing: Dict[str, int] = {}
+            for i, key in enumerate(keys):
+                if key not in self.rows and key not in missing:
+                    missing[key] = i
+            if not missing:
+                return
+            # rows are numbered by the matrix, the keys file stays aligned with it
+            first_row = len(self.matrix)
+            try:
+                self.matrix.append(vectors[list(missing.values())])
+                with open(self.keys_path, 'a') as f:
+                    f.write(''.join(key + '\n' for key in missing))
+            except OSError:
+                self.matrix.truncate(first_row)
+                with open(self.keys_path, 'ab') as f:
+                    f.truncate(first_row * _KEY_LINE_BYTES)
+                raise
+            for row, key in enumerate(missing, first_row):
+                self.rows[key] = row
+
+
+class EmbeddingsCache:
+    """
+    content addressed embeddings cache, an in-memory LRU tier in front of an optional on-disk tier,
+    ``lock`` only guards the in-memory tier, the on-disk tier has a lock of its own
+    """
+
+    def __init__(self, capacity: int, disk: Optional[EmbeddingsDiskCache] = None):
+        self.capacity = capacity
+        self.disk = disk
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_memory_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        the in-memory tier only, without touching the disk, misses are counted by ``get_disk_many``
+        """
+        vectors = []
+        with self.lock:
+            for key in keys:
+                vector = self.memory.get(key)
+                if vector is not None:
+                    self.memory.move_to_end(key)
+                    self.memory_hits += 1
+                vectors.append(vector)
+        return vectors
+
+    def get_disk_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        the on-disk tier, for keys missed by ``get_memory_many``, blocks on file io
+        """
+        vectors = self.disk.get_many(keys) if self.disk is not None else [None] * len(keys)
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                if vector is None:
+                    self.misses += 1
+                    continue
+                self._remember(key, vector)
+                self.disk_hits += 1
+        return vectors
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        """
+        blocks on file io when there is an on-disk tier
+        """
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+        if self.disk is not None:
+            self.disk.put_many(keys, vectors)
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return dict(
+            memory_hits=self.memory_hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            memory_entries=len(self.memory),
+            disk_entries=len(self.disk) if self.disk is not None else 0,
+        )
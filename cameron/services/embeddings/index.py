@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .storage import MappedMatrix
+
+
+def _train_centroids(vectors: np.ndarray, nlist: int, iterations: int = 10) -> np.ndarray:
+    """
+    spherical k-means over normalized vectors
+    """
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(nlist):
+            members = vectors[assignments == i]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+    return centroids
+
+
+class VectorIndex:
+    """
+    inner product search over normalized vectors, persisted as a memory-mapped matrix plus a json-lines file of
+    ids and payloads
+
+    exact flat search by default, with ``approximate`` an IVF coarse quantizer is trained once ``nlist * 32``
+    vectors are indexed and only the ``nprobe`` closest lists are scanned
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            name: str,
+            dim: int,
+            approximate: bool = False,
+            nlist: int = 64,
+            nprobe: int = 8,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.matrix = MappedMatrix(os.path.join(directory, name + '.f32'), dim)
+        self.meta_path = os.path.join(directory, name + '.jsonl')
+        self.lock = threading.Lock()
+
+        entries, offsets = [], [0]
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'rb') as f:
+                for line in iter(f.readline, b''):
+                    if not line.endswith(b'\n'):
+                        break
+                    entries.append(json.loads(line))
+                    offsets.append(offsets[-1] + len(line))
+        # an interrupted append may leave one file longer than the other
+        rows = min(len(self.matrix), len(entries))
+        self.matrix.truncate(rows)
+        with open(self.meta_path, 'ab') as f:
+            f.truncate(offsets[rows])
+
+        self.entries: List[Dict[str, Any]] = entries[:rows]
+        self.latest: Dict[str, int] = {}
+        self.alive = np.zeros(rows, dtype=bool)
+        for row, entry in enumerate(self.entries):
+            self._point(entry['id'], row)
+
+        self.approximate = approximate
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.trained_rows = 0
+
+    def __len__(self):
+        return len(self.latest)
+
+    def _point(self, id_: str, row: int):
+        if id_ in self.latest:
+            self.alive[self.latest[id_]] = False
+        self.latest[id_] = row
+        self.alive[row] = True
+
+    def contains(self, id_: str, digest: str) -> bool:
+        row = self.latest.get(id_)
+        return row is not None and self.entries[row].get('digest') == digest
+
+    def add(self, ids: List[str], digests: List[str], vectors: np.ndarray, payloads: List[Any]):
+        """
+        insert or replace items, an id already indexed with the same digest is skipped
+        """
+        with self.lock:
+            keep = [i for i, (id_, digest) in enumerate(zip(ids, digests)) if not self.contains(id_, digest)]
+            if not keep:
+                return
+            vectors = np.ascontiguousarray(vectors[keep], dtype='<f4')
+            entries = [dict(id=ids[i], digest=digests[i], payload=payloads[i]) for i in keep]
+
+            self.matrix.append(vectors)
+            with open(self.meta_path, 'a') as f:
+                f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+
+            start = len(self.entries)
+            self.entries.extend(entries)
+            self.alive = np.concatenate([self.alive, np.zeros(len(entries), dtype=bool)])
+            for row, entry in enumerate(entries, start=start):
+                self._point(entry['id'], row)
+
+            if self.centroids is not None:
+                self.assignments = np.concatenate([
+                    self.assignments,
+                    np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32),
+                ])
+
+    def _train(self):
+        vectors = np.asarray(self.matrix.view())
+        rng = np.random.default_rng(0)
+        sample = np.flatnonzero(self.alive)
+        if len(sample) > self.nlist * 256:
+            sample = rng.choice(sample, self.nlist * 256, replace=False)
+        self.centroids = _train_centroids(vectors[sample], self.nlist)
+        self.assignments = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        self.trained_rows = len(vectors)
+
+    def search(self, query: np.ndarray, k: int) -> List[Dict[str, Any]]:
+        """
+        :return: up to ``k`` items ordered by descending score, each with 'id', 'score' and 'payload'
+        """
+        with self.lock:
+            if not self.latest:
+                return []
+            query = np.asarray(query, dtype='<f4').reshape(-1)
+            vectors = self.matrix.view()
+
+            if self.approximate and len(self.latest) >= self.nlist * 32:
+                # retrain once the index has doubled since the last training
+                if self.centroids is None or len(vectors) >= self.trained_rows * 2:
+                    self._train()
+                probes = np.argsort(-(self.centroids @ query))[:self.nprobe]
+                candidates = np.flatnonzero(np.isin(self.assignments, probes) & self.alive)
+                scores = vectors[candidates] @ query
+            else:
+                candidates = np.flatnonzero(self.alive)
+                scores = (vectors @ query)[candidates]
+
+            k = min(k, len(candidates))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                dict(
+                    id=self.entries[candidates[i]]['id'],
+                    score=float(scores[i]),
+                    payload=self.entries[candidates[i]]['payload'],
+                )
+                for i in top
+            ]
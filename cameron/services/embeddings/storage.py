@@ -0,0 +1,45 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+
+class MappedMatrix:
+    """
+    append-only float32 matrix stored as raw little-endian rows, read through a memory map
+    """
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.rows = 0
+        self.mapped: Optional[np.memmap] = None
+
+        if os.path.exists(path):
+            self.rows = os.path.getsize(path) // self.row_bytes
+        self.truncate(self.rows)
+
+    def __len__(self):
+        return self.rows
+
+    def truncate(self, rows: int):
+        with open(self.path, 'ab') as f:
+            f.truncate(rows * self.row_bytes)
+        self.rows = rows
+        self.mapped = None
+
+    def append(self, vectors: np.ndarray):
+        with open(self.path, 'ab') as f:
+            f.write(np.ascontiguousarray(vectors, dtype='<f4').tobytes())
+        self.rows += len(vectors)
+
+    def view(self) -> np.ndarray:
+        """
+        :return: read-only view over all rows, remapped after the file has grown
+        """
+        if self.rows == 0:
+            return np.zeros((0, self.dim), dtype='<f4')
+        if self.mapped is None or self.mapped.shape[0] != self.rows:
+            self.mapped = np.memmap(self.path, dtype='<f4', mode='r', shape=(self.rows, self.dim))
+        return self.mapped
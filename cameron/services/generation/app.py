@@ -1,58 +1,171 @@
-import asyncio
 import contextlib
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
-from typing import List
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 from starlette.routing import Route
-from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from cameron.services.health import route_health
+from cameron.services.stubs import STUB_MODELS
+from .chat import build_chat_prompt
 
 MODEL_NAME = "Qwen/Qwen-7B-Chat-Int4"
 
+GENERATION_MAX_BATCH_SIZE = int(os.getenv('CAMERON_GENERATION_MAX_BATCH_SIZE', '8'))
+GENERATION_PREFIX_CACHE_BYTES = int(os.getenv('CAMERON_GENERATION_PREFIX_CACHE_BYTES', str(2 * 1024 ** 3)))
+# most padding tokens a prompt is prefilled with to join a running batch of a longer kv cache
+GENERATION_MAX_PADDING = int(os.getenv('CAMERON_GENERATION_MAX_PADDING', '256'))
+
 
 class GenerationService:
     def __init__(self):
-        self.lock = asyncio.Lock()
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_NAME, trust_remote_code=True)
-
-        self.model = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME,
-            device_map="auto",
-            trust_remote_code=True
-        ).eval()
-
-    def generate(self, input_text: str, history=List[List[str]], **kwargs) -> str:
-        output_text, history = self.model.chat(
+        # torch and transformers are only imported by the service process, on startup
+        from .scheduler import GenerationScheduler
+
+        if STUB_MODELS:
+            from cameron.services.stubs import StubCausalLM, StubChatTokenizer
+
+            print('generation: using stub model')
+            self.tokenizer = StubChatTokenizer()
+            self.model = StubCausalLM()
+        else:
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                MODEL_NAME, trust_remote_code=True)
+
+            self.model = AutoModelForCausalLM.from_pretrained(
+                MODEL_NAME,
+                device_map="auto",
+                trust_remote_code=True
+            ).eval()
+
+        self.scheduler = GenerationScheduler(
+            self.model,
             self.tokenizer,
-            input_text,
-            history
+            max_batch_size=GENERATION_MAX_BATCH_SIZE,
+            prefix_cache_bytes=GENERATION_PREFIX_CACHE_BYTES,
+            max_padding=GENERATION_MAX_PADDING,
+        )
+        self.scheduler.start()
+
+    async def generate(
+            self,
+            input_text: str,
+            history: List[List[str]] = None,
+            max_new_tokens: int = 512,
+            trace_id: Optional[str] = None,
+            **kwargs
+    ) -> Tuple[str, List[List[str]]]:
+        history = history or []
+        prompt_ids = build_chat_prompt(self.tokenizer, input_text, history)
+        output_ids = await self.scheduler.submit(
+            prompt_ids,
+            max_new_tokens=max_new_tokens,
+            **kwargs
+        )
+        output_text = self.decode(output_ids)
+        return output_text, history + [[input_text, output_text]]
+
+    async def generate_stream(
+            self,
+            input_text: str,
+            history: List[List[str]] = None,
+            max_new_tokens: int = 512,
+            trace_id: Optional[str] = None,
+            **kwargs
+    ) -> AsyncIterator[Dict]:
+        """
+        yield ``{"delta": ...}`` events as tokens decode, followed by a final ``{"output_text": ..., "history": ...,
+        "timings": ...}`` with seconds spent in queue, prefill and decode
+
+        :param trace_id: logged with the timings
+        """
+        started_at = time.monotonic()
+        history = history or []
+        prompt_ids = build_chat_prompt(self.tokenizer, input_text, history)
+
+        output_ids = []
+        output_text = ''
+        timings = {}
+        async for token_id in self.scheduler.stream(
+                prompt_ids,
+                max_new_tokens=max_new_tokens,
+                timings=timings,
+                **kwargs
+        ):
+            output_ids.append(token_id)
+            text = self.decode(output_ids)
+            # hold back incomplete multibyte characters until the next token completes them
+            if text.endswith('\ufffd') or len(text) <= len(output_text):
+                continue
+            yield dict(delta=text[len(output_text):])
+            output_text = text
+
+        output_text = self.decode(output_ids)
+        timings['decode'] = time.monotonic() - started_at - timings.get('queue', 0) - timings.get('prefill', 0)
+        if trace_id:
+            print(
+                f'generation: trace {trace_id} queue {timings.get("queue", 0):.3f}s '
+                f'prefill {timings.get("prefill", 0):.3f}s ({timings.get("cached_tokens", 0)} cached tokens) '
+                f'decode {timings["decode"]:.3f}s ({len(output_ids)} tokens)'
+            )
+        yield dict(output_text=output_text, history=history + [[input_text, output_text]], timings=timings)
+
+    def decode(self, output_ids: List[int]) -> str:
+        return self.tokenizer.decode(
+            [i for i in output_ids if i not in self.scheduler.stop_ids],
+            errors='replace',
         )
-        return output_text, history
 
     def destroy(self):
+        self.scheduler.stop()
+        self.scheduler = None
         self.tokenizer = None
         self.model = None
 
 
 async def route_generate(req: Request):
     data = await req.json()
-    output_text, history = req.state.service.generate(**data)
+    output_text, history = await req.state.service.generate(**data)
     return JSONResponse(dict(output_text=output_text, history=history))
 
 
+async def route_stream(req: Request):
+    data = await req.json()
+
+    async def iterate_events():
+        async for event in req.state.service.generate_stream(**data):
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(iterate_events(), media_type='application/x-ndjson')
+
+
+async def route_stats(req: Request):
+    return JSONResponse(req.state.service.scheduler.stats())
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app):
+    started_at = time.monotonic()
     service = GenerationService()
-    yield dict(service=service)
+    yield dict(service=service, load_time=time.monotonic() - started_at)
     service.destroy()
 
 
 app = Starlette(
     routes=[
+        Route('/generation/health', endpoint=route_health, methods=['GET']),
         Route('/generation/generate',
-              endpoint=route_generate, methods=['POST'])
+              endpoint=route_generate, methods=['POST']),
+        Route('/generation/stream',
+              endpoint=route_stream, methods=['POST']),
+        Route('/generation/stats',
+              endpoint=route_stats, methods=['GET']),
     ],
     lifespan=lifespan
 )
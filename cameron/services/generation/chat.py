@@ -0,0 +1,45 @@
+from typing import List
+
+CHAT_SYSTEM_PROMPT = "You are a helpful assistant."
+CHAT_MAX_WINDOW_SIZE = 6144
+
+
+def build_chat_prompt(
+        tokenizer,
+        input_text: str,
+        history: List[List[str]],
+        system: str = CHAT_SYSTEM_PROMPT,
+        max_window_size: int = CHAT_MAX_WINDOW_SIZE,
+) -> List[int]:
+    """
+    build ChatML prompt tokens the same way Qwen ``make_context`` does
+
+    :param tokenizer: Qwen tokenizer
+    :param input_text: current user input
+    :param history: previous [user, assistant] turns
+    :param system: system prompt
+    :param max_window_size: oldest turns are dropped once the prompt exceeds this size
+    :return: prompt token ids
+    """
+    im_start = [tokenizer.im_start_id]
+    im_end = [tokenizer.im_end_id]
+    nl = tokenizer.encode('\n')
+
+    def encode_turn(role: str, content: str) -> List[int]:
+        return im_start + \
+            tokenizer.encode(role, allowed_special=set()) + nl + \
+            tokenizer.encode(content, allowed_special=set()) + \
+            im_end
+
+    system_tokens = encode_turn('system', system)
+
+    context_tokens = []
+    for turn_query, turn_response in reversed(history or []):
+        next_context_tokens = nl + encode_turn('user', turn_query) + nl + encode_turn('assistant', turn_response)
+        if len(system_tokens) + len(next_context_tokens) + len(context_tokens) >= max_window_size:
+            break
+        context_tokens = next_context_tokens + context_tokens
+
+    return system_tokens + context_tokens + \
+        nl + encode_turn('user', input_text) + \
+        nl + im_start + tokenizer.encode('assistant', allowed_special=set()) + nl
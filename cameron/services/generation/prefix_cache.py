@@ -0,0 +1,115 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+
+def hash_token_ids(token_ids: List[int]) -> str:
+    return hashlib.blake2b(
+        torch.tensor(token_ids, dtype=torch.int64).numpy().tobytes(),
+        digest_size=16,
+    ).hexdigest()
+
+
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    n = min(a.shape[0], b.shape[0])
+    mismatch = torch.nonzero(a[:n] != b[:n])
+    if mismatch.shape[0]:
+        return int(mismatch[0, 0])
+    return n
+
+
+class PrefixCacheEntry:
+    def __init__(self, token_ids: List[int], past_key_values: Tuple):
+        self.token_ids = torch.tensor(token_ids, dtype=torch.int64)
+        self.past_key_values = past_key_values
+        self.nbytes = sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+class PrefixCache:
+    """
+    past key values of previously processed token sequences, a new prompt reuses the longest shared prefix,
+    entries are evicted least recently used first once the memory budget is exceeded
+    """
+
+    def __init__(self, kv_seq_dim: int, max_bytes: int, max_entries: int = 64):
+        self.kv_seq_dim = kv_seq_dim
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, PrefixCacheEntry] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+        self.bytes_resident = 0
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[Tuple]]:
+        """
+        :return: number of cached leading tokens and their past key values, (0, None) on miss
+        """
+        query = torch.tensor(token_ids, dtype=torch.int64)
+
+        best_key, best_length = None, 0
+        for key, entry in self.entries.items():
+            length = common_prefix_length(entry.token_ids, query)
+            if length > best_length:
+                best_key, best_length = key, length
+
+        # at least one prompt token must be fed to the model to produce logits
+        best_length = min(best_length, len(token_ids) - 1)
+        if best_length <= 0:
+            self.misses += 1
+            return 0, None
+
+        self.entries.move_to_end(best_key)
+        self.hits += 1
+        self.hit_tokens += best_length
+
+        entry = self.entries[best_key]
+        return best_length, tuple(
+            tuple(t.narrow(self.kv_seq_dim, 0, best_length) for t in layer)
+            for layer in entry.past_key_values
+        )
+
+    def insert(self, token_ids: List[int], past_key_values: Tuple):
+        """
+        :param token_ids: tokens already processed by the model
+        :param past_key_values: their past key values, batch size 1, must not share storage with a running batch
+        """
+        entry = PrefixCacheEntry(token_ids, past_key_values)
+        if entry.nbytes > self.max_bytes:
+            return
+
+        # entries that are a prefix of the new one are fully covered by it
+        for key in [
+            key for key, existed in self.entries.items()
+            if existed.token_ids.shape[0] <= entry.token_ids.shape[0] and
+               common_prefix_length(existed.token_ids, entry.token_ids) == existed.token_ids.shape[0]
+        ]:
+            self._remove(key)
+
+        key = hash_token_ids(token_ids)
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.bytes_resident += entry.nbytes
+
+        while self.bytes_resident > self.max_bytes or len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.bytes_resident -= entry.nbytes
+
+    def stats(self) -> Dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_tokens=self.hit_tokens,
+            evictions=self.evictions,
+            entries=len(self.entries),
+            bytes_resident=self.bytes_resident,
+        )
@@ -0,0 +1,439 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import torch
+
+from .prefix_cache import PrefixCache
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    if t.shape[dim] == length:
+        return t
+    shape = list(t.shape)
+    shape[dim] = length - t.shape[dim]
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+
+class GenerationRequest:
+    """
+    :param timings: filled by the worker with seconds spent in ``queue`` and ``prefill``, and the ``cached_tokens``
+        of the prompt reused from the prefix cache
+    """
+
+    def __init__(
+            self,
+            prompt_ids: List[int],
+            loop: asyncio.AbstractEventLoop,
+            max_new_tokens: int = 512,
+            temperature: float = 1.0,
+            top_p: float = 0.8,
+            repetition_penalty: float = 1.1,
+            timings: Optional[Dict] = None,
+    ):
+        self.prompt_ids = prompt_ids
+        self.output_ids: List[int] = []
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+
+        self.loop = loop
+        self.future: asyncio.Future = loop.create_future()
+        self.future.add_done_callback(self._on_future_done)
+        self.cancelled = False
+        self.tokens: Optional[asyncio.Queue] = None
+        self.timings = timings if timings is not None else {}
+        self.submitted_at = time.monotonic()
+
+    def _on_future_done(self, future: asyncio.Future):
+        if future.cancelled():
+            self.cancelled = True
+
+    def push(self, token_id: int, stop_ids: set) -> bool:
+        """
+        record a sampled token
+
+        :return: True if the request is finished
+        """
+        self.output_ids.append(token_id)
+        if self.tokens is not None:
+            self.loop.call_soon_threadsafe(self.tokens.put_nowait, token_id)
+        return token_id in stop_ids or len(self.output_ids) >= self.max_new_tokens
+
+    def resolve(self):
+        def _resolve():
+            if not self.future.done():
+                self.future.set_result(self.output_ids)
+            if self.tokens is not None:
+                self.tokens.put_nowait(None)
+
+        self.loop.call_soon_threadsafe(_resolve)
+
+    def reject(self, e: Exception):
+        def _reject():
+            if not self.future.done():
+                self.future.set_exception(e)
+            if self.tokens is not None:
+                self.tokens.put_nowait(None)
+
+        self.loop.call_soon_threadsafe(_reject)
+
+
+class DecodeBatch:
+    """
+    running requests decoded together, every row is left padded to the longest kv cache
+    """
+
+    def __init__(
+            self,
+            requests: List[GenerationRequest],
+            next_ids: torch.Tensor,
+            attention_mask: torch.Tensor,
+            past_key_values: Tuple,
+            kv_seq_dim: int,
+    ):
+        self.requests = requests
+        self.next_ids = next_ids
+        self.attention_mask = attention_mask
+        self.past_key_values = past_key_values
+        self.kv_seq_dim = kv_seq_dim
+
+    def __len__(self):
+        return len(self.requests)
+
+    @property
+    def length(self) -> int:
+        """
+        columns of the kv cache, padding included
+        """
+        return self.attention_mask.shape[1]
+
+    def extend(self, other: 'DecodeBatch'):
+        length = max(self.attention_mask.shape[1], other.attention_mask.shape[1])
+        dim = self.kv_seq_dim
+
+        self.requests = self.requests + other.requests
+        self.next_ids = torch.cat([self.next_ids, other.next_ids], dim=0)
+        self.attention_mask = torch.cat([
+            _left_pad(self.attention_mask, length, 1),
+            _left_pad(other.attention_mask, length, 1),
+        ], dim=0)
+        self.past_key_values = tuple(
+            tuple(
+                torch.cat([_left_pad(a, length, dim), _left_pad(b, length, dim)], dim=0)
+                for a, b in zip(layer_a, layer_b)
+            )
+            for layer_a, layer_b in zip(self.past_key_values, other.past_key_values)
+        )
+
+    def row_offset(self, i: int) -> int:
+        """
+        leading padding columns of row ``i``
+        """
+        return self.attention_mask.shape[1] - int(self.attention_mask[i].sum().item())
+
+    def row_past_key_values(self, i: int) -> Tuple:
+        """
+        :return: a standalone copy of the past key values of row ``i`` without padding
+        """
+        offset = self.row_offset(i)
+        return tuple(
+            tuple(
+                t[i:i + 1].narrow(self.kv_seq_dim, offset, t.shape[self.kv_seq_dim] - offset).clone()
+                for t in layer
+            )
+            for layer in self.past_key_values
+        )
+
+    def filter(self, keep: List[int], trim: bool = True):
+        """
+        :param trim: drop leading columns that are padding for every remaining row
+        """
+        index = torch.tensor(keep, device=self.next_ids.device)
+        self.requests = [self.requests[i] for i in keep]
+        self.next_ids = self.next_ids.index_select(0, index)
+        attention_mask = self.attention_mask.index_select(0, index)
+
+        offset = 0
+        if trim:
+            offset = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum().item())
+        self.attention_mask = attention_mask[:, offset:]
+        self.past_key_values = tuple(
+            tuple(
+                t.index_select(0, index).narrow(self.kv_seq_dim, offset, t.shape[self.kv_seq_dim] - offset)
+                for t in layer
+            )
+            for layer in self.past_key_values
+        )
+
+
+class GenerationScheduler:
+    """
+    continuous batching scheduler, requests join and leave the running batches on every decode step,
+    all model calls happen on a single worker thread
+
+    models taking ``position_ids`` run a single batch with rows left padded to the longest kv cache, qwen derives
+    rotary positions from the kv cache length instead, so a row can only be padded when it is prefilled: a newcomer
+    is left padded up to the length of the batch it joins, keeping its positions consistent, and padding columns are
+    never dropped afterwards, a newcomer longer than every batch starts a batch of its own, batches decode in turn
+
+    :param max_padding: most padding columns a qwen newcomer is prefilled with to join a batch, this also bounds
+        the columns a long running batch keeps for rows that already left
+    """
+
+    def __init__(
+            self,
+            model,
+            tokenizer,
+            max_batch_size: int = 8,
+            prefix_cache_bytes: int = 0,
+            max_padding: int = 256,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_padding = max_padding
+
+        self.stop_ids = {
+            i for i in (
+                getattr(tokenizer, 'im_start_id', None),
+                getattr(tokenizer, 'im_end_id', None),
+                getattr(tokenizer, 'eod_id', None),
+                tokenizer.eos_token_id,
+            ) if i is not None
+        }
+        self.pad_id = next(
+            i for i in (
+                getattr(tokenizer, 'pad_token_id', None),
+                getattr(tokenizer, 'eod_id', None),
+                tokenizer.eos_token_id,
+                0,
+            ) if i is not None
+        )
+        is_qwen = getattr(model.config, 'model_type', None) == 'qwen'
+        self.kv_seq_dim = 1 if is_qwen else 2
+        # rows can be left padded after prefill, positions follow position_ids rather than the kv cache length
+        self.repad_rows = not is_qwen
+        self.prefix_cache: Optional[PrefixCache] = None
+        if prefix_cache_bytes > 0:
+            self.prefix_cache = PrefixCache(self.kv_seq_dim, max_bytes=prefix_cache_bytes)
+
+        self.pending: queue.SimpleQueue[Optional[GenerationRequest]] = queue.SimpleQueue()
+        self.batches: List[DecodeBatch] = []
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='generation-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.pending.put(None)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    async def submit(self, prompt_ids: List[int], **kwargs) -> List[int]:
+        """
+        enqueue a prompt and wait for the generated token ids
+        """
+        request = GenerationRequest(prompt_ids, asyncio.get_running_loop(), **kwargs)
+        self.pending.put(request)
+        return await request.future
+
+    async def stream(self, prompt_ids: List[int], **kwargs) -> AsyncIterator[int]:
+        """
+        enqueue a prompt and yield token ids as they are decoded, closing the iterator cancels the request
+        """
+        request = GenerationRequest(prompt_ids, asyncio.get_running_loop(), **kwargs)
+        request.tokens = asyncio.Queue()
+        self.pending.put(request)
+        try:
+            while True:
+                token_id = await request.tokens.get()
+                if token_id is None:
+                    # surface worker errors
+                    request.future.result()
+                    return
+                yield token_id
+        finally:
+            request.future.cancel()
+
+    def stats(self) -> dict:
+        return dict(
+            batch_size=self._running(),
+            batches=len(self.batches),
+            pending=self.pending.qsize(),
+            prefix_cache=self.prefix_cache.stats() if self.prefix_cache else None,
+        )
+
+    def _running(self) -> int:
+        return sum(len(batch) for batch in self.batches)
+
+    def _run(self):
+        with torch.inference_mode():
+            while self.running:
+                try:
+                    self._admit()
+                    for batch in list(self.batches):
+                        self._step(batch)
+                except Exception as e:
+                    print(f'generation: scheduler step failed: {e}')
+                    for batch in self.batches:
+                        for request in batch.requests:
+                            request.reject(e)
+                    self.batches = []
+
+    def _admit(self):
+        requests = []
+        while self._running() + len(requests) < self.max_batch_size:
+            try:
+                # block only when there is nothing to decode
+                request = self.pending.get(block=not self.batches and not requests)
+            except queue.Empty:
+                break
+            if request is None:
+                self.running = False
+                break
+            if request.cancelled:
+                continue
+            requests.append(request)
+
+        # longest prompts first, so the shorter ones arriving with them can join their batch
+        for request in sorted(requests, key=lambda r: len(r.prompt_ids), reverse=True):
+            running = self._find_batch(len(request.prompt_ids))
+            length = len(request.prompt_ids)
+            if running and not self.repad_rows:
+                length = running.length
+            try:
+                batch = self._prefill(request, length)
+            except Exception as e:
+                print(f'generation: prefill failed: {e}')
+                request.reject(e)
+                continue
+            if batch is None:
+                continue
+            if running:
+                running.extend(batch)
+            else:
+                self.batches.append(batch)
+
+    def _find_batch(self, length: int) -> Optional[DecodeBatch]:
+        """
+        :return: the running batch a prompt of ``length`` tokens joins, None to run it as a batch of its own
+        """
+        if self.repad_rows:
+            return self.batches[0] if self.batches else None
+        # a qwen row is padded up to the batch at prefill, it can only join a batch at least as long
+        candidates = [batch for batch in self.batches if 0 <= batch.length - length <= self.max_padding]
+        if not candidates:
+            return None
+        return max(candidates, key=len)
+
+    def _prefill(self, request: GenerationRequest, length: int) -> Optional[DecodeBatch]:
+        """
+        :param length: columns of the kv cache after prefill, the prompt is left padded up to it
+        """
+        started_at = time.monotonic()
+        request.timings['queue'] = started_at - request.submitted_at
+        padding = length - len(request.prompt_ids)
+        cached_length, past_key_values = 0, None
+        # cached past key values sit at the positions of an unpadded prompt
+        if self.prefix_cache and not padding:
+            cached_length, past_key_values = self.prefix_cache.lookup(request.prompt_ids)
+
+        device = self.model.device
+        input_ids = torch.tensor([[self.pad_id] * padding + request.prompt_ids[cached_length:]], device=device)
+        attention_mask = torch.tensor([[0] * padding + [1] * len(request.prompt_ids)], device=device)
+        positions = [0] * padding + list(range(cached_length, len(request.prompt_ids)))
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=torch.tensor([positions], device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        next_ids = self._sample(output.logits[:, -1, :], [request])
+        request.timings['prefill'] = time.monotonic() - started_at
+        request.timings['cached_tokens'] = cached_length
+        if request.push(int(next_ids[0]), self.stop_ids):
+            if self.prefix_cache and not padding:
+                self.prefix_cache.insert(request.prompt_ids, output.past_key_values)
+            request.resolve()
+            return None
+        return DecodeBatch(
+            requests=[request],
+            next_ids=next_ids.unsqueeze(-1),
+            attention_mask=attention_mask,
+            past_key_values=output.past_key_values,
+            kv_seq_dim=self.kv_seq_dim,
+        )
+
+    def _step(self, batch: DecodeBatch):
+        attention_mask = torch.cat([batch.attention_mask, batch.attention_mask.new_ones((len(batch), 1))], dim=1)
+        output = self.model(
+            input_ids=batch.next_ids,
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.long().cumsum(dim=-1) - 1)[:, -1:],
+            past_key_values=batch.past_key_values,
+            use_cache=True,
+        )
+        next_ids = self._sample(output.logits[:, -1, :], batch.requests)
+
+        batch.next_ids = next_ids.unsqueeze(-1)
+        batch.attention_mask = attention_mask
+        batch.past_key_values = output.past_key_values
+
+        keep = []
+        for i, request in enumerate(batch.requests):
+            if request.cancelled:
+                continue
+            if request.push(int(next_ids[i]), self.stop_ids):
+                # the past key values of a padded qwen row sit at shifted positions, they are not reusable
+                if self.prefix_cache and (self.repad_rows or not batch.row_offset(i)):
+                    # the last sampled token has not been fed to the model yet
+                    self.prefix_cache.insert(
+                        request.prompt_ids + request.output_ids[:-1],
+                        batch.row_past_key_values(i),
+                    )
+                request.resolve()
+                continue
+            keep.append(i)
+
+        if not keep:
+            self.batches.remove(batch)
+        elif len(keep) < len(batch):
+            batch.filter(keep, trim=self.repad_rows)
+
+    @staticmethod
+    def _sample(logits: torch.Tensor, requests: List[GenerationRequest]) -> torch.Tensor:
+        logits = logits.float()
+
+        for i, request in enumerate(requests):
+            if request.repetition_penalty == 1.0:
+                continue
+            seen = torch.tensor(
+                list(set(request.prompt_ids + request.output_ids)), device=logits.device,
+            )
+            score = logits[i].index_select(0, seen)
+            score = torch.where(score < 0, score * request.repetition_penalty, score / request.repetition_penalty)
+            logits[i].index_copy_(0, seen, score)
+
+        temperature = torch.tensor(
+            [max(request.temperature, 1e-5) for request in requests], device=logits.device,
+        ).unsqueeze(-1)
+        top_p = torch.tensor(
+            [request.top_p for request in requests], device=logits.device,
+        ).unsqueeze(-1)
+
+        probs = torch.softmax(logits / temperature, dim=-1)
+        sorted_probs, sorted_ids = torch.sort(probs, dim=-1, descending=True)
+        # keep the smallest set of tokens whose cumulative probability reaches top_p
+        sorted_probs[(sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p] = 0
+        choice = torch.multinomial(sorted_probs, num_samples=1)
+        return sorted_ids.gather(-1, choice).squeeze(-1)
@@ -0,0 +1,9 @@
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+
+async def route_health(req: Request):
+    """
+    readiness probe, only served once the lifespan finished loading the service
+    """
+    return JSONResponse(dict(status='ok', load_time=req.state.load_time))
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import time
+from typing import Iterator, List
+
+import numpy as np
+
+# tiny stand-ins for the generation, synthesize and embeddings models, to benchmark the services without weights
+# or a gpu, torch is imported by the stubs that need it, when they are created
+STUB_MODELS = os.getenv('CAMERON_STUB_MODELS', '') == '1'
+# seconds of compute simulated per second of synthesized audio
+STUB_SYNTHESIZE_REAL_TIME_FACTOR = float(os.getenv('CAMERON_STUB_SYNTHESIZE_REAL_TIME_FACTOR', '0.1'))
+# seconds of every forward call of the stub lm, whatever the batch size, like reading the weights on a gpu
+STUB_GENERATION_STEP_SECONDS = float(os.getenv('CAMERON_STUB_GENERATION_STEP_SECONDS', '0.005'))
+
+STUB_GENERATION_REPLY = 'Sure, this is a stub reply for benchmarking. It has a few clauses, ' \
+                        'so the synthesizer receives them one by one. '
+
+
+class StubChatTokenizer:
+    """
+    byte level tokenizer with the special tokens of qwen
+    """
+    im_start_id = 256
+    im_end_id = 257
+    eod_id = 258
+    eos_token_id = 258
+    vocab_size = 259
+
+    def encode(self, text: str, allowed_special=None) -> List[int]:
+        return list(text.encode('utf-8'))
+
+    def decode(self, token_ids: List[int], errors: str = 'strict') -> str:
+        return bytes(i for i in token_ids if i < 256).decode('utf-8', errors=errors)
+
+
+class StubModelOutput:
+    def __init__(self, logits, past_key_values):
+        self.logits = logits
+        self.past_key_values = past_key_values
+
+
+class StubModelConfig:
+    model_type = 'qwen'
+
+
+class StubCausalLM:
+    """
+    a causal lm with the call signature of the qwen remote code, keeping a kv cache of ``layers`` layers, that
+    recites ``STUB_GENERATION_REPLY`` by position
+
+    like qwen, positions are derived from the length of the kv cache, ``position_ids`` is ignored, and every key
+    records the position it was computed at, the way rotary embeddings are baked into cached keys, the reply is
+    recited by the distance to the first key a row attends to, so left padding at prefill is harmless, while a row
+    padded or trimmed afterwards recites the wrong characters
+
+    :param hidden_size: width of the matmuls run per layer and token, the cost of a step
+    :param step_seconds: slept on every call, the cost of a step shared by the rows of a batch
+    """
+
+    def __init__(
+            self,
+            layers: int = 4,
+            heads: int = 4,
+            hidden_size: int = 256,
+            step_seconds: float = STUB_GENERATION_STEP_SECONDS,
+    ):
+        import torch
+
+        self.step_seconds = step_seconds
+        self.layers = layers
+        self.heads = heads
+        self.hidden_size = hidden_size
+        self.config = StubModelConfig()
+        self.device = torch.device('cpu')
+        generator = torch.Generator().manual_seed(0)
+        self.embeddings = torch.randn(StubChatTokenizer.vocab_size, hidden_size, generator=generator)
+        self.weights = [torch.randn(hidden_size, hidden_size, generator=generator) / hidden_size ** 0.5
+                        for _ in range(layers)]
+        self.reply = torch.tensor(list(STUB_GENERATION_REPLY.encode('utf-8')), dtype=torch.int64)
+
+    def eval(self) -> 'StubCausalLM':
+        return self
+
+    def __call__(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, use_cache=True):
+        import torch
+
+        time.sleep(self.step_seconds)
+        batch_size, length = input_ids.shape
+        past_length = past_key_values[0][0].shape[1] if past_key_values is not None else 0
+        positions = torch.arange(past_length, past_length + length).unsqueeze(0).expand(batch_size, -1)
+        hidden = self.embeddings[input_ids]
+        presents = []
+        for i, weight in enumerate(self.weights):
+            hidden = torch.tanh(hidden @ weight)
+            # keys and values of shape (batch, sequence, heads, head size), as qwen lays them out
+            kv = hidden.view(batch_size, length, self.heads, self.hidden_size // self.heads).clone()
+            kv[:, :, 0, 0] = positions
+            if past_key_values is not None:
+                past_key, past_value = past_key_values[i]
+                presents.append((torch.cat([past_key, kv], dim=1), torch.cat([past_value, kv], dim=1)))
+            else:
+                presents.append((kv, kv.clone()))
+
+        if attention_mask is None:
+            attention_mask = torch.ones(batch_size, past_length + length, dtype=torch.int64)
+        keys = presents[0][0]
+        first = attention_mask.long().argmax(dim=1)
+        first_positions = keys[torch.arange(batch_size), first, 0, 0].long().unsqueeze(-1)
+        logits = torch.zeros(batch_size, length, StubChatTokenizer.vocab_size)
+        next_ids = self.reply[(positions - first_positions + 1) % len(self.reply)]
+        logits.scatter_(-1, next_ids.unsqueeze(-1), 30.0)
+        return StubModelOutput(logits, tuple(presents))
+
+
+class StubXtts:
+    """
+    streams a sine wave ``seconds_per_character`` long per character of the text, sleeping the
+    ``real_time_factor`` share of every chunk to simulate inference
+    """
+
+    def __init__(
+            self,
+            sample_rate: int = 24000,
+            seconds_per_character: float = 0.15,
+            chunk_seconds: float = 0.2,
+            real_time_factor: float = STUB_SYNTHESIZE_REAL_TIME_FACTOR,
+    ):
+        import torch
+
+        self.device = torch.device('cpu')
+        self.sample_rate = sample_rate
+        self.seconds_per_character = seconds_per_character
+        self.chunk_seconds = chunk_seconds
+        self.real_time_factor = real_time_factor
+
+    def get_conditioning_latents(self, audio_path: List[str]):
+        import torch
+
+        return torch.zeros(1, 32, 1024), torch.zeros(1, 512, 1)
+
+    def inference_stream(self, text: str, language: str, gpt_cond_latent, speaker_embedding, **kwargs) -> Iterator:
+        import torch
+
+        total = int(len(text) * self.seconds_per_character * self.sample_rate)
+        chunk = int(self.chunk_seconds * self.sample_rate)
+        for offset in range(0, total, chunk):
+            n = min(chunk, total - offset)
+            time.sleep(n / self.sample_rate * self.real_time_factor)
+            t = torch.arange(offset, offset + n, dtype=torch.float32) / self.sample_rate
+            yield 0.3 * torch.sin(2 * torch.pi * 220 * t)
+
+
+class StubSentenceTransformer:
+    """
+    deterministic unit vectors derived from the text hash, followed by a matmul of the size of a small encoder layer
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+        self.projection = np.random.default_rng(0).standard_normal((dim, dim)).astype(np.float32) / dim ** 0.5
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts: List[str], normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        vectors = np.stack([
+            np.random.default_rng(int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little'))
+            .standard_normal(self.dim).astype(np.float32)
+            for text in texts
+        ]) @ self.projection
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
@@ -1,29 +1,91 @@
 import asyncio
 import contextlib
-import io
+import json
 import os
+import time
 from pathlib import Path
-from typing import AsyncIterable
-
-import torch
-import torchaudio
-from TTS.api import TTS
-from TTS.tts.configs.xtts_config import XttsConfig
-from TTS.tts.models.xtts import Xtts
-from TTS.utils.manage import ModelManager
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple, Union
+
 from starlette.applications import Starlette
 from starlette.endpoints import WebSocketEndpoint
-from starlette.routing import WebSocketRoute
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.types import Scope, Receive, Send
 from starlette.websockets import WebSocket
-from torch import Tensor
 
-TTS_MODEL_NAME = "tts_models/multilingual/multi-dataset/xtts_v2"
+from cameron.services.health import route_health
+from cameron.services.stubs import STUB_MODELS
+from .audio import AUDIO_FORMATS, AudioEncoder, create_audio_encoder
+from .cache import SynthesizeCache, SynthesizeRecording, SynthesizeReplay, synthesize_cache_key
+from .voices import VOICE_DEFAULT, VoiceRegistry
+from .worker import SynthesizeJob, SynthesizeWorker
+
+if TYPE_CHECKING:
+    from torch import Tensor
+
+# the stub keeps its latents and recordings apart from the cached ones of the real model
+TTS_MODEL_NAME = 'stub' if STUB_MODELS else "tts_models/multilingual/multi-dataset/xtts_v2"
 TTS_MODEL_SAMPLE_RATE = 24000
+TTS_LANGUAGE = "zh"
+
+SYNTHESIZE_MAX_PENDING_CHUNKS = int(os.getenv('CAMERON_SYNTHESIZE_MAX_PENDING_CHUNKS', '4'))
+SYNTHESIZE_VOICES_DIR = os.getenv('CAMERON_SYNTHESIZE_VOICES_DIR', os.path.join('data', 'voices'))
+SYNTHESIZE_VOICES_CACHE_DIR = os.getenv(
+    'CAMERON_SYNTHESIZE_VOICES_CACHE_DIR',
+    os.path.join('data', 'voices-cache'),
+)
+SYNTHESIZE_CACHE_BYTES = int(os.getenv('CAMERON_SYNTHESIZE_CACHE_BYTES', str(64 * 1024 * 1024)))
+SYNTHESIZE_CACHE_DIR = os.getenv('CAMERON_SYNTHESIZE_CACHE_DIR', os.path.join('data', 'synthesize-cache'))
+SYNTHESIZE_CACHE_DISK_BYTES = int(os.getenv('CAMERON_SYNTHESIZE_CACHE_DISK_BYTES', str(1024 * 1024 * 1024)))
+# only short phrases are likely to repeat
+SYNTHESIZE_CACHE_MAX_PHRASE_LENGTH = int(os.getenv('CAMERON_SYNTHESIZE_CACHE_MAX_PHRASE_LENGTH', '32'))
+SYNTHESIZE_WARMUP_FILE = os.getenv('CAMERON_SYNTHESIZE_WARMUP_FILE', os.path.join('data', 'synthesize-warmup.txt'))
 
 
 class SynthesizeService:
     def __init__(self):
-        self.lock = asyncio.Lock()
+        if STUB_MODELS:
+            from cameron.services.stubs import StubXtts
+
+            print("synthesize: using stub model")
+            model = StubXtts(sample_rate=TTS_MODEL_SAMPLE_RATE)
+        else:
+            model = self._load_model()
+        self.model = model
+
+        self.voices = VoiceRegistry(
+            self._compute_latents,
+            model_name=TTS_MODEL_NAME,
+            default_path=str(Path("data") / 'tts_ref.wav'),
+            directory=SYNTHESIZE_VOICES_DIR,
+            cache_dir=SYNTHESIZE_VOICES_CACHE_DIR,
+            device=str(model.device),
+        )
+        if self.voices.exists(VOICE_DEFAULT):
+            print("synthesize: loading speaker reference")
+            self.voices.get(VOICE_DEFAULT)
+
+        self.cache = SynthesizeCache(
+            SYNTHESIZE_CACHE_BYTES,
+            directory=SYNTHESIZE_CACHE_DIR or None,
+            max_disk_bytes=SYNTHESIZE_CACHE_DISK_BYTES,
+        ) if SYNTHESIZE_CACHE_BYTES > 0 else None
+        if self.cache and self.voices.exists(VOICE_DEFAULT):
+            self.warm_up(SYNTHESIZE_WARMUP_FILE)
+
+        self.worker = SynthesizeWorker(self._inference, max_pending=SYNTHESIZE_MAX_PENDING_CHUNKS)
+        self.worker.start()
+        print('synthesize: ready')
+
+    @staticmethod
+    def _load_model():
+        # the tts stack is only imported by the service process, on startup
+        import torch
+        from TTS.api import TTS
+        from TTS.tts.configs.xtts_config import XttsConfig
+        from TTS.tts.models.xtts import Xtts
+        from TTS.utils.manage import ModelManager
 
         def no_check(*args, **kwargs):
             pass
@@ -40,69 +102,283 @@ class SynthesizeService:
         model.load_checkpoint(config, checkpoint_dir=model_path)
         if torch.cuda.is_available():
             model.cuda()
-        self.model = model
-
-        print("synthesize: loading speaker reference")
-        self.gpt_cond_latent, self.speaker_embedding = model.get_conditioning_latents(
-            audio_path=[str(Path("data") / 'tts_ref.wav')]
-        )
-        print('synthesize: ready')
+        return model
 
     def destroy(self):
+        self.worker.stop()
+        self.worker = None
         self.model = None
-        self.gpt_cond_latent = None
-        self.speaker_embedding = None
+        self.voices = None
+        self.cache = None
+
+    def _compute_latents(self, path: str):
+        return self.model.get_conditioning_latents(audio_path=[path])
 
-    # noinspection PyUnresolvedReferences
     @staticmethod
-    def encode_wav(data: Tensor, *args, **kwargs) -> bytes:
-        buf = io.BytesIO()
-        torchaudio.save(buf, data, *args, **kwargs)
-        buf.seek(0)
-        return buf.read()
-
-    async def inference_stream(self, text: str, **kwargs) -> AsyncIterable[bytes]:
-        async with self.lock:
-            chunks = self.model.inference_stream(
-                text,
-                "zh",
-                self.gpt_cond_latent,
-                self.speaker_embedding,
-                **kwargs
-            )
+    def encode_pcm(data: 'Tensor') -> bytes:
+        """
+        convert a float waveform to signed 16-bit little-endian pcm without an intermediate container
+        """
+        return (data.squeeze().clamp(-1, 1) * 32767).short().cpu().numpy().tobytes()
+
+    def _cache_key(self, text: str, voice: str, params: Dict) -> Optional[str]:
+        if not self.cache or len(text) > SYNTHESIZE_CACHE_MAX_PHRASE_LENGTH:
+            return None
+        voice_digest = self.voices.digest(voice)
+        if not voice_digest:
+            return None
+        return synthesize_cache_key(text, voice_digest, TTS_LANGUAGE, params)
+
+    def _synthesize(self, text: str, voice: str, params: Dict) -> Iterator[bytes]:
+        """
+        blocking, the produced chunks are recorded in the cache unless the iteration is stopped early
+
+        :return: signed 16-bit little-endian pcm chunks
+        """
+        gpt_cond_latent, speaker_embedding = self.voices.get(voice)
+        cache_key = self._cache_key(text, voice, params)
+        recording = SynthesizeRecording()
+        chunks = self.model.inference_stream(
+            text,
+            TTS_LANGUAGE,
+            gpt_cond_latent,
+            speaker_embedding,
+            **params
+        )
+        try:
             for chunk in chunks:
-                data = self.encode_wav(
-                    chunk.squeeze().unsqueeze(0).cpu(),
-                    sample_rate=TTS_MODEL_SAMPLE_RATE,
-                    format='wav'
-                )
-                yield data
+                pcm = self.encode_pcm(chunk)
+                recording.add(pcm)
+                yield pcm
+        finally:
+            chunks.close()
+        if cache_key:
+            self.cache.put(cache_key, recording)
+
+    def _inference(self, job: SynthesizeJob) -> Iterator[bytes]:
+        """
+        runs on the worker thread
+        """
+        params = dict(job.kwargs)
+        voice = params.pop('voice', VOICE_DEFAULT)
+        return self._synthesize(job.text, voice, params)
+
+    def warm_up(self, path: str):
+        """
+        synthesize every phrase listed in ``path``, one per line, with the default voice, unless already cached
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            phrases = [line.strip() for line in f if line.strip()]
+
+        synthesized = 0
+        for phrase in phrases:
+            cache_key = self._cache_key(phrase, VOICE_DEFAULT, {})
+            if not cache_key:
+                print(f'synthesize: warm-up phrase too long to be cached: {phrase}')
+                continue
+            if self.cache.get(cache_key):
+                continue
+            for _ in self._synthesize(phrase, VOICE_DEFAULT, {}):
+                pass
+            synthesized += 1
+        print(f'synthesize: warmed up {len(phrases)} phrases, {synthesized} synthesized')
+
+    async def submit(
+            self,
+            text: str,
+            voice: str = VOICE_DEFAULT,
+            **kwargs
+    ) -> Union[SynthesizeJob, SynthesizeReplay]:
+        """
+        queue an utterance for synthesis, iterate the returned job to receive its pcm chunks, a cached phrase is
+        replayed without going through the worker, a recording on disk is read on a thread
+
+        :param voice: name of a registered voice, latents of a voice not used before are loaded by the worker
+        """
+        cache_key = self._cache_key(text, voice, kwargs)
+        if cache_key:
+            recording = self.cache.get_memory(cache_key)
+            if recording is None:
+                recording = await asyncio.to_thread(self.cache.get, cache_key)
+            if recording:
+                return SynthesizeReplay(recording)
+        return self.worker.submit(text, voice=voice, **kwargs)
+
+    def stats(self) -> Dict:
+        return dict(cache=self.cache.stats() if self.cache else None)
+
+
+def parse_synthesize_message(data: str) -> Dict:
+    """
+    a message is either plain text, or a json object with 'text', 'voice', 'trace_id' and/or 'cancel'
+    """
+    if data.startswith('{'):
+        try:
+            message = json.loads(data)
+            if isinstance(message, dict):
+                return message
+        except json.JSONDecodeError:
+            pass
+    return dict(text=data)
 
 
 class SynthesizeEndpoint(WebSocketEndpoint):
+    """
+    output format is negotiated with the ``format`` query parameter, one of 'wav' (default, every chunk is a
+    standalone wav file), 'pcm' and 'opus' (a json stream header is sent first, followed by raw frames)
+
+    utterances are queued and streamed in order, ``{"cancel": true}`` drops the current and queued ones
+
+    the voice is selected per message with ``{"text": ..., "voice": ...}``, defaulting to the ``voice`` query
+    parameter of the connection
+
+    with the ``events=1`` query parameter, every utterance is framed by json text messages, ``{"type": "start",
+    "trace_id": ..., "cached": ...}`` before its first chunk and ``{"type": "end", "trace_id": ..., "queue": ...,
+    "first_chunk": ..., "duration": ...}`` in seconds after its last one, the trace id is taken from the message
+    """
     encoding = 'text'
 
+    def __init__(self, scope: Scope, receive: Receive, send: Send):
+        super().__init__(scope, receive, send)
+        self.websocket: Optional[WebSocket] = None
+        self.encoder: Optional[AudioEncoder] = None
+        self.voice = VOICE_DEFAULT
+        self.events = False
+        # job, trace id, and when it was queued
+        self.jobs: List[Tuple[Union[SynthesizeJob, SynthesizeReplay], Optional[str], float]] = []
+        self.jobs_event = asyncio.Event()
+        self.sender_task: Optional[asyncio.Task] = None
+
+    async def on_connect(self, websocket: WebSocket) -> None:
+        audio_format = websocket.query_params.get('format', 'wav')
+        if audio_format not in AUDIO_FORMATS:
+            await websocket.close(code=1003, reason=f'unsupported format: {audio_format}')
+            return
+        try:
+            self.encoder = create_audio_encoder(audio_format, TTS_MODEL_SAMPLE_RATE)
+        except ValueError as e:
+            await websocket.close(code=1003, reason=str(e))
+            return
+
+        self.voice = websocket.query_params.get('voice', VOICE_DEFAULT)
+        if not websocket.state.service.voices.exists(self.voice):
+            await websocket.close(code=1003, reason=f'unknown voice: {self.voice}')
+            return
+
+        await super().on_connect(websocket)
+        self.websocket = websocket
+        self.events = websocket.query_params.get('events') == '1'
+
+        header = self.encoder.header()
+        if header:
+            await websocket.send_text(header)
+
+        self.sender_task = asyncio.create_task(self._send_loop())
+
     async def on_receive(self, websocket: WebSocket, data: str) -> None:
         await super().on_receive(websocket, data)
 
-        async for wav_data in websocket.state.service.inference_stream(data):
+        message = parse_synthesize_message(data)
+        if message.get('cancel'):
+            self._cancel_jobs()
+        if message.get('text'):
+            service: SynthesizeService = websocket.state.service
+            voice = message.get('voice') or self.voice
+            if not service.voices.exists(voice):
+                print(f'synthesize: unknown voice {voice}, using {self.voice}')
+                voice = self.voice
+            job = await service.submit(message['text'], voice=voice)
+            self.jobs.append((job, message.get('trace_id'), time.monotonic()))
+            self.jobs_event.set()
+
+    def _cancel_jobs(self):
+        for job, _, _ in self.jobs:
+            job.cancel()
+        self.jobs = []
+        if self.sender_task:
+            # restart streaming, dropping any partially encoded audio
+            self.sender_task.cancel()
+            self.sender_task = asyncio.create_task(self._send_loop())
+
+    async def _send_loop(self):
+        self.encoder.flush()
+        while True:
+            while not self.jobs:
+                self.jobs_event.clear()
+                await self.jobs_event.wait()
+            job, trace_id, queued_at = self.jobs[0]
+            started_at = time.monotonic()
+            first_chunk_at = None
+            cached = isinstance(job, SynthesizeReplay)
+            if self.events:
+                await self.websocket.send_text(json.dumps(dict(type='start', trace_id=trace_id, cached=cached)))
             try:
-                await websocket.send_bytes(wav_data)
+                async for pcm in job:
+                    if first_chunk_at is None:
+                        first_chunk_at = time.monotonic()
+                    await self.websocket.send_bytes(self.encoder.encode(pcm))
+                tail = self.encoder.flush()
+                if tail:
+                    await self.websocket.send_bytes(tail)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                print("synthesize: websocket closed", e)
-                break
+                print("synthesize: streaming failed", e)
+            finished_at = time.monotonic()
+            if trace_id:
+                print(
+                    f'synthesize: trace {trace_id} queue {started_at - queued_at:.3f}s '
+                    f'first chunk {(first_chunk_at or finished_at) - started_at:.3f}s '
+                    f'duration {finished_at - started_at:.3f}s{" cached" if cached else ""}'
+                )
+            if self.events:
+                await self.websocket.send_text(json.dumps(dict(
+                    type='end',
+                    trace_id=trace_id,
+                    queue=started_at - queued_at,
+                    first_chunk=(first_chunk_at or finished_at) - started_at,
+                    duration=finished_at - started_at,
+                )))
+            if self.jobs and self.jobs[0][0] is job:
+                self.jobs.pop(0)
+
+    async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
+        for job, _, _ in self.jobs:
+            job.cancel()
+        self.jobs = []
+        if self.sender_task:
+            self.sender_task.cancel()
+            self.sender_task = None
+        self.websocket = None
+        await super().on_disconnect(websocket, close_code)
+
+
+async def route_voices(request: Request):
+    service: SynthesizeService = request.state.service
+    return JSONResponse(dict(voices=service.voices.names()))
+
+
+async def route_stats(request: Request):
+    service: SynthesizeService = request.state.service
+    return JSONResponse(service.stats())
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app):
+    started_at = time.monotonic()
     service = SynthesizeService()
-    yield dict(service=service)
+    yield dict(service=service, load_time=time.monotonic() - started_at)
     service.destroy()
 
 
 app = Starlette(
     routes=[
-        WebSocketRoute('/synthesize/ws', endpoint=SynthesizeEndpoint)
+        Route('/synthesize/health', endpoint=route_health, methods=['GET']),
+        Route('/synthesize/voices', endpoint=route_voices),
+        Route('/synthesize/stats', endpoint=route_stats),
+        WebSocketRoute('/synthesize/ws', endpoint=SynthesizeEndpoint),
     ],
     lifespan=lifespan
 )
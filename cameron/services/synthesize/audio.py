@@ -0,0 +1,129 @@
+import json
+import struct
+from typing import List, Optional
+
+try:
+    import opuslib
+except ImportError:
+    opuslib = None
+
+AUDIO_FORMATS = ('wav', 'pcm', 'opus')
+
+OPUS_FRAME_DURATION = 0.02
+
+
+def encode_wav(pcm: bytes, sample_rate: int, channels: int = 1) -> bytes:
+    """
+    wrap signed 16-bit little-endian pcm in a wav container
+    """
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + len(pcm), b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+        b'data', len(pcm),
+    ) + pcm
+
+
+class AudioEncoder:
+    """
+    turn a stream of signed 16-bit little-endian pcm chunks into websocket messages
+    """
+
+    def __init__(self, sample_rate: int, channels: int = 1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    def header(self) -> Optional[str]:
+        """
+        :return: json text message sent once before the first chunk, None for self-describing formats
+        """
+        return None
+
+    def encode(self, pcm: bytes) -> bytes:
+        raise NotImplementedError()
+
+    def flush(self) -> bytes:
+        """
+        :return: buffered audio at the end of an utterance
+        """
+        return b''
+
+
+class WavAudioEncoder(AudioEncoder):
+    """
+    every chunk as a standalone wav file
+    """
+
+    def encode(self, pcm: bytes) -> bytes:
+        return encode_wav(pcm, self.sample_rate, self.channels)
+
+
+class PcmAudioEncoder(AudioEncoder):
+    """
+    raw chunks, described once by the stream header
+    """
+
+    def header(self) -> Optional[str]:
+        return json.dumps(dict(
+            format='pcm_s16le',
+            sample_rate=self.sample_rate,
+            channels=self.channels,
+        ))
+
+    def encode(self, pcm: bytes) -> bytes:
+        return pcm
+
+
+class OpusAudioEncoder(AudioEncoder):
+    """
+    20ms opus packets, every message holds the packets of one chunk, each prefixed by its u16le length
+    """
+
+    def __init__(self, sample_rate: int, channels: int = 1):
+        super().__init__(sample_rate, channels)
+        if opuslib is None:
+            raise ValueError('opus output requires the opuslib package')
+        self.encoder = opuslib.Encoder(sample_rate, channels, opuslib.APPLICATION_VOIP)
+        self.frame_samples = int(sample_rate * OPUS_FRAME_DURATION)
+        self.frame_bytes = self.frame_samples * channels * 2
+        self.buffer = b''
+
+    def header(self) -> Optional[str]:
+        return json.dumps(dict(
+            format='opus',
+            sample_rate=self.sample_rate,
+            channels=self.channels,
+            frame_duration=OPUS_FRAME_DURATION,
+            framing='u16le-length-prefixed',
+        ))
+
+    def _packets(self, data: bytes) -> bytes:
+        packets: List[bytes] = []
+        for i in range(0, len(data), self.frame_bytes):
+            packet = self.encoder.encode(data[i:i + self.frame_bytes], self.frame_samples)
+            packets.append(struct.pack('<H', len(packet)) + packet)
+        return b''.join(packets)
+
+    def encode(self, pcm: bytes) -> bytes:
+        data = self.buffer + pcm
+        size = len(data) - len(data) % self.frame_bytes
+        self.buffer = data[size:]
+        return self._packets(data[:size])
+
+    def flush(self) -> bytes:
+        if not self.buffer:
+            return b''
+        # pad the last partial frame with silence
+        data = self.buffer + b'\0' * (self.frame_bytes - len(self.buffer))
+        self.buffer = b''
+        return self._packets(data)
+
+
+def create_audio_encoder(audio_format: str, sample_rate: int) -> AudioEncoder:
+    if audio_format == 'wav':
+        return WavAudioEncoder(sample_rate)
+    if audio_format == 'pcm':
+        return PcmAudioEncoder(sample_rate)
+    if audio_format == 'opus':
+        return OpusAudioEncoder(sample_rate)
+    raise ValueError(f'unsupported audio format: {audio_format}')
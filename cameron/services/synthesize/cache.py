@@ -0,0 +1,219 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+def normalize_phrase(text: str) -> str:
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip().lower()
+
+
+def synthesize_cache_key(text: str, voice_digest: str, language: str, params: Dict) -> str:
+    return hashlib.sha256('\0'.join((
+        normalize_phrase(text),
+        voice_digest,
+        language,
+        json.dumps(params, sort_keys=True, default=str),
+    )).encode('utf-8')).hexdigest()
+
+
+class SynthesizeRecording:
+    """
+    pcm chunks of an utterance and the delay before each of them, relative to the previous chunk
+    """
+
+    def __init__(self, chunks: Optional[List[bytes]] = None, gaps: Optional[List[float]] = None):
+        self.chunks = chunks or []
+        self.gaps = gaps or []
+        self.last = time.monotonic()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def add(self, chunk: bytes):
+        now = time.monotonic()
+        # the first chunk is replayed immediately
+        self.gaps.append(now - self.last if self.chunks else 0.0)
+        self.chunks.append(chunk)
+        self.last = now
+
+    def dump(self) -> bytes:
+        header = json.dumps(dict(sizes=[len(chunk) for chunk in self.chunks], gaps=self.gaps))
+        return header.encode('utf-8') + b'\n' + b''.join(self.chunks)
+
+    @classmethod
+    def load(cls, data: bytes) -> 'SynthesizeRecording':
+        header, body = data.split(b'\n', 1)
+        header = json.loads(header)
+        chunks, offset = [], 0
+        for size in header['sizes']:
+            chunks.append(body[offset:offset + size])
+            offset += size
+        if offset != len(body):
+            raise ValueError('truncated recording')
+        return cls(chunks, header['gaps'])
+
+
+class SynthesizeReplay:
+    """
+    plays a cached recording back with the cadence it was produced with, iterated like a ``SynthesizeJob``
+    """
+
+    def __init__(self, recording: SynthesizeRecording):
+        self.recording = recording
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for gap, chunk in zip(self.recording.gaps, self.recording.chunks):
+            if gap > 0:
+                await asyncio.sleep(gap)
+            if self.cancelled:
+                return
+            yield chunk
+
+
+class SynthesizeCache:
+    """
+    recordings of synthesized phrases, an in-memory LRU tier bounded by bytes, in front of an optional on-disk
+    tier in ``directory`` that is also bounded by bytes, oldest files first
+    """
+
+    def __init__(self, max_bytes: int, directory: Optional[str] = None, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory: OrderedDict[str, SynthesizeRecording] = OrderedDict()
+        self.bytes_resident = 0
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.disk_bytes = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.pcm')
+
+    def get_memory(self, key: str) -> Optional[SynthesizeRecording]:
+        """
+        the in-memory tier only, without touching the disk, a miss is counted by ``get``
+        """
+        with self.lock:
+            recording = self.memory.get(key)
+            if recording is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+            return recording
+
+    def get(self, key: str) -> Optional[SynthesizeRecording]:
+        """
+        blocking, falls back to the on-disk tier
+        """
+        recording = self.get_memory(key)
+        if recording is not None:
+            return recording
+
+        recording = self._read(key)
+        with self.lock:
+            if recording is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, recording)
+        return recording
+
+    def put(self, key: str, recording: SynthesizeRecording):
+        with self.lock:
+            self._remember(key, recording)
+        self._write(key, recording)
+
+    def _remember(self, key: str, recording: SynthesizeRecording):
+        if recording.nbytes > self.max_bytes:
+            return
+        existed = self.memory.pop(key, None)
+        if existed is not None:
+            self.bytes_resident -= existed.nbytes
+        self.memory[key] = recording
+        self.bytes_resident += recording.nbytes
+        while self.bytes_resident > self.max_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.bytes_resident -= evicted.nbytes
+
+    def _read(self, key: str) -> Optional[SynthesizeRecording]:
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                recording = SynthesizeRecording.load(f.read())
+            # keep recently used files away from eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            print(f'synthesize: dropping corrupted cache file {path}: {e}')
+            os.remove(path)
+            return None
+        return recording
+
+    def _write(self, key: str, recording: SynthesizeRecording):
+        if not self.directory:
+            return
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        data = recording.dump()
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self.disk_bytes += len(data)
+        if 0 < self.max_disk_bytes < self.disk_bytes:
+            self._trim_disk()
+
+    def _disk_files(self) -> List[Tuple[float, int, str]]:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pcm'):
+                # replicas of the service share the directory, and trim it concurrently
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _trim_disk(self):
+        files = self._disk_files()
+        self.disk_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self.disk_bytes -= size
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return dict(
+                memory_hits=self.memory_hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                entries=len(self.memory),
+                bytes_resident=self.bytes_resident,
+                disk_bytes=self.disk_bytes,
+            )
@@ -0,0 +1,137 @@
+import hashlib
+import os
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from torch import Tensor
+
+VOICE_DEFAULT = 'default'
+VOICE_EXTENSIONS = ('.wav', '.flac', '.mp3')
+
+Latents = Tuple['Tensor', 'Tensor']
+
+
+def hash_file(path: str, model_name: str) -> str:
+    h = hashlib.sha256(model_name.encode('utf-8') + b'\0')
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class VoiceRegistry:
+    """
+    speaker reference files by voice name, 'default' is ``default_path``, every audio file in ``directory`` is a
+    voice named after the file
+
+    conditioning latents are computed once per reference file, persisted under ``cache_dir`` keyed by the file
+    hash, and loaded on first use
+    """
+
+    def __init__(
+            self,
+            compute: Callable[[str], Latents],
+            model_name: str,
+            default_path: str,
+            directory: str,
+            cache_dir: str,
+            device: str = 'cpu',
+    ):
+        self.compute = compute
+        self.model_name = model_name
+        self.default_path = default_path
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.device = device
+        self.latents: Dict[str, Tuple[Tuple, str, Latents]] = {}
+        self.lock = threading.Lock()
+        # signature of the directory and the reference files found in it
+        self.listing: Optional[Tuple[Tuple, Dict[str, str]]] = None
+
+    def paths(self) -> Dict[str, str]:
+        """
+        reference files by voice name, the directory is only listed again once its mtime changes
+        """
+        try:
+            directory_mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            directory_mtime = None
+        signature = (directory_mtime, os.path.exists(self.default_path))
+        listing = self.listing
+        if listing is None or listing[0] != signature:
+            listing = self.listing = (signature, self._list())
+        return listing[1]
+
+    def _list(self) -> Dict[str, str]:
+        paths = {}
+        if os.path.isdir(self.directory):
+            for filename in sorted(os.listdir(self.directory)):
+                name, ext = os.path.splitext(filename)
+                if ext.lower() in VOICE_EXTENSIONS:
+                    paths[name] = os.path.join(self.directory, filename)
+        if os.path.exists(self.default_path):
+            paths[VOICE_DEFAULT] = self.default_path
+        return paths
+
+    def names(self) -> List[str]:
+        return list(self.paths().keys())
+
+    def exists(self, name: str) -> bool:
+        return name in self.paths()
+
+    def get(self, name: str) -> Latents:
+        """
+        blocking, computes the latents on a cache miss
+
+        :return: gpt conditioning latent and speaker embedding
+        """
+        path = self.paths().get(name)
+        if path is None:
+            # the reference file was removed
+            self.latents.pop(name, None)
+            raise KeyError(f'unknown voice: {name}')
+
+        with self.lock:
+            stat = os.stat(path)
+            # the file is only hashed again when it changed
+            signature = (path, stat.st_mtime_ns, stat.st_size)
+            loaded = self.latents.get(name)
+            if loaded and loaded[0] == signature:
+                return loaded[2]
+
+            digest = hash_file(path, self.model_name)
+            latents = self._load(digest)
+            if latents is None:
+                print(f'synthesize: computing latents of voice {name}')
+                latents = self.compute(path)
+                self._save(digest, latents)
+            self.latents[name] = (signature, digest, latents)
+            return latents
+
+    def digest(self, name: str) -> Optional[str]:
+        """
+        :return: hash of the reference file of a voice already loaded, None otherwise
+        """
+        loaded = self.latents.get(name)
+        return loaded[1] if loaded else None
+
+    def _load(self, digest: str) -> Optional[Latents]:
+        cache_path = os.path.join(self.cache_dir, digest + '.pt')
+        if not os.path.exists(cache_path):
+            return None
+        import torch
+        try:
+            gpt_cond_latent, speaker_embedding = torch.load(cache_path, map_location=self.device)
+        except Exception as e:
+            print(f'synthesize: failed to load cached latents {cache_path}: {e}')
+            return None
+        return gpt_cond_latent, speaker_embedding
+
+    def _save(self, digest: str, latents: Latents):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = os.path.join(self.cache_dir, digest + '.pt')
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        import torch
+        torch.save(tuple(t.detach().cpu() for t in latents), tmp_path)
+        os.replace(tmp_path, cache_path)
@@ -0,0 +1,104 @@
+import asyncio
+import queue
+import threading
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+SYNTHESIZE_JOB_END = object()
+
+
+class SynthesizeJob:
+    """
+    a queued utterance, chunks produced by the worker thread are consumed by iterating the job asynchronously,
+    the worker blocks once ``max_pending`` chunks are waiting to be consumed
+    """
+
+    def __init__(self, text: str, loop: asyncio.AbstractEventLoop, max_pending: int = 4, **kwargs):
+        self.text = text
+        self.kwargs = kwargs
+        self.loop = loop
+        self.chunks: asyncio.Queue = asyncio.Queue()
+        self.slots = threading.Semaphore(max_pending)
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def put(self, item) -> bool:
+        """
+        called from the worker thread, waits for a free slot
+
+        :return: False if the job was cancelled meanwhile
+        """
+        while not self.slots.acquire(timeout=0.1):
+            if self.cancelled.is_set():
+                return False
+        if self.cancelled.is_set():
+            return False
+        self.loop.call_soon_threadsafe(self.chunks.put_nowait, item)
+        return True
+
+    def finish(self, error: Optional[Exception] = None):
+        self.loop.call_soon_threadsafe(self.chunks.put_nowait, error or SYNTHESIZE_JOB_END)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            while True:
+                item = await self.chunks.get()
+                if item is SYNTHESIZE_JOB_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                self.slots.release()
+                yield item
+        finally:
+            self.cancel()
+
+
+class SynthesizeWorker:
+    """
+    runs blocking inference for queued jobs one after another on a dedicated thread
+    """
+
+    def __init__(self, infer: Callable[[SynthesizeJob], Iterator[bytes]], max_pending: int = 4):
+        self.infer = infer
+        self.max_pending = max_pending
+        self.jobs: queue.SimpleQueue[Optional[SynthesizeJob]] = queue.SimpleQueue()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='synthesize-worker', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.jobs.put(None)
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, text: str, **kwargs) -> SynthesizeJob:
+        job = SynthesizeJob(text, asyncio.get_running_loop(), max_pending=self.max_pending, **kwargs)
+        self.jobs.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if job.cancelled.is_set():
+                job.finish()
+                continue
+            chunks = None
+            try:
+                chunks = self.infer(job)
+                for chunk in chunks:
+                    if not job.put(chunk):
+                        break
+                job.finish()
+            except Exception as e:
+                print(f'synthesize: inference failed: {e}')
+                job.finish(e)
+            finally:
+                # stop the model generator early when the job was cancelled
+                if hasattr(chunks, 'close'):
+                    chunks.close()
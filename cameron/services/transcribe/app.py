@@ -1,140 +1,234 @@
-import asyncio
 import contextlib
 import json
 import os.path
 import time
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
+import websockets
 from starlette.applications import Starlette
 from starlette.endpoints import WebSocketEndpoint
-from starlette.routing import WebSocketRoute
+from starlette.routing import Route, WebSocketRoute
 from starlette.types import Scope, Receive, Send
 from starlette.websockets import WebSocket
 
-from cameron.vendor import nls
+from cameron.services.health import route_health
+from .transcriber import AliyunNlsTranscriber, NlsTokenManager, Transcriber
+from .vad import VAD_AUDIO, VAD_SPEECH_END, VAD_SPEECH_START, VoiceActivityDetector
+from .whisper import WhisperModel, WhisperTranscriber
 
+TRANSCRIBE_SAMPLE_RATE = 16000
+# 'aliyun' for the cloud service, 'whisper' for a local model
+TRANSCRIBE_BACKEND = os.getenv('CAMERON_TRANSCRIBE_BACKEND', 'aliyun')
+TRANSCRIBE_VAD_ENABLED = os.getenv('CAMERON_VAD_ENABLED', '1') == '1'
+TRANSCRIBE_VAD_HANGOVER = float(os.getenv('CAMERON_VAD_HANGOVER', '0.8'))
 
-def get_aliyun_nls_token() -> str:
-    token_file = os.path.join('data', 'aliyun-nls.token.json')
+NLS_TOKEN_REFRESH_AHEAD = float(os.getenv('CAMERON_NLS_TOKEN_REFRESH_AHEAD', '3600'))
 
-    conf = {}
+WHISPER_MODEL = os.getenv('CAMERON_WHISPER_MODEL', 'small')
+WHISPER_LANGUAGE = os.getenv('CAMERON_WHISPER_LANGUAGE', 'zh') or None
+WHISPER_COMPUTE_TYPE = os.getenv('CAMERON_WHISPER_COMPUTE_TYPE', 'int8')
+WHISPER_CPU_THREADS = int(os.getenv('CAMERON_WHISPER_CPU_THREADS', '0'))
+WHISPER_WORKERS = int(os.getenv('CAMERON_WHISPER_WORKERS', '1'))
+WHISPER_MAX_CHUNK = float(os.getenv('CAMERON_WHISPER_MAX_CHUNK', '15'))
 
-    if os.path.exists(token_file):
-        # noinspection PyBroadException
-        try:
-            with open(token_file, 'r') as f:
-                conf = json.load(f)
-        except Exception:
-            pass
-
-    if 'expires_at' in conf and 'token' in conf:
-        if conf['expires_at'] > int(time.time()):
-            print('aliyun-nls: using existed token')
-            return conf['token']
-
-    token, expires_at = nls.get_token(
-        os.getenv('ALIYUN_NLS_ACCESS_KEY_ID'),
-        os.getenv('ALIYUN_NLS_ACCESS_KEY_SECRET'),
-    )
 
-    print('aliyun-nls: fetched new token')
+def parse_transcribe_message(data: str) -> Optional[Dict]:
+    """
+    a text message is a json object, e.g. ``{"trace_id": ...}``, None if it is not
+    """
+    try:
+        message = json.loads(data)
+    except json.JSONDecodeError:
+        return None
+    return message if isinstance(message, dict) else None
 
-    with open(token_file, 'w') as f:
-        json.dump({
-            'token': token,
-            'expires_at': expires_at,
-        }, f)
 
-    return token
-
-
-def decode_aliyun_nls_data(s: str) -> (str, int):
-    data = json.loads(s)
-    if "payload" not in data:
-        return "", 0
-    payload = data["payload"]
-    if "result" not in payload or "index" not in payload:
-        return "", 0
-    return payload["result"], payload["index"]
+class RecognizerEndpoint(WebSocketEndpoint):
+    """
+    receives 16 kHz signed 16-bit mono pcm, sends every transcribed sentence as text
 
+    with the ``events=1`` query parameter, json events are sent instead, ``{"type": "sentence", "text": ...}``, and
+    ``{"type": "speech_start"}`` / ``{"type": "speech_end"}`` from voice activity detection
 
-class RecognizerEndpoint(WebSocketEndpoint):
-    encoding = 'bytes'
+    a text message ``{"trace_id": ...}`` tags the following sentence events with the trace id of the utterance, a
+    sentence decoded after the end of speech also reports ``asr_seconds`` since then
+    """
+    encoding = None
 
     def __init__(self, scope: Scope, receive: Receive, send: Send):
         super().__init__(scope, receive, send)
-        self.transcriber: Optional[nls.NlsSpeechTranscriber] = None
+        self.transcriber: Optional[Transcriber] = None
+        self.vad: Optional[VoiceActivityDetector] = None
+        self.events = False
+        self.trace_id: Optional[str] = None
+        self.speech_end_at: Optional[float] = None
+        self.disconnected = False
 
     async def on_connect(self, websocket: WebSocket) -> None:
         await super().on_connect(websocket)
 
-        def on_sentence_end(s: str, *args, **kwargs):
-            content, index = decode_aliyun_nls_data(s)
-            if not content or not index:
-                return
-            print(f"on_sentence_end: {content}")
-            asyncio.run(websocket.send_text(content))
+        self.events = websocket.query_params.get('events') == '1'
 
-        def on_result_changed(s: str, *args, **kwargs):
-            result, index = decode_aliyun_nls_data(s)
-            if not result or not index:
+        async def on_sentence(content: str):
+            if self.disconnected:
+                # the tail of the stream decoded after the client disconnected
+                print(f'transcribe: sentence after disconnect: {content}')
                 return
-            print(f"on_result_changed: {result}")
-
-        def on_close(*args, **kwargs):
-            async def try_close():
-                try:
-                    await websocket.close()
-                except Exception as _:
-                    pass
-
-            asyncio.run(try_close())
-
-        nls_token = get_aliyun_nls_token()
-        self.transcriber = nls.NlsSpeechTranscriber(
-            url=os.getenv('ALIYUN_NLS_ENDPOINT'),
-            token=nls_token,
-            appkey=os.getenv('ALIYUN_NLS_APP_KEY'),
-            on_sentence_end=on_sentence_end,
-            on_result_changed=on_result_changed,
-            on_close=on_close,
-        )
-        self.transcriber.start(
-            aformat="pcm",
-            sample_rate=16000,
-            ch=1,
-            enable_intermediate_result=True,
-            enable_punctuation_prediction=True,
-            enable_inverse_text_normalization=True,
-        )
+            if self.events:
+                event = dict(type='sentence', text=content)
+                if self.trace_id:
+                    event['trace_id'] = self.trace_id
+                if self.speech_end_at is not None:
+                    event['asr_seconds'] = time.monotonic() - self.speech_end_at
+                    self.speech_end_at = None
+                await websocket.send_text(json.dumps(event, ensure_ascii=False))
+            else:
+                await websocket.send_text(content)
+
+        async def on_close():
+            try:
+                await websocket.close()
+            except Exception as _:
+                pass
+
+        service: RecognizerService = websocket.state.service
+        transcriber = service.create_transcriber(on_sentence, on_close)
+        if TRANSCRIBE_VAD_ENABLED or transcriber.requires_vad:
+            self.vad = VoiceActivityDetector(sample_rate=TRANSCRIBE_SAMPLE_RATE, hangover=TRANSCRIBE_VAD_HANGOVER)
 
-    async def on_receive(self, websocket: WebSocket, data: bytes) -> None:
+        try:
+            await transcriber.start()
+        except Exception as e:
+            print(f"transcribe: failed to start transcription: {e}")
+            await websocket.close(code=1011)
+            return
+        self.transcriber = transcriber
+
+    async def on_receive(self, websocket: WebSocket, data: str | bytes) -> None:
         await super().on_receive(websocket, data)
-        self.transcriber.send_audio(data)
+        if isinstance(data, str):
+            message = parse_transcribe_message(data)
+            if message is None:
+                print(f'transcribe: ignoring text message {data[:64]!r}')
+            else:
+                self.trace_id = message.get('trace_id')
+            return
+        if not self.transcriber:
+            return
+        if not self.vad:
+            await self._send_audio(data)
+            return
+        await self._forward(websocket, self.vad.push(data))
+
+    async def _forward(self, websocket: WebSocket, items: List[Tuple[str, Optional[bytes]]], events: bool = True):
+        """
+        pass the output of voice activity detection to the transcriber
+
+        :param events: send speech events to the client, unless it is gone
+        """
+        for kind, frame in items:
+            if kind == VAD_AUDIO:
+                await self._send_audio(frame)
+                continue
+            if kind == VAD_SPEECH_START:
+                self.speech_end_at = None
+                await self.transcriber.speech_start()
+            elif kind == VAD_SPEECH_END:
+                self.speech_end_at = time.monotonic()
+                await self.transcriber.speech_end()
+            if self.events and events:
+                await websocket.send_text(json.dumps(dict(type=kind)))
+
+    async def _send_audio(self, data: bytes):
+        try:
+            await self.transcriber.send_audio(data)
+        except websockets.ConnectionClosed:
+            # on_close of the transcriber closes the websocket
+            pass
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int) -> None:
+        self.disconnected = True
         if self.transcriber:
-            self.transcriber.stop()
+            if self.vad:
+                # the tail of an utterance cut off by the disconnect is still transcribed
+                await self._forward(websocket, self.vad.flush(), events=False)
+            await self.transcriber.stop()
+            self.transcriber = None
+        if self.vad and self.vad.frames_in:
+            print(f"transcribe: forwarded {self.vad.frames_out} of {self.vad.frames_in} audio frames")
         await super().on_disconnect(websocket, close_code)
 
 
 class RecognizerService:
     def __init__(self):
-        self.lock = asyncio.Lock()
+        self.whisper: Optional[WhisperModel] = None
+        self.token_manager: Optional[NlsTokenManager] = None
+        if TRANSCRIBE_BACKEND == 'whisper':
+            self.whisper = WhisperModel(
+                WHISPER_MODEL,
+                WHISPER_LANGUAGE,
+                compute_type=WHISPER_COMPUTE_TYPE,
+                cpu_threads=WHISPER_CPU_THREADS,
+                workers=WHISPER_WORKERS,
+            )
+        elif TRANSCRIBE_BACKEND == 'aliyun':
+            self.token_manager = NlsTokenManager(
+                os.path.join('data', 'aliyun-nls.token.json'),
+                os.getenv('ALIYUN_NLS_ACCESS_KEY_ID'),
+                os.getenv('ALIYUN_NLS_ACCESS_KEY_SECRET'),
+                refresh_ahead=NLS_TOKEN_REFRESH_AHEAD,
+            )
+        else:
+            raise ValueError(f'unknown transcribe backend: {TRANSCRIBE_BACKEND}')
+        print(f'transcribe: using {TRANSCRIBE_BACKEND} backend')
+
+    def start(self):
+        if self.token_manager:
+            # fetches a token ahead of the first session unless a valid one is persisted
+            self.token_manager.start()
+
+    def create_transcriber(self, on_sentence, on_close) -> Transcriber:
+        if self.whisper:
+            return WhisperTranscriber(
+                on_sentence,
+                on_close,
+                self.whisper,
+                sample_rate=TRANSCRIBE_SAMPLE_RATE,
+                max_chunk=WHISPER_MAX_CHUNK,
+            )
+        max_sentence_silence = None
+        if TRANSCRIBE_VAD_ENABLED:
+            # silence after the hangover is not forwarded, the cloud must end a sentence before the hangover does
+            max_sentence_silence = max(200, int(TRANSCRIBE_VAD_HANGOVER * 1000) - 200)
+        return AliyunNlsTranscriber(
+            on_sentence,
+            on_close,
+            self.token_manager,
+            sample_rate=TRANSCRIBE_SAMPLE_RATE,
+            max_sentence_silence=max_sentence_silence,
+        )
 
     def destroy(self):
-        pass
+        if self.token_manager:
+            self.token_manager.close()
+            self.token_manager = None
+        if self.whisper:
+            self.whisper.destroy()
+            self.whisper = None
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app):
+    started_at = time.monotonic()
     service = RecognizerService()
-    yield dict(service=service)
+    service.start()
+    yield dict(service=service, load_time=time.monotonic() - started_at)
     service.destroy()
 
 
 app = Starlette(
     routes=[
+        Route('/transcribe/health', endpoint=route_health, methods=['GET']),
         WebSocketRoute('/transcribe/ws', endpoint=RecognizerEndpoint)
     ],
     lifespan=lifespan
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+import websockets
+from websockets import WebSocketClientProtocol
+
+NLS_TRANSCRIBER_NAMESPACE = 'SpeechTranscriber'
+NLS_TRANSCRIBER_CONTEXT = {
+    'sdk': {
+        'name': 'nls-python-sdk',
+        'version': '0.0.1',
+        'language': 'python'
+    }
+}
+
+NlsCallback = Callable[[Dict], Awaitable[None]]
+
+
+class NlsTranscriberError(Exception):
+    pass
+
+
+class AsyncNlsTranscriber:
+    """
+    asyncio client of the aliyun nls realtime transcription protocol, the same StartTranscription /
+    StopTranscription / ControlTranscriber messages as ``nls.NlsSpeechTranscriber``, without a thread per session
+
+    callbacks are coroutines awaited on the event loop with the decoded server message, in the order messages arrive
+    """
+
+    def __init__(
+            self,
+            url: str,
+            token: str,
+            appkey: str,
+            on_sentence_begin: Optional[NlsCallback] = None,
+            on_sentence_end: Optional[NlsCallback] = None,
+            on_result_changed: Optional[NlsCallback] = None,
+            on_completed: Optional[NlsCallback] = None,
+            on_error: Optional[NlsCallback] = None,
+            on_close: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        if not token or not appkey:
+            raise NlsTranscriberError('must provide token and appkey')
+        self.url = url
+        self.token = token
+        self.appkey = appkey
+        self.handlers: Dict[str, Optional[NlsCallback]] = {
+            'SentenceBegin': on_sentence_begin,
+            'SentenceEnd': on_sentence_end,
+            'TranscriptionResultChanged': on_result_changed,
+            'TranscriptionCompleted': on_completed,
+            'TaskFailed': on_error,
+        }
+        self.on_close = on_close
+
+        self.task_id = uuid.uuid4().hex
+        self.ws: Optional[WebSocketClientProtocol] = None
+        self.receive_task: Optional[asyncio.Task] = None
+        self.started: Optional[asyncio.Future] = None
+        self.completed: Optional[asyncio.Future] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self.started and self.started.done() and not self.started.exception()) and \
+            not self.completed.done()
+
+    def _message(self, name: str, payload: Optional[Dict] = None) -> str:
+        message = dict(
+            header=dict(
+                message_id=uuid.uuid4().hex,
+                task_id=self.task_id,
+                namespace=NLS_TRANSCRIBER_NAMESPACE,
+                name=name,
+                appkey=self.appkey,
+            ),
+            context=NLS_TRANSCRIBER_CONTEXT,
+        )
+        if payload is not None:
+            message['payload'] = payload
+        return json.dumps(message)
+
+    async def start(
+            self,
+            aformat: str = 'pcm',
+            sample_rate: int = 16000,
+            enable_intermediate_result: bool = False,
+            enable_punctuation_prediction: bool = False,
+            enable_inverse_text_normalization: bool = False,
+            timeout: float = 10,
+            ping_interval: Optional[float] = 8,
+            ex: Optional[Dict] = None,
+    ):
+        """
+        connect and wait for the TranscriptionStarted message
+
+        :param ex: merged into the payload of the start message
+        """
+        if aformat not in ('pcm', 'opus', 'opu', 'wav'):
+            raise ValueError(f'format {aformat} not supported')
+        loop = asyncio.get_running_loop()
+        self.started = loop.create_future()
+        self.completed = loop.create_future()
+
+        self.ws = await websockets.connect(
+            self.url,
+            extra_headers={'X-NLS-Token': self.token},
+            ping_interval=ping_interval,
+            open_timeout=timeout,
+            max_size=None,
+        )
+        self.receive_task = asyncio.create_task(self._receive_loop())
+
+        payload = dict(
+            format=aformat,
+            sample_rate=sample_rate,
+            enable_intermediate_result=enable_intermediate_result,
+            enable_punctuation_prediction=enable_punctuation_prediction,
+            enable_inverse_text_normalization=enable_inverse_text_normalization,
+        )
+        if ex:
+            payload.update(ex)
+        await self.ws.send(self._message('StartTranscription', payload))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self.started), timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise NlsTranscriberError(f'waiting for start over {timeout}s')
+        except Exception:
+            await self.close()
+            raise
+
+    async def send_audio(self, data: bytes):
+        """
+        audio is dropped unless the transcription is running, 20ms per frame is preferred
+        """
+        if not self.running:
+            return
+        await self.ws.send(data)
+
+    async def ctrl(self, **kwargs):
+        if not kwargs:
+            raise NlsTranscriberError('empty control payload')
+        if not self.running:
+            return
+        await self.ws.send(self._message('ControlTranscriber', kwargs))
+
+    async def stop(self, timeout: float = 10):
+        """
+        finish the transcription, waits for the TranscriptionCompleted message then closes the connection
+        """
+        try:
+            if self.running:
+                await self.ws.send(self._message('StopTranscription'))
+                await asyncio.wait_for(asyncio.shield(self.completed), timeout)
+        except asyncio.TimeoutError:
+            print(f'aliyun-nls: waiting for stop over {timeout}s')
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.ws:
+            await self.ws.close()
+        if self.receive_task:
+            await asyncio.gather(self.receive_task, return_exceptions=True)
+            self.receive_task = None
+
+    async def _dispatch(self, message: Dict):
+        name = message.get('header', {}).get('name')
+        if name == 'TranscriptionStarted':
+            if not self.started.done():
+                self.started.set_result(message)
+        elif name == 'TranscriptionCompleted':
+            if not self.completed.done():
+                self.completed.set_result(message)
+        elif name == 'TaskFailed':
+            error = NlsTranscriberError(message.get('header', {}).get('status_text', 'task failed'))
+            if not self.started.done():
+                self.started.set_exception(error)
+            if not self.completed.done():
+                self.completed.set_exception(error)
+        elif name not in self.handlers:
+            print(f'aliyun-nls: unhandled message {name}')
+            return
+
+        handler = self.handlers.get(name)
+        if handler:
+            await handler(message)
+
+    async def _receive_loop(self):
+        try:
+            async for data in self.ws:
+                if not isinstance(data, str):
+                    continue
+                try:
+                    message = json.loads(data)
+                except json.JSONDecodeError:
+                    print(f'aliyun-nls: cannot parse message {data}')
+                    continue
+                try:
+                    await self._dispatch(message)
+                except Exception as e:
+                    print(f'aliyun-nls: callback failed: {e}')
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            error = NlsTranscriberError('connection closed')
+            for future in (self.started, self.completed):
+                if not future.done():
+                    future.set_exception(error)
+                # retrieved here so an unawaited future does not log a warning
+                future.exception()
+            if self.on_close:
+                try:
+                    await self.on_close()
+                except Exception as e:
+                    print(f'aliyun-nls: close callback failed: {e}')
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from cameron.vendor import nls
+from .nls import AsyncNlsTranscriber
+
+SentenceCallback = Callable[[str], Awaitable[None]]
+CloseCallback = Callable[[], Awaitable[None]]
+
+
+class Transcriber:
+    """
+    a transcription session, audio is 16 kHz signed 16-bit mono pcm, every recognized sentence is passed to
+    ``on_sentence``, ``on_close`` is called when the session ends on its own
+    """
+
+    # the backend has no end-of-sentence detection of its own, and relies on speech_start / speech_end
+    requires_vad = False
+
+    def __init__(self, on_sentence: SentenceCallback, on_close: CloseCallback):
+        self.on_sentence = on_sentence
+        self.on_close = on_close
+
+    async def start(self):
+        raise NotImplementedError()
+
+    async def send_audio(self, data: bytes):
+        raise NotImplementedError()
+
+    async def speech_start(self):
+        pass
+
+    async def speech_end(self):
+        pass
+
+    async def stop(self):
+        raise NotImplementedError()
+
+
+class NlsTokenManager:
+    """
+    keeps the aliyun nls token in memory, and refreshes it in the background ``refresh_ahead`` seconds before it
+    expires, concurrent refreshes share a single fetch
+
+    the token is persisted to ``path`` for the next start
+    """
+
+    def __init__(self, path: str, access_key_id: str, access_key_secret: str, refresh_ahead: float = 3600):
+        self.path = path
+        self.access_key_id = access_key_id
+        self.access_key_secret = access_key_secret
+        self.refresh_ahead = refresh_ahead
+        self.token: Optional[str] = None
+        self.expires_at = 0
+        self.refreshing: Optional[asyncio.Task] = None
+        self.refresh_loop_task: Optional[asyncio.Task] = None
+
+    def _load(self):
+        # noinspection PyBroadException
+        try:
+            with open(self.path, 'r') as f:
+                conf = json.load(f)
+            self.token, self.expires_at = conf['token'], conf['expires_at']
+        except Exception:
+            pass
+
+    def _fetch(self) -> Tuple[str, int]:
+        """
+        blocking, fetch a new token and persist it
+        """
+        token, expires_at = nls.get_token(self.access_key_id, self.access_key_secret)
+        if not token:
+            raise ValueError('failed to fetch token')
+
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'token': token,
+                'expires_at': expires_at,
+            }, f)
+        os.replace(tmp_path, self.path)
+        return token, expires_at
+
+    @property
+    def valid(self) -> bool:
+        return bool(self.token) and self.expires_at > time.time() + 10
+
+    async def get(self) -> str:
+        if self.valid:
+            return self.token
+        return await self.refresh()
+
+    async def refresh(self) -> str:
+        if not self.refreshing:
+            self.refreshing = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self.refreshing)
+
+    async def _refresh(self) -> str:
+        try:
+            self.token, self.expires_at = await asyncio.to_thread(self._fetch)
+            print('aliyun-nls: fetched new token')
+            return self.token
+        finally:
+            self.refreshing = None
+
+    def start(self):
+        self._load()
+        if self.valid:
+            print('aliyun-nls: using existed token')
+        self.refresh_loop_task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        retry_delay = 5
+        while True:
+            lifetime = self.expires_at - time.time()
+            await asyncio.sleep(max(0.0, lifetime - min(self.refresh_ahead, lifetime / 2)))
+            try:
+                await self.refresh()
+                retry_delay = 5
+            except Exception as e:
+                print(f'aliyun-nls: failed to refresh token: {e}, retrying in {retry_delay}s')
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 300)
+
+    def close(self):
+        if self.refresh_loop_task:
+            self.refresh_loop_task.cancel()
+            self.refresh_loop_task = None
+
+
+def decode_aliyun_nls_data(data: Dict) -> (str, int):
+    if "payload" not in data:
+        return "", 0
+    payload = data["payload"]
+    if "result" not in payload or "index" not in payload:
+        return "", 0
+    return payload["result"], payload["index"]
+
+
+class AliyunNlsTranscriber(Transcriber):
+    """
+    aliyun cloud realtime transcription
+
+    :param max_sentence_silence: milliseconds of silence ending a sentence, None for the server default
+    """
+
+    def __init__(
+            self,
+            on_sentence: SentenceCallback,
+            on_close: CloseCallback,
+            token_manager: NlsTokenManager,
+            sample_rate: int = 16000,
+            max_sentence_silence: Optional[int] = None,
+    ):
+        super().__init__(on_sentence, on_close)
+        self.token_manager = token_manager
+        self.sample_rate = sample_rate
+        self.max_sentence_silence = max_sentence_silence
+        self.client: Optional[AsyncNlsTranscriber] = None
+
+    async def start(self):
+        async def on_sentence_end(message: Dict):
+            content, index = decode_aliyun_nls_data(message)
+            if not content or not index:
+                return
+            print(f"on_sentence_end: {content}")
+            await self.on_sentence(content)
+
+        async def on_result_changed(message: Dict):
+            result, index = decode_aliyun_nls_data(message)
+            if not result or not index:
+                return
+            print(f"on_result_changed: {result}")
+
+        nls_token = await self.token_manager.get()
+        self.client = AsyncNlsTranscriber(
+            url=os.getenv('ALIYUN_NLS_ENDPOINT'),
+            token=nls_token,
+            appkey=os.getenv('ALIYUN_NLS_APP_KEY'),
+            on_sentence_end=on_sentence_end,
+            on_result_changed=on_result_changed,
+            on_close=self.on_close,
+        )
+        ex = None
+        if self.max_sentence_silence:
+            ex = dict(max_sentence_silence=self.max_sentence_silence)
+        await self.client.start(
+            aformat="pcm",
+            sample_rate=self.sample_rate,
+            enable_intermediate_result=True,
+            enable_punctuation_prediction=True,
+            enable_inverse_text_normalization=True,
+            ex=ex,
+        )
+
+    async def send_audio(self, data: bytes):
+        await self.client.send_audio(data)
+
+    async def stop(self):
+        if self.client:
+            await self.client.stop()
+            self.client = None
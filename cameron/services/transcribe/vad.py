@@ -0,0 +1,132 @@
+import collections
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+VAD_AUDIO = 'audio'
+VAD_SPEECH_START = 'speech_start'
+VAD_SPEECH_END = 'speech_end'
+
+
+class VoiceActivityDetector:
+    """
+    energy and zero-crossing rate based voice activity detection over signed 16-bit little-endian mono pcm
+
+    input of any size is cut into frames of ``frame_ms``, frames are forwarded while speaking, plus ``preroll``
+    seconds before the speech start and ``hangover`` seconds after the last voiced frame, silence in between is
+    dropped except for a zero frame every ``keepalive`` seconds, so the upstream connection does not time out
+
+    the energy threshold follows the noise floor, measured while silent
+    """
+
+    def __init__(
+            self,
+            sample_rate: int = 16000,
+            frame_ms: int = 20,
+            margin_db: float = 12,
+            min_energy_db: float = -55,
+            max_zero_crossing_rate: float = 0.35,
+            start: float = 0.06,
+            preroll: float = 0.3,
+            hangover: float = 0.8,
+            keepalive: float = 1.0,
+    ):
+        self.frame_bytes = sample_rate * frame_ms // 1000 * 2
+        self.margin_db = margin_db
+        self.min_energy_db = min_energy_db
+        self.max_zero_crossing_rate = max_zero_crossing_rate
+        self.start_frames = max(1, round(start * 1000 / frame_ms))
+        self.hangover_frames = max(1, round(hangover * 1000 / frame_ms))
+        self.keepalive_frames = max(1, round(keepalive * 1000 / frame_ms))
+
+        self.buffer = bytearray()
+        self.preroll: collections.deque = collections.deque(
+            maxlen=max(self.start_frames, round(preroll * 1000 / frame_ms)),
+        )
+        self.noise_db: Optional[float] = None
+        self.speaking = False
+        # consecutive voiced frames while silent, consecutive unvoiced frames while speaking
+        self.run = 0
+        self.silent_frames = 0
+
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def _measure(self, frame: bytes) -> Tuple[float, float]:
+        samples = np.frombuffer(frame, dtype='<i2').astype(np.float32) / 32768
+        energy_db = 10 * np.log10(np.mean(samples * samples) + 1e-10)
+        zero_crossing_rate = np.count_nonzero(np.diff(np.signbit(samples))) / len(samples)
+        return float(energy_db), float(zero_crossing_rate)
+
+    def _is_voiced(self, frame: bytes) -> bool:
+        energy_db, zero_crossing_rate = self._measure(frame)
+        if self.noise_db is None:
+            self.noise_db = energy_db
+        threshold = max(self.min_energy_db, self.noise_db + self.margin_db)
+        # loud frames are speech regardless of their rate, quiet noisy frames (hiss) are not
+        voiced = energy_db > threshold and (
+                zero_crossing_rate < self.max_zero_crossing_rate or energy_db > threshold + self.margin_db
+        )
+        if not self.speaking and not voiced:
+            self.noise_db = 0.95 * self.noise_db + 0.05 * energy_db
+        return voiced
+
+    def push(self, data: bytes) -> List[Tuple[str, Optional[bytes]]]:
+        """
+        :return: ordered ('audio', frame), ('speech_start', None) and ('speech_end', None) items
+        """
+        self.buffer.extend(data)
+        output = []
+        while len(self.buffer) >= self.frame_bytes:
+            frame = bytes(self.buffer[:self.frame_bytes])
+            del self.buffer[:self.frame_bytes]
+            self._process(frame, output)
+        return output
+
+    def _emit(self, output: List, frame: bytes):
+        output.append((VAD_AUDIO, frame))
+        self.frames_out += 1
+
+    def _process(self, frame: bytes, output: List):
+        self.frames_in += 1
+        voiced = self._is_voiced(frame)
+
+        if self.speaking:
+            self._emit(output, frame)
+            self.run = 0 if voiced else self.run + 1
+            if self.run >= self.hangover_frames:
+                self.speaking = False
+                self.run = 0
+                self.silent_frames = 0
+                output.append((VAD_SPEECH_END, None))
+            return
+
+        self.preroll.append(frame)
+        self.run = self.run + 1 if voiced else 0
+        if self.run >= self.start_frames:
+            self.speaking = True
+            self.run = 0
+            output.append((VAD_SPEECH_START, None))
+            for buffered in self.preroll:
+                self._emit(output, buffered)
+            self.preroll.clear()
+            return
+
+        self.silent_frames += 1
+        if self.silent_frames >= self.keepalive_frames:
+            self.silent_frames = 0
+            self._emit(output, bytes(self.frame_bytes))
+
+    def flush(self) -> List[Tuple[str, Optional[bytes]]]:
+        """
+        end of the stream, a partial frame is zero padded
+        """
+        output = []
+        if self.buffer:
+            frame = bytes(self.buffer) + bytes(self.frame_bytes - len(self.buffer))
+            self.buffer.clear()
+            self._process(frame, output)
+        if self.speaking:
+            self.speaking = False
+            output.append((VAD_SPEECH_END, None))
+        return output
@@ -0,0 +1,145 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from .transcriber import CloseCallback, SentenceCallback, Transcriber
+
+
+class WhisperModel:
+    """
+    a whisper model run by ctranslate2 on the cpu, shared by all sessions, decoding happens on a thread pool so the
+    event loop is never blocked
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            language: Optional[str],
+            compute_type: str = 'int8',
+            cpu_threads: int = 0,
+            workers: int = 1,
+            beam_size: int = 1,
+    ):
+        # ctranslate2 is only imported when the whisper backend is selected
+        try:
+            import faster_whisper
+        except ImportError:
+            raise ValueError('the whisper backend requires the faster-whisper package')
+        print(f'transcribe: loading whisper model {model_name} ({compute_type})')
+        self.model = faster_whisper.WhisperModel(
+            model_name,
+            device='cpu',
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            num_workers=workers,
+        )
+        self.language = language
+        self.beam_size = beam_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='whisper')
+
+    def _transcribe(self, pcm: bytes) -> str:
+        audio = np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768
+        segments, _ = self.model.transcribe(
+            audio,
+            language=self.language,
+            beam_size=self.beam_size,
+            condition_on_previous_text=False,
+            without_timestamps=True,
+        )
+        return ''.join(segment.text for segment in segments).strip()
+
+    async def transcribe(self, pcm: bytes) -> str:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._transcribe, pcm)
+
+    def destroy(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.model = None
+
+
+class WhisperTranscriber(Transcriber):
+    """
+    local transcription, the speech between speech_start and speech_end is decoded as one sentence, speech longer
+    than ``max_chunk`` seconds is cut at its quietest 20ms frame of the last second and decoded while the rest
+    is still arriving
+    """
+    requires_vad = True
+
+    def __init__(
+            self,
+            on_sentence: SentenceCallback,
+            on_close: CloseCallback,
+            model: WhisperModel,
+            sample_rate: int = 16000,
+            max_chunk: float = 15,
+            min_chunk: float = 0.3,
+    ):
+        super().__init__(on_sentence, on_close)
+        self.model = model
+        self.sample_rate = sample_rate
+        self.max_chunk_bytes = int(max_chunk * sample_rate) * 2
+        # shorter speech is most likely noise, on which whisper tends to hallucinate
+        self.min_chunk_bytes = int(min_chunk * sample_rate) * 2
+        self.buffer = bytearray()
+        self.chunks: asyncio.Queue = asyncio.Queue()
+        self.decode_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.decode_task = asyncio.create_task(self._decode_loop())
+
+    async def send_audio(self, data: bytes):
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.max_chunk_bytes:
+            self._cut(self._quietest_offset())
+
+    async def speech_start(self):
+        # drops keepalive frames of the preceding silence
+        self.buffer.clear()
+
+    async def speech_end(self):
+        self._cut(len(self.buffer))
+
+    async def stop(self):
+        self._cut(len(self.buffer))
+        if self.decode_task:
+            self.chunks.put_nowait(None)
+            await self.decode_task
+            self.decode_task = None
+
+    def _quietest_offset(self) -> int:
+        frame_bytes = self.sample_rate // 50 * 2
+        start = max(0, len(self.buffer) - self.sample_rate * 2) // frame_bytes * frame_bytes
+        tail = np.frombuffer(self.buffer, dtype='<i2', offset=start, count=(len(self.buffer) - start) // 2)
+        frames = tail[:len(tail) // (frame_bytes // 2) * (frame_bytes // 2)].reshape(-1, frame_bytes // 2)
+        if not len(frames):
+            return len(self.buffer)
+        energy = np.mean(frames.astype(np.float32) ** 2, axis=1)
+        return start + int(np.argmin(energy)) * frame_bytes
+
+    def _cut(self, offset: int):
+        if offset <= 0:
+            return
+        self.chunks.put_nowait(bytes(self.buffer[:offset]))
+        del self.buffer[:offset]
+
+    async def _decode_loop(self):
+        # one chunk at a time, sentences are delivered in order
+        while True:
+            pcm = await self.chunks.get()
+            if pcm is None:
+                return
+            if len(pcm) < self.min_chunk_bytes:
+                continue
+            try:
+                text = await self.model.transcribe(pcm)
+            except Exception as e:
+                print(f'transcribe: whisper decoding failed: {e}')
+                continue
+            if not text:
+                continue
+            print(f"on_sentence_end: {text}")
+            try:
+                await self.on_sentence(text)
+            except Exception as e:
+                print(f'transcribe: delivering sentence failed: {e}')
@@ -0,0 +1,60 @@
+import struct
+from typing import Optional
+
+import numpy as np
+
+VECTORS_MEDIA_TYPE = 'application/x-cameron-vectors'
+
+# magic, version, dtype code, reserved, rows, dim
+_VECTORS_HEADER = struct.Struct('<4sBBHII')
+_VECTORS_MAGIC = b'CVEC'
+_VECTORS_VERSION = 1
+
+_VECTORS_DTYPES = {
+    'float32': (0, np.dtype('<f4')),
+    'float16': (1, np.dtype('<f2')),
+}
+_VECTORS_DTYPE_CODES = {code: dtype for code, dtype in _VECTORS_DTYPES.values()}
+
+
+def encode_vectors(vectors: np.ndarray, dtype: str = 'float32') -> bytes:
+    """
+    encode a 2d array as a small header followed by raw little-endian rows
+    """
+    code, np_dtype = _VECTORS_DTYPES[dtype]
+    vectors = np.ascontiguousarray(vectors, dtype=np_dtype)
+    rows, dim = vectors.shape
+    return _VECTORS_HEADER.pack(_VECTORS_MAGIC, _VECTORS_VERSION, code, 0, rows, dim) + vectors.tobytes()
+
+
+def decode_vectors(data: bytes) -> np.ndarray:
+    """
+    decode ``encode_vectors`` output, the returned array is a read-only view over ``data``
+    """
+    magic, version, code, _, rows, dim = _VECTORS_HEADER.unpack_from(data)
+    if magic != _VECTORS_MAGIC or version != _VECTORS_VERSION:
+        raise ValueError('invalid vectors payload')
+    return np.frombuffer(
+        data,
+        dtype=_VECTORS_DTYPE_CODES[code],
+        count=rows * dim,
+        offset=_VECTORS_HEADER.size,
+    ).reshape(rows, dim)
+
+
+def negotiate_vectors_dtype(accept: Optional[str]) -> Optional[str]:
+    """
+    :param accept: Accept header, e.g. ``application/x-cameron-vectors; dtype=float16``
+    :return: requested dtype, None if binary vectors are not acceptable
+    """
+    for media_range in (accept or '').split(','):
+        media_type, *params = [s.strip() for s in media_range.split(';')]
+        if media_type != VECTORS_MEDIA_TYPE:
+            continue
+        dtype = 'float32'
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'dtype' and value.strip() in _VECTORS_DTYPES:
+                dtype = value.strip()
+        return dtype
+    return None
@@ -0,0 +1,110 @@
+import time
+import uuid
+from typing import Dict, Optional
+
+from cameron.metrics import Counter, Gauge, Histogram
+
+# stages of a reply in order, 'asr_final' is measured from the start of the utterance, every later stage from
+# 'asr_final'
+TRACE_STAGE_ASR_FINAL = 'asr_final'
+TRACE_STAGE_GENERATION_START = 'generation_start'
+TRACE_STAGE_FIRST_TOKEN = 'first_token'
+TRACE_STAGE_FIRST_AUDIO = 'first_audio'
+TRACE_STAGE_REPLY_DONE = 'reply_done'
+
+TRACE_STAGE_SECONDS = Histogram(
+    'cameron_voice_stage_seconds',
+    'seconds to reach a stage of a reply, the final transcription from the start of the utterance, every later '
+    'stage from the final transcription',
+    labels=('stage',),
+)
+TRACE_SERVICE_SECONDS = Histogram(
+    'cameron_service_stage_seconds',
+    'seconds spent in a stage as reported by the service, e.g. queue and prefill of generation',
+    labels=('service', 'stage'),
+)
+TRACE_UTTERANCES = Counter(
+    'cameron_voice_utterances_total',
+    'utterances by outcome, one of replied, superseded, failed or incomplete',
+    labels=('outcome',),
+)
+TRACE_ACTIVE = Gauge(
+    'cameron_voice_traces_active',
+    'utterances transcribed and not yet replied to',
+)
+
+
+def create_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class UtteranceTrace:
+    """
+    timings of one utterance, from its first voice frame to the last audio chunk of the reply, identified by
+    ``trace_id`` in the requests to every service
+    """
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or create_trace_id()
+        self.started_at = time.monotonic()
+        self.marks: Dict[str, float] = {}
+        self.durations: Dict[str, float] = {}
+        self.finished = False
+        # clauses sent for synthesis and finished by synthesize
+        self.clauses_sent = 0
+        self.clauses_done = 0
+        self.generation_done = False
+
+    def restart(self):
+        """
+        move the start of the utterance to now, e.g. once speech starts after a silence
+        """
+        if not self.marks:
+            self.started_at = time.monotonic()
+
+    def mark(self, stage: str):
+        """
+        record the first time a stage is reached
+        """
+        if stage in self.marks or self.finished:
+            return
+        now = time.monotonic()
+        self.marks[stage] = now
+        if stage == TRACE_STAGE_ASR_FINAL:
+            TRACE_ACTIVE.inc()
+            TRACE_STAGE_SECONDS.observe(now - self.started_at, stage=stage)
+        else:
+            since = self.marks.get(TRACE_STAGE_ASR_FINAL, self.started_at)
+            TRACE_STAGE_SECONDS.observe(now - since, stage=stage)
+
+    def record(self, service: str, stage: str, seconds: float):
+        """
+        record a duration reported by a service
+        """
+        self.durations[f'{service}.{stage}'] = seconds
+        TRACE_SERVICE_SECONDS.observe(seconds, service=service, stage=stage)
+
+    @property
+    def reply_done(self) -> bool:
+        return self.generation_done and self.clauses_done >= self.clauses_sent
+
+    def finish(self, outcome: str):
+        if self.finished:
+            return
+        if outcome == 'replied':
+            self.mark(TRACE_STAGE_REPLY_DONE)
+        self.finished = True
+        if TRACE_STAGE_ASR_FINAL in self.marks:
+            TRACE_ACTIVE.dec()
+        TRACE_UTTERANCES.inc(outcome=outcome)
+        print(f'trace: {self.trace_id} {outcome} {self.summary()}')
+
+    def summary(self) -> str:
+        since = self.marks.get(TRACE_STAGE_ASR_FINAL, self.started_at)
+        items = []
+        for stage, at in self.marks.items():
+            start = self.started_at if stage == TRACE_STAGE_ASR_FINAL else since
+            items.append(f'{stage}={at - start:.3f}s')
+        for stage, seconds in self.durations.items():
+            items.append(f'{stage}={seconds:.3f}s')
+        return ' '.join(items)
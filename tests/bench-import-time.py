@@ -0,0 +1,100 @@
+import argparse
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# ml stacks loaded on service startup, never on import
+HEAVY_MODULES = ['torch', 'torchaudio', 'transformers', 'sentence_transformers', 'TTS', 'faster_whisper']
+
+# entry point -> (import statement, seconds of cumulative import time allowed)
+ENTRY_POINTS = {
+    'package': ('import cameron', 0.05),
+    'cli': ('from cameron import cli', 1.0),
+    'app': ('import cameron.app', 1.5),
+    'embeddings': ('import cameron.services.embeddings', 1.0),
+    'generation': ('import cameron.services.generation', 1.0),
+    'synthesize': ('import cameron.services.synthesize', 1.0),
+    'transcribe': ('import cameron.services.transcribe', 1.0),
+}
+
+IMPORT_TIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure(statement: str) -> List[Tuple[str, int, int, int]]:
+    """
+    :return: (module, self microseconds, cumulative microseconds, nesting depth) of every import
+    """
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        cwd=Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+    )
+    if res.returncode != 0:
+        raise RuntimeError(f'{statement} failed:\n{res.stderr}')
+    modules = []
+    for line in res.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            modules.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3))))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure import time of each entry point with python -X importtime')
+    parser.add_argument('entry_points', nargs='*', default=list(ENTRY_POINTS))
+    parser.add_argument('--repeat', type=int, default=3, help='best of n runs')
+    parser.add_argument('--top', type=int, default=5, help='modules with the slowest own import time to print')
+    parser.add_argument('--output', help='write results as json')
+    args = parser.parse_args()
+
+    # imported by the interpreter on startup, before the statement runs
+    startup = {name for name, _, _, _ in measure('pass')}
+
+    results: Dict[str, Dict] = {}
+    failed = []
+    for entry_point in args.entry_points:
+        statement, budget = ENTRY_POINTS[entry_point]
+        best = None
+        for _ in range(args.repeat):
+            imported = [m for m in measure(statement) if m[0] not in startup]
+            total = sum(cumulative for _, _, cumulative, depth in imported if depth == 1) / 1e6
+            if best is None or total < best[0]:
+                best = (total, imported)
+        total, imported = best
+        names = {name.split('.')[0] for name, _, _, _ in imported}
+        heavy = [name for name in HEAVY_MODULES if name in names]
+
+        print(f'{entry_point:<12} {total:6.3f}s (budget {budget:.2f}s) {statement}')
+        for name, own, _, _ in sorted(imported, key=lambda m: -m[1])[:args.top]:
+            print(f'    {own / 1e3:8.1f}ms {name}')
+        if heavy:
+            print(f'    heavy modules imported: {", ".join(heavy)}')
+        if heavy or total > budget:
+            failed.append(entry_point)
+
+        results[entry_point] = dict(
+            statement=statement,
+            seconds=total,
+            budget=budget,
+            heavy_modules=heavy,
+            modules=[
+                dict(module=name, seconds=own / 1e6, cumulative_seconds=cumulative / 1e6, depth=depth)
+                for name, own, cumulative, depth in imported
+            ],
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if failed:
+        print(f'regressions: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
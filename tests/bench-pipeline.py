@@ -0,0 +1,615 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+ROOT = Path(__file__).parent.parent
+
+SERVICES = ['generation', 'embeddings', 'synthesize', 'transcribe']
+
+TRANSCRIBE_SAMPLE_RATE = 16000
+TRANSCRIBE_FRAME_SECONDS = 0.02
+# leading silence of an utterance, the voice activity detection measures the noise floor on it
+TRANSCRIBE_LEADING_SILENCE_SECONDS = 0.2
+# trailing silence of an utterance, longer than the hangover of the voice activity detection
+TRANSCRIBE_SILENCE_SECONDS = 1.2
+
+DEFAULT_TEXTS = [
+    '早上好，今天天气怎么样？',
+    '帮我记一下，明天下午三点开会。',
+    '你还记得我们上次聊到的那本书吗？',
+    '给我讲一个简短的故事吧。',
+    'What time is it in Tokyo right now?',
+    'Remind me to call my mother tonight.',
+    '这个周末有什么好玩的地方推荐吗？',
+    'Can you summarize what we talked about yesterday?',
+]
+
+
+def percentiles(values: List[float]) -> Optional[Dict]:
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return dict(p50=p50, p95=p95, p99=p99, mean=float(np.mean(values)), max=max(values))
+
+
+def read_texts(path: Optional[str]) -> List[str]:
+    if not path:
+        return DEFAULT_TEXTS
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def synthesize_utterances(count: int = 8) -> List[bytes]:
+    """
+    voiced harmonics under a syllable envelope, 1 to 2 seconds long, passing the voice activity detection
+    """
+    rng = np.random.default_rng(0)
+    utterances = []
+    for _ in range(count):
+        duration = rng.uniform(1.0, 2.0)
+        t = np.arange(int(duration * TRANSCRIBE_SAMPLE_RATE)) / TRANSCRIBE_SAMPLE_RATE
+        f0 = rng.uniform(120, 220)
+        signal = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+        envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 4 * t)
+        samples = 0.1 * signal * envelope / np.max(np.abs(signal))
+        utterances.append((samples * 32767).astype('<i2').tobytes())
+    return utterances
+
+
+def read_utterances(path: Optional[str]) -> List[bytes]:
+    """
+    16 kHz signed 16-bit mono .wav or raw .pcm files of ``path``, one utterance each
+    """
+    if not path:
+        return synthesize_utterances()
+    utterances = []
+    for file in sorted(Path(path).iterdir()):
+        if file.suffix == '.pcm':
+            utterances.append(file.read_bytes())
+        elif file.suffix == '.wav':
+            with wave.open(str(file)) as f:
+                if f.getframerate() != TRANSCRIBE_SAMPLE_RATE or f.getnchannels() != 1 or f.getsampwidth() != 2:
+                    print(f'bench: skipping {file}, not 16 kHz 16-bit mono')
+                    continue
+                utterances.append(f.readframes(f.getnframes()))
+    if not utterances:
+        raise ValueError(f'no utterances in {path}')
+    return utterances
+
+
+def prepare_workdir(workdir: Path):
+    """
+    the files services expect under data/, a reference voice and an nls token that never expires
+    """
+    data = workdir / 'data'
+    data.mkdir(parents=True, exist_ok=True)
+    sample_rate = 24000
+    t = np.arange(sample_rate * 3) / sample_rate
+    with wave.open(str(data / 'tts_ref.wav'), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((0.3 * np.sin(2 * np.pi * 220 * t) * 32767).astype('<i2').tobytes())
+    with open(data / 'aliyun-nls.token.json', 'w') as f:
+        json.dump(dict(token='benchmark', expires_at=int(time.time()) + 365 * 24 * 3600), f)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_nls_server(port: int, latency: float) -> subprocess.Popen:
+    env = dict(os.environ, LOCAL_NLS_SERVER_PORT=str(port), LOCAL_NLS_SERVER_LATENCY=str(latency))
+    process = subprocess.Popen([sys.executable, str(ROOT / 'tests' / 'fake-nls-server.py')], env=env)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('fake nls server did not start')
+
+
+def read_memory(pid: int) -> Dict[str, float]:
+    """
+    :return: resident and peak resident MiB of a process
+    """
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value, _ = line.split()
+                    memory[key[:-1]] = int(value) / 1024
+    except FileNotFoundError:
+        pass
+    return memory
+
+
+class MemorySampler:
+    """
+    samples the resident memory of the replicas of a service in the background, summed over replicas
+    """
+
+    def __init__(self, pids: List[int], interval: float = 0.05):
+        self.pids = pids
+        self.interval = interval
+        self.peak = 0.0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self) -> float:
+        return sum(read_memory(pid).get('VmRSS', 0) for pid in self.pids)
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.peak = max(self.peak, self.sample())
+
+    def __enter__(self) -> 'MemorySampler':
+        self.before = self.sample()
+        self.peak = self.before
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopping.set()
+        self.thread.join()
+
+    def result(self) -> Dict:
+        return dict(
+            rss_before_mib=self.before,
+            rss_peak_mib=self.peak,
+            rss_after_mib=self.sample(),
+            hwm_mib=sum(read_memory(pid).get('VmHWM', 0) for pid in self.pids),
+        )
+
+
+class ServiceDriver:
+    """
+    one kind of request to a service, ``request`` returns seconds to the first result, if any, and the units of work
+    done, e.g. characters generated or seconds of audio
+    """
+    name = ''
+    unit = ''
+
+    def __init__(self, args, texts: List[str], utterances: List[bytes]):
+        self.args = args
+        self.texts = texts
+        self.utterances = utterances
+
+    async def connect(self):
+        return None
+
+    async def close(self, conn):
+        pass
+
+    async def request(self, conn, i: int) -> Tuple[Optional[float], float]:
+        raise NotImplementedError()
+
+
+class GenerationDriver(ServiceDriver):
+    name = 'generation'
+    unit = 'characters'
+
+    async def request(self, conn, i: int) -> Tuple[Optional[float], float]:
+        from cameron.services.client import stream_service
+
+        started_at = time.monotonic()
+        first = None
+        output_text = ''
+        async for event in stream_service(
+                'generation',
+                '/generation/stream',
+                affinity=f'bench-{i}',
+                input_text=self.texts[i % len(self.texts)],
+                history=[],
+                max_new_tokens=self.args.max_new_tokens,
+                trace_id=f'bench-{i}',
+        ):
+            if first is None and 'delta' in event:
+                first = time.monotonic() - started_at
+            output_text = event.get('output_text', output_text)
+        return first, len(output_text)
+
+
+class EmbeddingsDriver(ServiceDriver):
+    name = 'embeddings'
+    unit = 'texts'
+
+    async def request(self, conn, i: int) -> Tuple[Optional[float], float]:
+        from cameron.services.client import invoke_service_vectors
+
+        batch = self.args.embeddings_batch
+        texts = [self.texts[(i * batch + k) % len(self.texts)] for k in range(batch)]
+        if not self.args.cache:
+            # distinct texts, so a cached vector is never measured
+            texts = [f'{text} {i}-{k}' for k, text in enumerate(texts)]
+        vectors = await invoke_service_vectors('embeddings', '/embeddings/encode', idempotent=True, texts=texts)
+        return None, len(vectors)
+
+
+class SynthesizeDriver(ServiceDriver):
+    name = 'synthesize'
+    unit = 'audio seconds'
+
+    async def connect(self):
+        from cameron.services.balancer import SERVICE_BALANCER
+        from cameron.services.client import connect_service_websocket
+
+        replica = SERVICE_BALANCER.acquire('synthesize')
+        ws = await connect_service_websocket('synthesize', '/synthesize/ws?format=pcm&events=1', replica)
+        header = json.loads(await ws.recv())
+        return ws, replica, header.get('sample_rate', 24000)
+
+    async def close(self, conn):
+        from cameron.services.balancer import SERVICE_BALANCER
+
+        ws, replica, _ = conn
+        SERVICE_BALANCER.release('synthesize', replica)
+        await ws.close()
+
+    async def request(self, conn, i: int) -> Tuple[Optional[float], float]:
+        ws, _, sample_rate = conn
+        started_at = time.monotonic()
+        first = None
+        pcm_bytes = 0
+        await ws.send(json.dumps(dict(text=self.texts[i % len(self.texts)], trace_id=f'bench-{i}')))
+        while True:
+            data = await ws.recv()
+            if isinstance(data, bytes):
+                if first is None:
+                    first = time.monotonic() - started_at
+                pcm_bytes += len(data)
+            elif json.loads(data).get('type') == 'end':
+                return first, pcm_bytes / 2 / sample_rate
+
+
+class TranscribeDriver(ServiceDriver):
+    """
+    streams an utterance between silences in 20ms frames, ``--audio-speed`` times faster than real time, the first
+    result is the sentence, measured from the last frame of speech
+    """
+    name = 'transcribe'
+    unit = 'audio seconds'
+
+    async def connect(self):
+        from cameron.services.client import connect_service_websocket
+
+        ws = await connect_service_websocket('transcribe', '/transcribe/ws?events=1')
+        events = asyncio.Queue()
+
+        async def receive():
+            async for data in ws:
+                await events.put((time.monotonic(), json.loads(data)))
+
+        return ws, events, asyncio.create_task(receive())
+
+    async def close(self, conn):
+        ws, _, task = conn
+        await ws.close()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def _send(self, ws, audio: bytes):
+        frame_bytes = int(TRANSCRIBE_SAMPLE_RATE * TRANSCRIBE_FRAME_SECONDS) * 2
+        for offset in range(0, len(audio), frame_bytes):
+            await ws.send(audio[offset:offset + frame_bytes])
+            await asyncio.sleep(TRANSCRIBE_FRAME_SECONDS / self.args.audio_speed)
+
+    async def request(self, conn, i: int) -> Tuple[Optional[float], float]:
+        ws, events, task = conn
+        utterance = self.utterances[i % len(self.utterances)]
+        silence = bytes(int(TRANSCRIBE_SAMPLE_RATE * TRANSCRIBE_SILENCE_SECONDS) * 2)
+        # the end of speech of the previous utterance follows its sentence
+        while not events.empty():
+            events.get_nowait()
+        await ws.send(json.dumps(dict(trace_id=f'bench-{i}')))
+        await self._send(ws, silence[:int(TRANSCRIBE_SAMPLE_RATE * TRANSCRIBE_LEADING_SILENCE_SECONDS) * 2])
+        await self._send(ws, utterance)
+        speech_sent_at = time.monotonic()
+        await self._send(ws, silence)
+
+        while True:
+            if task.done():
+                raise ConnectionError('transcribe closed the connection')
+            received_at, event = await events.get()
+            if event['type'] == 'sentence':
+                return received_at - speech_sent_at, len(utterance) / 2 / TRANSCRIBE_SAMPLE_RATE
+
+
+DRIVERS = {driver.name: driver for driver in (GenerationDriver, EmbeddingsDriver, SynthesizeDriver, TranscribeDriver)}
+
+
+async def run_level(driver: ServiceDriver, concurrency: int, requests: int, timeout: float) -> Dict:
+    """
+    ``requests`` requests from ``concurrency`` workers, each keeping a connection when the service has them
+    """
+    pending = iter(range(requests))
+    latencies = []
+    firsts = []
+    units = 0.0
+    errors = []
+
+    async def worker():
+        nonlocal units
+        conn = None
+        for i in pending:
+            started_at = time.monotonic()
+            try:
+                if conn is None:
+                    conn = await driver.connect()
+                first, done = await asyncio.wait_for(driver.request(conn, i), timeout)
+            except Exception as e:
+                errors.append(f'{type(e).__name__}: {e}')
+                if conn is not None:
+                    await asyncio.gather(driver.close(conn), return_exceptions=True)
+                    conn = None
+                continue
+            latencies.append(time.monotonic() - started_at)
+            if first is not None:
+                firsts.append(first)
+            units += done
+        if conn is not None:
+            await driver.close(conn)
+
+    started_at = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    seconds = time.monotonic() - started_at
+    return dict(
+        concurrency=concurrency,
+        requests=requests,
+        errors=len(errors),
+        error_samples=sorted(set(errors))[:5],
+        seconds=seconds,
+        throughput=len(latencies) / seconds,
+        unit=driver.unit,
+        units_per_second=units / seconds,
+        latency=percentiles(latencies),
+        first=percentiles(firsts),
+    )
+
+
+async def run_benchmark(args, supervisor, texts: List[str], utterances: List[bytes]) -> Dict[str, Dict]:
+    from cameron.services.client import close_service_pool, open_service_pool
+
+    open_service_pool()
+    results = {}
+    try:
+        for name in args.services:
+            driver = DRIVERS[name](args, texts, utterances)
+            pids = [worker.process.pid for worker in supervisor.workers if worker.name == name]
+            if args.warmup:
+                await run_level(driver, 1, args.warmup, args.timeout)
+            results[name] = {}
+            for concurrency in args.concurrency:
+                with MemorySampler(pids) as sampler:
+                    result = await run_level(driver, concurrency, args.requests, args.timeout)
+                result['memory'] = sampler.result()
+                results[name][str(concurrency)] = result
+                print_result(name, result)
+    finally:
+        await close_service_pool()
+    return results
+
+
+def format_seconds(stats: Optional[Dict], key: str) -> str:
+    return f'{stats[key] * 1000:8.1f}ms' if stats else f'{"-":>10}'
+
+
+def print_result(name: str, result: Dict):
+    latency = result['latency']
+    print(
+        f'{name:<11} c={result["concurrency"]:<3} {result["throughput"]:7.2f} req/s '
+        f'{result["units_per_second"]:9.1f} {result["unit"]}/s '
+        f'p50 {format_seconds(latency, "p50")} p95 {format_seconds(latency, "p95")} '
+        f'p99 {format_seconds(latency, "p99")} '
+        f'first p50 {format_seconds(result["first"], "p50")} '
+        f'rss {result["memory"]["rss_peak_mib"]:7.1f}MiB errors {result["errors"]}'
+    )
+    for error in result['error_samples']:
+        print(f'    {error}')
+
+
+def print_comparison(old: Dict, new: Dict):
+    """
+    relative change of throughput, latency and peak memory of the levels run in both
+    """
+
+    def change(before: Optional[float], after: Optional[float]) -> str:
+        if not before or after is None:
+            return f'{"-":>8}'
+        return f'{(after - before) / before * 100:+7.1f}%'
+
+    print(f'compared to {old.get("commit", "unknown")[:10]} of {old.get("created_at", "unknown")}')
+    for name, levels in new['results'].items():
+        for concurrency, result in levels.items():
+            before = old.get('results', {}).get(name, {}).get(concurrency)
+            if not before:
+                continue
+            items = [f'throughput {change(before["throughput"], result["throughput"])}']
+            for key in ('p50', 'p95', 'p99'):
+                items.append(f'{key} {change((before["latency"] or {}).get(key), (result["latency"] or {}).get(key))}')
+            items.append(f'first p50 {change((before["first"] or {}).get("p50"), (result["first"] or {}).get("p50"))}')
+            items.append(f'rss {change(before["memory"]["rss_peak_mib"], result["memory"]["rss_peak_mib"])}')
+            print(f'{name:<11} c={concurrency:<3} ' + ' '.join(items))
+
+
+def git_commit() -> Tuple[str, bool]:
+    """
+    :return: commit of the tree, and whether it has uncommitted changes
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True,
+        ).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def start_services(names: List[str], log_path: Path):
+    """
+    start the services with their output in ``log_path``, the benchmark prints its own
+    """
+    from cameron.services.bootstrap import ServiceSupervisor
+
+    supervisor = ServiceSupervisor(names)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout, stderr = os.dup(1), os.dup(2)
+    with open(log_path, 'a') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            supervisor.start()
+        finally:
+            os.dup2(stdout, 1)
+            os.dup2(stderr, 2)
+            os.close(stdout)
+            os.close(stderr)
+    return supervisor
+
+
+def print_log_tail(log_path: Path, lines: int = 40):
+    if log_path.exists():
+        print(f'bench: last lines of {log_path}')
+        print(''.join(log_path.read_text(errors='replace').splitlines(keepends=True)[-lines:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the services over their unix sockets, offline, with stub models and a fake nls server',
+    )
+    parser.add_argument('--services', default=','.join(SERVICES), help='comma separated services to benchmark')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated levels of concurrent requests')
+    parser.add_argument('--requests', type=int, default=32, help='requests per service and level')
+    parser.add_argument('--warmup', type=int, default=2, help='requests per service before measuring')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds per request')
+    parser.add_argument('--text-file', help='utterances to generate, synthesize and embed, one per line')
+    parser.add_argument('--audio-dir', help='16 kHz 16-bit mono .wav or .pcm utterances to transcribe')
+    parser.add_argument('--audio-speed', type=float, default=4, help='audio is streamed this many times real time')
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--embeddings-batch', type=int, default=8, help='texts per embeddings request')
+    parser.add_argument('--nls-latency', type=float, default=50, help='milliseconds of the fake nls per sentence')
+    parser.add_argument('--cache', action='store_true', help='keep the synthesize and embeddings caches enabled')
+    parser.add_argument('--workdir', help='working directory of the services, a temporary one by default')
+    parser.add_argument('--output', help='json results, data/benchmark/<time>-<commit>.json by default')
+    parser.add_argument('--compare', help='json results of an earlier run to compare with')
+    args = parser.parse_args()
+    args.services = [name for name in args.services.split(',') if name]
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+    for name in args.services:
+        if name not in DRIVERS:
+            parser.error(f'unknown service {name}')
+
+    texts = read_texts(args.text_file)
+    utterances = read_utterances(args.audio_dir)
+    commit, dirty = git_commit()
+    created_at = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    output = Path(args.output or ROOT / 'data' / 'benchmark' / f'{time.strftime("%Y%m%d-%H%M%S")}-{commit[:10]}.json')
+    output = output.resolve()
+    compare = Path(args.compare).resolve() if args.compare else None
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='cameron-bench-')).resolve()
+    prepare_workdir(workdir)
+    log_path = workdir / 'services.log'
+    nls_port = free_port()
+    nls_server = start_fake_nls_server(nls_port, args.nls_latency)
+
+    # read by the services on import, in the forked workers
+    os.environ.update(
+        CAMERON_STUB_MODELS='1',
+        CAMERON_TRANSCRIBE_BACKEND='aliyun',
+        ALIYUN_NLS_ENDPOINT=f'ws://localhost:{nls_port}',
+        ALIYUN_NLS_APP_KEY='benchmark',
+    )
+    if not args.cache:
+        os.environ.update(
+            CAMERON_SYNTHESIZE_CACHE_BYTES='0',
+            CAMERON_EMBEDDINGS_CACHE_SIZE='0',
+            CAMERON_EMBEDDINGS_CACHE_DIR='',
+        )
+    sys.path.insert(0, str(ROOT))
+    os.chdir(workdir)
+
+    supervisor = None
+    try:
+        supervisor = start_services(args.services, log_path)
+        started_at = time.monotonic()
+        if not supervisor.wait_ready(timeout=300):
+            print_log_tail(log_path)
+            sys.exit(1)
+        print(f'bench: services ready after {time.monotonic() - started_at:.1f}s, logs in {log_path}')
+
+        results = asyncio.run(run_benchmark(args, supervisor, texts, utterances))
+    except BaseException:
+        print_log_tail(log_path)
+        raise
+    finally:
+        if supervisor:
+            supervisor.stop()
+        nls_server.kill()
+        nls_server.wait()
+        os.chdir(ROOT)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        commit=commit,
+        dirty=dirty,
+        created_at=created_at,
+        host=dict(
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+        ),
+        config=dict(
+            services=args.services,
+            concurrency=args.concurrency,
+            requests=args.requests,
+            warmup=args.warmup,
+            texts=len(texts),
+            utterances=len(utterances),
+            audio_speed=args.audio_speed,
+            max_new_tokens=args.max_new_tokens,
+            embeddings_batch=args.embeddings_batch,
+            nls_latency=args.nls_latency,
+            cache=args.cache,
+        ),
+        results=results,
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f'bench: results written to {output}')
+
+    if compare:
+        with open(compare) as f:
+            print_comparison(json.load(f), report)
+
+    if any(result['errors'] for levels in results.values() for result in levels.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from cameron.services.generation.chat import build_chat_prompt  # noqa: E402
+from cameron.services.generation.scheduler import GenerationScheduler  # noqa: E402
+
+# prompts of different lengths, one repeated so rows of equal length are batched too
+INPUTS = [
+    '你好',
+    'Tell me a short story about a lighthouse keeper and a lost ship.',
+    '你好',
+    '明天下午三点提醒我开会，顺便帮我查一下天气。',
+]
+
+# greedy decoding, so the output only depends on the logits
+GREEDY = dict(temperature=1e-5, top_p=0.0, repetition_penalty=1.0)
+
+
+class RecordingScheduler(GenerationScheduler):
+    """
+    records the prompt lengths of the rows of every decode step
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps: List[List[int]] = []
+
+    def _step(self, batch):
+        self.steps.append([len(request.prompt_ids) for request in batch.requests])
+        super()._step(batch)
+
+    def largest_mixed_step(self) -> List[int]:
+        """
+        :return: prompt lengths of the largest step decoding rows of different lengths together
+        """
+        mixed = [step for step in self.steps if len(set(step)) > 1]
+        self.steps = []
+        return max(mixed, key=len, default=[])
+
+
+def load_model(name: str):
+    if name == 'stub':
+        from cameron.services.stubs import StubCausalLM, StubChatTokenizer
+
+        return StubCausalLM(), StubChatTokenizer()
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(name, device_map='auto', trust_remote_code=True).eval()
+    return model, tokenizer
+
+
+async def decode_alone(scheduler: GenerationScheduler, prompts: List[List[int]], max_new_tokens: int):
+    return [await scheduler.submit(prompt, max_new_tokens=max_new_tokens, **GREEDY) for prompt in prompts]
+
+
+async def decode_together(scheduler: GenerationScheduler, prompts: List[List[int]], max_new_tokens: int):
+    return await asyncio.gather(*[
+        scheduler.submit(prompt, max_new_tokens=max_new_tokens, **GREEDY) for prompt in prompts
+    ])
+
+
+async def decode_staggered(scheduler: GenerationScheduler, prompts: List[List[int]], max_new_tokens: int, after: int):
+    """
+    every prompt joins the running batch once the previous one decoded ``after`` tokens
+    """
+
+    async def consume(prompt: List[int], started: asyncio.Event) -> List[int]:
+        output_ids = []
+        async for token_id in scheduler.stream(prompt, max_new_tokens=max_new_tokens, **GREEDY):
+            output_ids.append(token_id)
+            if len(output_ids) >= after:
+                started.set()
+        started.set()
+        return output_ids
+
+    tasks = []
+    for prompt in prompts:
+        started = asyncio.Event()
+        tasks.append(asyncio.create_task(consume(prompt, started)))
+        await started.wait()
+    return await asyncio.gather(*tasks)
+
+
+async def check(args) -> bool:
+    model, tokenizer = load_model(args.model)
+    scheduler = RecordingScheduler(model, tokenizer, max_batch_size=len(INPUTS))
+    scheduler.start()
+    try:
+        prompts = [build_chat_prompt(tokenizer, input_text, []) for input_text in INPUTS]
+        expected = await decode_alone(scheduler, prompts, args.max_new_tokens)
+        scheduler.steps = []
+        results, mixed = {}, {}
+        results['together'] = await decode_together(scheduler, prompts, args.max_new_tokens)
+        mixed['together'] = scheduler.largest_mixed_step()
+        results['staggered'] = await decode_staggered(scheduler, prompts, args.max_new_tokens, args.stagger)
+        mixed['staggered'] = scheduler.largest_mixed_step()
+    finally:
+        scheduler.stop()
+
+    passed = True
+    for mode, outputs in results.items():
+        # prompts arriving together all share one batch, staggered ones at least partly
+        matched = len(mixed[mode]) >= (len(INPUTS) if mode == 'together' else 2)
+        if not matched:
+            passed = False
+            print(f'{mode}: rows of different lengths did not share a batch, largest mixed step {mixed[mode]}')
+        for input_text, alone, batched in zip(INPUTS, expected, outputs):
+            if batched == alone:
+                continue
+            matched = passed = False
+            print(f'{mode}: {input_text!r} differs from its batch of one')
+            print(f'    alone:   {tokenizer.decode(alone, errors="replace")!r}')
+            print(f'    batched: {tokenizer.decode(batched, errors="replace")!r}')
+        print(f'{mode}: {"ok" if matched else "failed"}')
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='check requests decoded in a mixed batch match their batch of one output, with greedy decoding',
+    )
+    parser.add_argument('--model', default='stub', help='stub, or a model name for AutoModelForCausalLM')
+    parser.add_argument('--max-new-tokens', type=int, default=32)
+    parser.add_argument('--stagger', type=int, default=3, help='tokens decoded before the next request joins')
+    args = parser.parse_args()
+    if not asyncio.run(check(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from cameron.memory import ConversationMemory, MEMORY_RECENT_TURNS, recent_window_start  # noqa: E402
+from cameron.services.generation.chat import build_chat_prompt  # noqa: E402
+from cameron.services.stubs import StubChatTokenizer  # noqa: E402
+
+
+class ScriptedMemory(ConversationMemory):
+    """
+    recalls a different pair of older turns for every input, instead of searching the embeddings service
+    """
+
+    def __init__(self, history: List[List[str]]):
+        self.history = history
+
+    async def search(self, input_text: str, k: int) -> List[Dict]:
+        turn = int(input_text.split()[1].rstrip(','))
+        indexes = random.Random(turn).sample(range(turn), min(k, 2, turn))
+        return [dict(index=i, turn=self.history[i]) for i in indexes]
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+async def check(args) -> bool:
+    tokenizer = StubChatTokenizer()
+    history = []
+    memory = ScriptedMemory(history)
+
+    passed = True
+    shared = 0
+    previous = None
+    for turn in range(args.turns):
+        input_text = f'turn {turn}, what did we talk about?'
+        context = await memory.recall(input_text, history, offset=0)
+        prompt_ids = build_chat_prompt(tokenizer, input_text, context)
+        output_text = f'reply to turn {turn}.'
+
+        if previous is not None:
+            # the prefix cache holds the previous prompt followed by its reply, it must cover the system prompt and
+            # at least the first turn of the context
+            length = common_prefix_length(previous, prompt_ids)
+            moved = recent_window_start(turn) != recent_window_start(turn - 1)
+            if context[0][1] in tokenizer.decode(prompt_ids[:length]):
+                shared += 1
+            elif not moved:
+                passed = False
+                print(f'turn {turn}: shares {length} tokens with the previous turn, not even its first history turn')
+        previous = prompt_ids + tokenizer.encode(output_text)
+        history.append([input_text, output_text])
+
+    print(f'{shared} of {args.turns - 1} turns share history turns with the previous prompt, '
+          f'the recent window advances every {MEMORY_RECENT_TURNS} turns')
+    print('ok' if passed else 'failed')
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='check consecutive generation prompts built from recalled history share a prefix beyond the '
+                    'system prompt, so the prefix cache is reused across turns',
+    )
+    parser.add_argument('--turns', type=int, default=32)
+    args = parser.parse_args()
+    if not asyncio.run(check(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
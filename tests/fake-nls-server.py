@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# a local stand-in of the aliyun nls realtime transcription service, built on the vendored websocket echo-server,
+# ends a sentence after max_sentence_silence of quiet audio following speech, and transcribes it as a placeholder
+
+import asyncio
+import json
+import os
+import uuid
+
+import numpy as np
+import websockets
+
+LOCAL_NLS_SERVER_PORT = os.environ.get('LOCAL_NLS_SERVER_PORT', '8766')
+# milliseconds to decode a sentence, waited before SentenceEnd
+LOCAL_NLS_SERVER_LATENCY = float(os.environ.get('LOCAL_NLS_SERVER_LATENCY', '50'))
+# frames louder than this are speech
+LOCAL_NLS_SERVER_SPEECH_DB = -40
+
+NLS_STATUS_OK = 20000000
+
+
+def message(name: str, task_id: str, payload=None) -> str:
+    data = dict(
+        header=dict(
+            namespace='SpeechTranscriber',
+            name=name,
+            status=NLS_STATUS_OK,
+            message_id=uuid.uuid4().hex,
+            task_id=task_id,
+            status_text='Gateway:SUCCESS:Success.',
+        ),
+    )
+    if payload is not None:
+        data['payload'] = payload
+    return json.dumps(data)
+
+
+async def transcribe(websocket):
+    task_id = ''
+    sample_rate = 16000
+    max_sentence_silence = 800
+    intermediate = False
+    buffer = bytearray()
+    # milliseconds of audio received, of the current sentence start, and of silence since its last speech
+    received = 0
+    begin_time = None
+    silence = 0
+    index = 0
+
+    async def end_sentence():
+        nonlocal begin_time
+        await asyncio.sleep(LOCAL_NLS_SERVER_LATENCY / 1000)
+        await websocket.send(message('SentenceEnd', task_id, dict(
+            index=index,
+            time=received,
+            begin_time=begin_time,
+            result=f'benchmark sentence {index}',
+            confidence=0.9,
+        )))
+        begin_time = None
+
+    async for data in websocket:
+        if isinstance(data, str):
+            request = json.loads(data)
+            name = request['header']['name']
+            if name == 'StartTranscription':
+                task_id = request['header'].get('task_id', uuid.uuid4().hex)
+                payload = request.get('payload', {})
+                sample_rate = payload.get('sample_rate', sample_rate)
+                max_sentence_silence = payload.get('max_sentence_silence', max_sentence_silence)
+                intermediate = payload.get('enable_intermediate_result', False)
+                await websocket.send(message('TranscriptionStarted', task_id))
+            elif name == 'StopTranscription':
+                if begin_time is not None:
+                    await end_sentence()
+                await websocket.send(message('TranscriptionCompleted', task_id))
+            continue
+
+        # 20ms frames of signed 16-bit mono pcm
+        frame_bytes = sample_rate // 50 * 2
+        buffer.extend(data)
+        while len(buffer) >= frame_bytes:
+            samples = np.frombuffer(bytes(buffer[:frame_bytes]), dtype='<i2').astype(np.float32) / 32768
+            del buffer[:frame_bytes]
+            received += 20
+            if 10 * np.log10(np.mean(samples * samples) + 1e-10) > LOCAL_NLS_SERVER_SPEECH_DB:
+                silence = 0
+                if begin_time is None:
+                    index += 1
+                    begin_time = received - 20
+                    await websocket.send(message('SentenceBegin', task_id, dict(index=index, time=received)))
+                elif intermediate and (received - begin_time) % 500 == 0:
+                    await websocket.send(message('TranscriptionResultChanged', task_id, dict(
+                        index=index,
+                        time=received,
+                        result='benchmark',
+                    )))
+            elif begin_time is not None:
+                silence += 20
+                if silence >= max_sentence_silence:
+                    await end_sentence()
+
+
+async def main():
+    async with websockets.serve(transcribe, "localhost", LOCAL_NLS_SERVER_PORT, max_size=None):
+        await asyncio.Future()  # run forever
+
+asyncio.run(main())
@@ -5,3 +5,5 @@ set -eu
 cd "$(dirname "${0}")"
 
 curl -v -XPOST -H 'Content-Type:application/json' -d '{"text":"你好呀世界"}' --unix-socket ../data/service-embeddings.socket http://service/embeddings/encode
+
+curl -v -XPOST -H 'Content-Type:application/json' -d '{"texts":["你好呀世界","早上好夜之城"]}' --unix-socket ../data/service-embeddings.socket http://service/embeddings/encode